@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+__author__ = 'codez'
+
+
+def pytest_collection_modifyitems(items):
+    """
+    Run transaction test cases after other tests, like Django test runner does, because they
+    leave the database without the data created by migrations.
+    """
+    from django.test import TestCase, TransactionTestCase
+
+    def flushes(item):
+        cls = getattr(item, "cls", None)
+        return cls is not None and issubclass(cls, TransactionTestCase) and not issubclass(cls, TestCase)
+
+    items.sort(key=flushes)
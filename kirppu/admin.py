@@ -41,6 +41,7 @@ from .models import (
     TemporaryAccessPermit,
     TemporaryAccessPermitLog,
 )
+from .mobile import invalidate_vendor_status
 
 __author__ = 'jyrkila'
 
@@ -384,6 +385,7 @@ class ItemAdmin(admin.ModelAdmin):
 
     @with_description(ugettext(u"Delete generated bar codes"))
     def _del_ean(self, request, queryset):
+        invalidate_vendor_status(queryset.values_list("vendor_id", flat=True).distinct())
         queryset.update(code="")
 
     @with_description(ugettext(u"Re-generate bar codes for items"))
@@ -428,7 +430,7 @@ class ReceiptAdmin(admin.ModelAdmin):
     ]
     form = ReceiptAdminForm
     search_fields = ["items__code", "items__name"]
-    actions = ["re_calculate_total"]
+    actions = ["re_calculate_total", "verify_total"]
 
     @with_description("Re-calculate total sum of receipt")
     def re_calculate_total(self, request, queryset):
@@ -436,6 +438,20 @@ class ReceiptAdmin(admin.ModelAdmin):
             i.calculate_total()
             i.save(update_fields=["total"])
 
+    @with_description("Verify total sum of receipt")
+    def verify_total(self, request, queryset):
+        drifted = []
+        for i in queryset:  # type: Receipt
+            drift = i.total_drift()
+            if drift:
+                drifted.append(u"{} ({:+})".format(i.pk, drift))
+
+        if drifted:
+            self.message_user(request, ugettext(u"Totals differing from receipt rows: {0}").format(
+                u", ".join(drifted)), messages.WARNING)
+        else:
+            self.message_user(request, ugettext(u"All totals match receipt rows."), messages.SUCCESS)
+
     def has_delete_permission(self, request, obj=None):
         return False
 
@@ -1,7 +1,10 @@
 from __future__ import unicode_literals, print_function, absolute_import
 from functools import wraps
 import json
+import uuid
 
+from django.conf import settings
+from django.core.cache import caches
 from django.http.response import (
     HttpResponse,
     HttpResponseBadRequest,
@@ -44,7 +47,7 @@ class AjaxError(Exception):
 
 
 class AjaxFunc(object):
-    def __init__(self, func, url, method, is_public=False):
+    def __init__(self, func, url, method, is_public=False, query_budget=None):
         self.name = func.__name__               # name of the view function
         self.pkg = func.__module__
         self.func = func
@@ -53,6 +56,7 @@ class AjaxFunc(object):
         self.view = 'kirppu:' + self.view_name  # view name for templates
         self.method = method                    # http method for templates
         self.is_public = is_public
+        self.query_budget = query_budget        # maximum number of database queries of a call
 
 
 def ajax_func(method='POST', params=None, defaults=None):
@@ -121,6 +125,62 @@ def ajax_func(method='POST', params=None, defaults=None):
     return decorator
 
 
+# Cache key of the version of cached checkout identities, see `_cached_identity`.
+IDENTITY_VERSION_KEY = "kirppu:checkout:version"
+
+
+def invalidate_checkout_identities():
+    """
+    Make all cached clerks and counters of checkout sessions invalid.
+    Called when a transaction saving or deleting a Clerk or Counter is committed.
+    """
+    caches[settings.KIRPPU_CHECKOUT_IDENTITY_CACHE].set(IDENTITY_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+
+
+def _cached_identity(request, kind, session_values, load):
+    """
+    Get the clerk or counter of the session, loading it with `load` if it is not cached.
+
+    Loaded values are remembered for the rest of the request, and for
+    `settings.KIRPPU_CHECKOUT_IDENTITY_CACHE_TIME` seconds for later requests of the same session.
+    A cached value is used only if the session values it was loaded with have not changed,
+    and no Clerk or Counter has been changed since.
+
+    :param kind: "clerk" or "counter".
+    :param session_values: Session values the result depends on.
+    :type session_values: tuple
+    :param load: Function returning the value to cache for the session values. May raise AjaxError.
+    :return: Cache entry, a dict with the value in key "value".
+    :rtype: dict
+    """
+    memo = request.__dict__.setdefault("_kirppu_identity", {})
+    entry = memo.get(kind)
+    if entry is not None and entry["session"] == session_values:
+        return entry
+
+    timeout = settings.KIRPPU_CHECKOUT_IDENTITY_CACHE_TIME
+    session_key = request.session.session_key
+    if not timeout or session_key is None:
+        entry = memo[kind] = {"session": session_values, "value": load()}
+        return entry
+
+    cache = caches[settings.KIRPPU_CHECKOUT_IDENTITY_CACHE]
+    key = "kirppu:checkout:{}:{}".format(session_key, kind)
+    found = cache.get_many([key, IDENTITY_VERSION_KEY])
+    version = found.get(IDENTITY_VERSION_KEY)
+    if version is None:
+        version = uuid.uuid4().hex
+        cache.add(IDENTITY_VERSION_KEY, version, timeout=None)
+
+    entry = found.get(key)
+    if entry is None or entry["session"] != session_values or entry["version"] != version:
+        entry = {"session": session_values, "version": version, "value": load()}
+        cache.set(key, entry, timeout=timeout)
+    entry["cache_key"] = key
+    memo[kind] = entry
+    return entry
+
+
 def get_counter(request):
     """
     Get the Counter object associated with a request.
@@ -131,23 +191,20 @@ def get_counter(request):
         raise AjaxError(RET_UNAUTHORIZED, _(u"Not logged in."))
 
     counter_id = request.session["counter"]
-    try:
-        counter_object = Counter.objects.get(pk=counter_id)
-    except Counter.DoesNotExist:
-        raise AjaxError(
-            RET_UNAUTHORIZED,
-            _(u"Counter has gone missing."),
-        )
 
-    return counter_object
+    def load():
+        try:
+            return Counter.objects.get(pk=counter_id)
+        except Counter.DoesNotExist:
+            raise AjaxError(
+                RET_UNAUTHORIZED,
+                _(u"Counter has gone missing."),
+            )
 
+    return _cached_identity(request, "counter", (counter_id,), load)["value"]
 
-def get_clerk(request):
-    """
-    Get the Clerk object associated with a request.
 
-    Raise AjaxError if session is invalid or clerk is not found.
-    """
+def _clerk_entry(request):
     for key in ["clerk", "clerk_token", "counter"]:
         if key not in request.session:
             raise AjaxError(RET_UNAUTHORIZED, _(u"Not logged in."))
@@ -155,15 +212,46 @@ def get_clerk(request):
     clerk_id = request.session["clerk"]
     clerk_token = request.session["clerk_token"]
 
-    try:
-        clerk_object = Clerk.objects.get(pk=clerk_id)
-    except Clerk.DoesNotExist:
-        raise AjaxError(RET_UNAUTHORIZED, _(u"Clerk not found."))
+    def load():
+        try:
+            clerk_object = Clerk.objects.select_related("user").get(pk=clerk_id)
+        except Clerk.DoesNotExist:
+            raise AjaxError(RET_UNAUTHORIZED, _(u"Clerk not found."))
 
-    if clerk_object.access_key != clerk_token:
-        raise AjaxError(RET_UNAUTHORIZED, _(u"Bye."))
+        if clerk_object.access_key != clerk_token:
+            raise AjaxError(RET_UNAUTHORIZED, _(u"Bye."))
 
-    return clerk_object
+        return clerk_object
+
+    return _cached_identity(request, "clerk", (clerk_id, clerk_token), load)
+
+
+def get_clerk(request):
+    """
+    Get the Clerk object associated with a request.
+
+    Raise AjaxError if session is invalid or clerk is not found.
+    """
+    return _clerk_entry(request)["value"]
+
+
+def is_overseer(request):
+    """
+    Check whether the clerk of the request has overseer permission.
+    The result is cached with the clerk, see `get_clerk`.
+
+    Raise AjaxError if session is invalid or clerk is not found.
+    """
+    entry = _clerk_entry(request)
+    if "overseer" not in entry:
+        entry["overseer"] = entry["value"].user.has_perm('kirppu.oversee')
+        if "cache_key" in entry:
+            caches[settings.KIRPPU_CHECKOUT_IDENTITY_CACHE].set(
+                entry["cache_key"],
+                {key: value for key, value in entry.items() if key != "cache_key"},
+                timeout=settings.KIRPPU_CHECKOUT_IDENTITY_CACHE_TIME,
+            )
+    return entry["overseer"]
 
 
 def require_user_features(counter=True, clerk=True, overseer=False, staff_override=False):
@@ -179,9 +267,9 @@ def require_user_features(counter=True, clerk=True, overseer=False, staff_overri
 
             if clerk or overseer:
                 # Thus call raises if clerk is not found.
-                clerk_obj = get_clerk(request)
+                get_clerk(request)
 
-                if overseer and not clerk_obj.user.has_perm('kirppu.oversee'):
+                if overseer and not is_overseer(request):
                     raise AjaxError(RET_FORBIDDEN, _(u"Access denied."))
 
             return func(request, *args, **kwargs)
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from itertools import chain
 
+from django.db import connection
 from django.utils.translation import ugettext as _
 
 from .common import (
@@ -12,7 +13,7 @@ from .common import (
 from ..ajax_util import AjaxError, RET_BAD_REQUEST, RET_CONFLICT
 from ..checkout_api import ajax_func
 from ..forms import ItemRemoveForm
-from ..models import Item, ItemStateLog, ReceiptItem
+from ..models import BoxItemCounts, Item, ItemStateLog, ReceiptItem
 
 __author__ = 'codez'
 
@@ -40,7 +41,7 @@ def box_find(request, box_number, box_item_count="1"):
     box_item_count = _parse_item_count(box_item_count)
 
     box = _get_box_or_404(box_number)
-    available_count = box.item_set.filter(state=Item.BROUGHT).count()
+    available_count = BoxItemCounts.objects.get_for(box.pk).brought_count
     if available_count < box_item_count:
         raise AjaxError(RET_CONFLICT, _("Not enough available box items, only {} exist").format(available_count))
 
@@ -88,31 +89,34 @@ def box_item_reserve(request, box_number, box_item_count="1"):
     receipt_id = request.session["receipt"]
     receipt = get_receipt(receipt_id)
 
-    # Must force id-list to ensure stability.
-    # Otherwise the "list" is considered as a subquery which may not be stable.
-    candidates = list(box.item_set.filter(state=Item.BROUGHT)[:box_item_count].values_list("pk", flat=True))
+    # Items being reserved by other counters are skipped instead of waited for.
+    # The list is forced, as a sliced locking query cannot be used as a subquery.
+    candidates = list(
+        box.item_set
+        .filter(state=Item.BROUGHT)
+        .select_for_update(skip_locked=connection.features.has_select_for_update_skip_locked)
+        [:box_item_count]
+    )
     if len(candidates) == box_item_count:
-        items = Item.objects.filter(pk__in=candidates)
         rows = [
             ReceiptItem(
                 item=item,
                 receipt=receipt,
             )
-            for item in items
+            for item in candidates
         ]
 
-        ItemStateLog.objects.log_states(items, Item.STAGED, request=request)
-        items.update(state=Item.STAGED)
+        ItemStateLog.objects.log_states(candidates, Item.STAGED, request=request)
+        Item.objects.filter(pk__in=[item.pk for item in candidates]).update(state=Item.STAGED)
 
         ReceiptItem.objects.bulk_create(rows)
-        receipt.calculate_total()
-        receipt.save()
+        receipt.add_to_total(sum(item.price for item in candidates))
 
         ret = box.as_dict()
         ret.update(
             total=receipt.total_cents,
             changed=box_item_count,
-            item_codes=list(items.values_list("code", flat=True)),
+            item_codes=[item.code for item in candidates],
             item_name=box.representative_item.name,
         )
         return ret
@@ -149,8 +153,8 @@ def box_item_release(request, box_number, box_item_count="1"):
     for form in forms:
         form.save(request)
         item_codes.append(form.removal_entry.item.code)
-    receipt.calculate_total()
-    receipt.save()
+    # Forms have updated the total through their own instances.
+    receipt.refresh_from_db(fields=("total",))
 
     ret.update(
         total=receipt.total_cents,
@@ -56,8 +56,15 @@ def item_state_conflict(item):
     )
 
 
-def get_receipt(receipt_id):
+def get_receipt(receipt_id, for_update=False):
+    """
+    Get a purchase receipt.
+
+    :param for_update: Lock the receipt until the end of the transaction.
+    :type for_update: bool
+    """
+    receipts = Receipt.objects.select_for_update() if for_update else Receipt.objects
     try:
-        return Receipt.objects.get(pk=receipt_id, type=Receipt.TYPE_PURCHASE)
+        return receipts.get(pk=receipt_id, type=Receipt.TYPE_PURCHASE)
     except Receipt.DoesNotExist:
         raise AjaxError(500, "Receipt {} does not exist.".format(receipt_id))
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, print_function, absolute_import
+
+from collections import deque
+from contextlib import contextmanager
+import functools
+import logging
+import threading
+from timeit import default_timer
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+__author__ = 'codez'
+
+logger = logging.getLogger(__name__)
+
+__all__ = [
+    "ApiMetrics",
+    "EndpointMetrics",
+    "api_metrics",
+]
+
+
+@contextmanager
+def _logged_queries(connection):
+    """
+    Log queries of a database connection within the context, also when not in DEBUG mode.
+
+    The queries are logged to a separate log, as the log of the connection has a maximum length, and
+    its length stops telling the number of new queries once it is full.
+
+    :return: Context value is a list that is filled with the logged queries when the context exits.
+    :rtype: list[dict]
+    """
+    queries = []
+    queries_logged = connection.queries_logged
+    force_debug_cursor = connection.force_debug_cursor
+    # Connecting may run queries, which are not counted.
+    connection.ensure_connection()
+    queries_log = connection.queries_log
+    connection.queries_log = deque()
+    connection.force_debug_cursor = True
+    try:
+        yield queries
+    finally:
+        connection.force_debug_cursor = force_debug_cursor
+        queries.extend(connection.queries_log)
+        connection.queries_log = queries_log
+        if queries_logged:
+            # Keep the queries in the log of the connection, e.g. for CaptureQueriesContext.
+            queries_log.extend(queries)
+
+
+class EndpointMetrics(object):
+    """
+    Accumulated measurements of one API function.
+    """
+    __slots__ = ("calls", "errors", "queries", "max_queries", "over_budget", "db_time", "time", "max_time", "bytes")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.queries = 0
+        self.over_budget = 0
+        self.max_queries = 0
+        self.db_time = 0.0
+        self.time = 0.0
+        self.max_time = 0.0
+        self.bytes = 0
+
+    def add(self, queries, db_time, elapsed, size, error, over_budget):
+        self.calls += 1
+        self.errors += 1 if error else 0
+        self.queries += queries
+        self.over_budget += 1 if over_budget else 0
+        self.max_queries = max(self.max_queries, queries)
+        self.db_time += db_time
+        self.time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        self.bytes += size
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class ApiMetrics(object):
+    """
+    Per-endpoint query counts, database time, latency and response sizes of the checkout API functions.
+
+    Recording is enabled with `settings.KIRPPU_API_METRICS`, or temporarily with `enable`. When disabled,
+    the only cost is the settings lookup. The metrics are kept in process memory, so with several
+    workers each worker reports its own numbers, as usual for Prometheus scraping.
+    """
+    # (Prometheus metric name, EndpointMetrics attribute, metric type, help text)
+    PROMETHEUS_METRICS = (
+        ("kirppu_api_requests_total", "calls", "counter", "Number of API calls."),
+        ("kirppu_api_errors_total", "errors", "counter", "Number of API calls with error response."),
+        ("kirppu_api_queries_total", "queries", "counter", "Number of database queries."),
+        ("kirppu_api_queries_max", "max_queries", "gauge", "Most database queries in a single call."),
+        ("kirppu_api_over_budget_total", "over_budget", "counter", "Number of calls exceeding their query budget."),
+        ("kirppu_api_db_seconds_total", "db_time", "counter", "Time spent in database queries."),
+        ("kirppu_api_seconds_total", "time", "counter", "Time spent in API calls."),
+        ("kirppu_api_seconds_max", "max_time", "gauge", "Longest single API call."),
+        ("kirppu_api_response_bytes_total", "bytes", "counter", "Size of API responses."),
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+        self._forced = 0
+
+    @property
+    def enabled(self):
+        return self._forced > 0 or settings.KIRPPU_API_METRICS
+
+    @contextmanager
+    def enable(self):
+        """
+        Record metrics within the context regardless of settings, e.g. in tests.
+        """
+        with self._lock:
+            self._forced += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._forced -= 1
+
+    def record(self, name, queries, db_time, elapsed, size, error=False, over_budget=False):
+        with self._lock:
+            endpoint = self._endpoints.get(name)
+            if endpoint is None:
+                endpoint = self._endpoints[name] = EndpointMetrics()
+            endpoint.add(queries, db_time, elapsed, size, error, over_budget)
+
+    def get(self, name):
+        """
+        :param name: API function name.
+        :type name: str
+        :return: Metrics of the function, or None if it has not been called while recording.
+        :rtype: dict | None
+        """
+        with self._lock:
+            endpoint = self._endpoints.get(name)
+            return endpoint.as_dict() if endpoint is not None else None
+
+    def snapshot(self):
+        """
+        :return: Metrics of all called functions by function name.
+        :rtype: dict[str, dict]
+        """
+        with self._lock:
+            return {name: endpoint.as_dict() for name, endpoint in self._endpoints.items()}
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+
+    def prometheus(self):
+        """
+        Format the metrics in Prometheus text exposition format.
+
+        :rtype: str
+        """
+        endpoints = sorted(self.snapshot().items())
+        lines = []
+        for metric, attribute, metric_type, help_text in self.PROMETHEUS_METRICS:
+            lines.append("# HELP {} {}".format(metric, help_text))
+            lines.append("# TYPE {} {}".format(metric, metric_type))
+            for name, values in endpoints:
+                lines.append('{}{{endpoint="{}"}} {}'.format(metric, name, values[attribute]))
+        return "\n".join(lines) + "\n"
+
+    def wrap(self, fn, query_budget=None):
+        """
+        Decorate an API view function to record its metrics, by function name, when enabled.
+        Queries of the default database are counted.
+
+        :param fn: API view function.
+        :param query_budget: Maximum number of queries of a single call. Calls exceeding it are logged
+            and counted in `over_budget`.
+        :type query_budget: int | None
+        """
+        name = fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(request, *args, **kwargs):
+            if not self.enabled:
+                return fn(request, *args, **kwargs)
+
+            response = None
+            start = default_timer()
+            queries = []
+            try:
+                with _logged_queries(connections[DEFAULT_DB_ALIAS]) as queries:
+                    response = fn(request, *args, **kwargs)
+            finally:
+                elapsed = default_timer() - start
+                db_time = sum(float(query["time"]) for query in queries)
+                if response is None or response.streaming:
+                    size = 0
+                else:
+                    size = len(response.content)
+                error = response is None or response.status_code >= 400
+                over_budget = query_budget is not None and len(queries) > query_budget
+                if over_budget:
+                    logger.warning("%s made %i database queries, over its budget of %i",
+                                   name, len(queries), query_budget)
+                self.record(name, len(queries), db_time, elapsed, size, error, over_budget)
+            return response
+
+        return wrapper
+
+
+api_metrics = ApiMetrics()
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, print_function, absolute_import
+
+import base64
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.html import format_html_join
+from django.utils.lru_cache import lru_cache
+
+import pubcode
+
+__author__ = 'codez'
+
+__all__ = [
+    "BarcodeCache",
+    "IMAGE_FORMATS",
+    "barcode_cache",
+    "expected_width",
+    "render_image",
+]
+
+# Supported image formats and their content types.
+IMAGE_FORMATS = {
+    "png": "image/png",
+    "bmp": "image/bmp",
+    "svg": "image/svg+xml",
+}
+
+
+def expected_width(code):
+    """
+    Get the width of a barcode image of a code with given length, including quiet zone.
+    As the codes are rendered with charset B, the width depends only on the length of the code.
+
+    :param code: Code, or number of characters in the code.
+    :type code: str | int
+    :rtype: int
+    """
+    return _width_of_length(code if isinstance(code, int) else len(code))
+
+
+@lru_cache(maxsize=None)
+def _width_of_length(length):
+    return pubcode.Code128("A" * length, charset="B").width(add_quiet_zone=True)
+
+
+def _svg(barcode):
+    # Same layout as the bitmap images: one unit high, one unit per module, quiet zone included.
+    modules = [1] * barcode.quiet_zone + list(barcode.modules) + [1] * barcode.quiet_zone
+    bars = []
+    start = None
+    for i, module in enumerate(modules + [1]):
+        if module == 0 and start is None:
+            start = i
+        elif module != 0 and start is not None:
+            bars.append((start, i - start))
+            start = None
+    return (
+        u'<svg xmlns="http://www.w3.org/2000/svg" width="{0}" height="1" viewBox="0 0 {0} 1"'
+        u' preserveAspectRatio="none" shape-rendering="crispEdges">'
+        u'<rect width="{0}" height="1" fill="white"/>{1}</svg>'
+    ).format(
+        len(modules),
+        format_html_join(u"", u'<rect x="{}" width="{}" height="1"/>', bars),
+    ).encode("utf-8")
+
+
+def render_image(code, ext):
+    """
+    Render a barcode image file.
+
+    :param code: Code to render.
+    :type code: str
+    :param ext: Image format, one of `IMAGE_FORMATS`.
+    :type ext: str
+    :return: Tuple of image file content and image width.
+    :rtype: (bytes, int)
+    """
+    # Code the barcode entirely with charset B to make sure that the bacode is
+    # always the same width.
+    barcode = pubcode.Code128(code, charset='B')
+    width = barcode.width(add_quiet_zone=True)
+    if ext == "svg":
+        return _svg(barcode), width
+    if ext not in IMAGE_FORMATS:
+        raise ValueError("Unsupported image format: " + ext)
+    data_url = barcode.data_url(image_format=ext, add_quiet_zone=True)
+    return base64.b64decode(data_url.split(",", 1)[1]), width
+
+
+class BarcodeCache(object):
+    """
+    Cache of rendered barcode data urls and image files, stored in Django cache `settings.KIRPPU_BARCODE_CACHE`.
+
+    Use a cache backend shared between workers, such as a file based cache or memcached,
+    for the rendered images to be shared between workers and over restarts.
+    The cache hits and misses are counted per process, see `stats`.
+    """
+    PREFIX = "kirppu:barcode:"
+
+    def __init__(self):
+        self._hits = 0
+        self._misses = 0
+
+    @property
+    def cache(self):
+        return caches[settings.KIRPPU_BARCODE_CACHE]
+
+    @classmethod
+    def _key(cls, code, ext):
+        return "{}{}:{}".format(cls.PREFIX, ext, code)
+
+    @staticmethod
+    def render(code, ext):
+        """
+        Render a barcode data url without cache.
+
+        :return: Tuple of data url and image width.
+        :rtype: (str, int)
+        """
+        content, width = render_image(code, ext)
+        data_url = "data:{};base64,{}".format(IMAGE_FORMATS[ext], base64.b64encode(content).decode("ascii"))
+        return data_url, width
+
+    def get_image(self, code, ext, timeout=None):
+        """
+        Get a barcode image file.
+
+        :param code: Code to render.
+        :type code: str
+        :param ext: Image format, one of `IMAGE_FORMATS`.
+        :type ext: str
+        :param timeout: Seconds to keep a rendered image in the cache, None to keep it for ever.
+        :type timeout: int | None
+        :return: Image file content.
+        :rtype: bytes
+        """
+        cache = self.cache
+        key = self._key(code, "file." + ext)
+        content = cache.get(key)
+        if content is None:
+            content, width = render_image(code, ext)
+            # Same check as in get_many: price_tags.css relies on the width.
+            assert width == expected_width(code)
+            cache.set(key, content, timeout=timeout)
+            self._misses += 1
+        else:
+            self._hits += 1
+        return content
+
+    def get(self, code, ext, expect_width=None, cached=True):
+        """
+        Get data url of a barcode image.
+
+        :param code: Code to render.
+        :type code: str
+        :param ext: Image format, such as "png".
+        :type ext: str
+        :param expect_width: Width the image must have, or None to not check it.
+        :type expect_width: int | None
+        :param cached: Use the cache. Codes that are credentials, like clerk login codes,
+            must not be stored in a cache shared by workers.
+        :type cached: bool
+        :rtype: str
+        """
+        if not cached:
+            data_url, width = self.render(code, ext)
+            assert expect_width is None or width == expect_width
+            return data_url
+        return self.get_many([code], ext, expect_width)[0]
+
+    def get_many(self, codes, ext, expect_width=None):
+        """
+        Get data urls of several barcode images, reading and writing the cache once.
+        Rendered images are kept in the cache for ever, so do not use this for secret codes.
+
+        :param codes: Codes to render.
+        :type codes: list[str]
+        :param ext: Image format, such as "png".
+        :type ext: str
+        :param expect_width: Width the images must have, None to not check it,
+            or a callable returning the width for a code.
+        :type expect_width: int | None | callable
+        :return: Data urls in the order of `codes`.
+        :rtype: list[str]
+        """
+        cache = self.cache
+        keys = [self._key(code, ext) for code in codes]
+        found = cache.get_many(keys)
+
+        rendered = {}
+        result = []
+        for code, key in zip(codes, keys):
+            entry = found.get(key) or rendered.get(key)
+            if entry is None:
+                entry = rendered[key] = self.render(code, ext)
+
+            data_url, width = entry
+            # These measurements have to be exactly the same as the ones used in
+            # price_tags.css. If they are not the image might be distorted enough
+            # to not register on the scanner.
+            expected = expect_width(code) if callable(expect_width) else expect_width
+            assert expected is None or width == expected
+            result.append(data_url)
+
+        if rendered:
+            cache.set_many(rendered, timeout=None)
+        self._hits += len(found)
+        self._misses += len(rendered)
+        return result
+
+    def stats(self):
+        """
+        :return: Numbers of cache hits and misses of this process.
+        :rtype: dict
+        """
+        return {
+            "hits": self._hits,
+            "misses": self._misses,
+        }
+
+    def reset_stats(self):
+        self._hits = self._misses = 0
+
+
+barcode_cache = BarcodeCache()
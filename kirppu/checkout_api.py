@@ -8,9 +8,10 @@ from django.conf import settings
 from django.contrib.auth import get_user_model
 
 from django.core.exceptions import ValidationError
-from django.db import models, transaction, IntegrityError
-from django.db.models import Q, F, Count
+from django.db import transaction, IntegrityError
+from django.db.models import Q, F
 from django.http.response import (
+    Http404,
     HttpResponse,
     JsonResponse,
     StreamingHttpResponse,
@@ -40,15 +41,19 @@ from .models import (
     ReceiptExtraRow,
     Vendor,
     UserAdapter,
+    ItemStateBucket,
     ItemStateLog,
     Box,
     TemporaryAccessPermit,
     TemporaryAccessPermitLog,
+    VendorLedger,
 )
 from .fields import ItemPriceField
 from .forms import ItemRemoveForm
 
-from . import ajax_util, stats
+from . import ajax_util, search, stats
+from .api_metrics import api_metrics
+from .events import counter_channel, event_stream_response
 from .ajax_util import (
     AjaxError,
     AjaxFunc,
@@ -88,7 +93,8 @@ def _register_ajax_func(func):
     AJAX_FUNCTIONS[func.name] = func
 
 
-def ajax_func(url, method='POST', counter=True, clerk=True, overseer=False, atomic=False, staff_override=False):
+def ajax_func(url, method='POST', counter=True, clerk=True, overseer=False, atomic=False, staff_override=False,
+              query_budget=None):
     """
     Decorate a function with some common logic.
     The names of the function being decorated are required to be present in the JSON object
@@ -107,6 +113,10 @@ def ajax_func(url, method='POST', counter=True, clerk=True, overseer=False, atom
     :type overseer: bool
     :param atomic: Should this function run in atomic transaction? Default: False.
     :type atomic: bool
+    :param query_budget: Maximum number of database queries of a call, with cached checkout identities.
+        Checked when API metrics are recorded. Raise only with a reason; a growing count is a regression.
+        Default: None, no budget.
+    :type query_budget: int | None
     :return: Decorated function.
     """
 
@@ -131,7 +141,8 @@ def ajax_func(url, method='POST', counter=True, clerk=True, overseer=False, atom
         # Copy name etc from original function to wrapping function.
         # The wrapper must be the one referred from urlconf.
         fn = functools.wraps(func)(fn)
-        _register_ajax_func(AjaxFunc(fn, url, method, staff_override))
+        fn = api_metrics.wrap(fn, query_budget)
+        _register_ajax_func(AjaxFunc(fn, url, method, staff_override, query_budget))
 
         return fn
     return decorator
@@ -186,7 +197,7 @@ def item_mode_change(request, code, from_, to, message_if_not_first=None):
         _item_state_conflict(item)
 
 
-@ajax_func('^clerk/login$', clerk=False, counter=False)
+@ajax_func('^clerk/login$', clerk=False, counter=False, query_budget=6)
 def clerk_login(request, code, counter):
     try:
         counter_obj = Counter.objects.get(identifier=counter)
@@ -261,7 +272,7 @@ def counter_validate(request, code):
             "name": counter.name}
 
 
-@ajax_func('^item/find$', method='GET')
+@ajax_func('^item/find$', method='GET', query_budget=4)
 def item_find(request, code):
     item = _get_item_or_404(code)
     value = item.as_dict()
@@ -284,49 +295,58 @@ def item_find(request, code):
 
 
 @ajax_func('^item/search$', method='GET', overseer=True)
-def item_search(request, query, code, vendor, min_price, max_price, item_type, item_state):
-
-    clauses = []
-
-    types = item_type.split()
-    if types:
-        clauses.append(Q(itemtype__key__in=types))
-
-    code = code.strip()
-    if code:
-        clauses.append(Q(code__contains=code))
-
-    if vendor:
-        clauses.append(Q(vendor=vendor))
-
-    states = item_state.split()
-    if states:
-        clauses.append(Q(state__in=states))
-
-    for part in query.split():
-        p = Q(name__icontains=part)
-        if Item.is_item_barcode(part):
-            p |= Q(code=part)
-        clauses.append(p)
-
-    try:
-        clauses.append(Q(price__gte=float(min_price)))
-    except ValueError:
-        pass
+def item_search(request, query, code, vendor, min_price, max_price, item_type, item_state,
+                offset="0", limit=None):
+    """
+    Search items.
 
+    :return: Dict with found `items`, and `more` telling whether there are results after `offset` + `limit`.
+    """
     try:
-        clauses.append(Q(price__lte=float(max_price)))
+        offset = int(offset)
+        limit = int(limit) if limit else search.DEFAULT_LIMIT
     except ValueError:
-        pass
+        raise AjaxError(RET_BAD_REQUEST, "offset and limit must be numbers")
+
+    query = search.item_search_query(
+        query=query,
+        code=code,
+        vendor=vendor,
+        min_price=min_price,
+        max_price=max_price,
+        types=item_type.split(),
+        states=item_state.split(),
+    )
+    items, more = search.paginate(query, offset, limit)
 
     results = []
-
-    for item in Item.objects.filter(*clauses).all():
+    for item in items:
         item_dict = item.as_dict()
         item_dict['vendor'] = item.vendor.as_dict()
         results.append(item_dict)
 
-    return results
+    return {
+        "items": results,
+        "offset": offset,
+        "more": more,
+    }
+
+
+def _save_edited_item(request, item, price, state):
+    """
+    Save new price and state of an item, logging the state change and the price change in sales buckets.
+    """
+    if item.state != state:
+        # Removal from receipt may have changed the state already.
+        item.refresh_from_db(fields=["state"])
+    if item.state != state:
+        # Logged with the old price, which the item had in its old state.
+        ItemStateLog.objects.log_state(item=item, new_state=state, request=request)
+    old_price = item.price
+    item.price = price
+    item.state = state
+    ItemStateBucket.objects.record_price_change(item, old_price)
+    item.save()
 
 
 @ajax_func('^item/edit$', method='POST', overseer=True, atomic=True)
@@ -383,9 +403,7 @@ def item_edit(request, code, price, state):
                 )
             )
 
-    item.state = state
-    item.price = price
-    item.save()
+    _save_edited_item(request, item, price, state)
 
     item_dict = item.as_dict()
     item_dict['vendor'] = item.vendor.as_dict()
@@ -408,15 +426,9 @@ def vendor_returnable_items(request, vendor):
 
     # Shrink boxes to single representative items with box information.
     boxes = Box.objects \
+        .with_counts() \
         .exclude(item__state=Item.ADVERTISED) \
-        .filter(item__vendor__id=vendor) \
-        .annotate(
-            item_count=Count("item"),
-            returnable_count=Count(models.Case(models.When(item__state=Item.BROUGHT, then=1),
-                                               output_field=models.IntegerField())),
-            returned_count=Count(models.Case(models.When(item__state=Item.RETURNED, then=1),
-                                             output_field=models.IntegerField()))
-        )
+        .filter(representative_item__vendor__id=vendor)
     boxes = {b.representative_item_id: b for b in boxes}
 
     # Merge the two queries to a single response.
@@ -425,21 +437,30 @@ def vendor_returnable_items(request, vendor):
         box = boxes.get(i.pk)  # type: Box
         element = i.as_dict()
         if box is not None:
-            element.update(
-                box={
-                    "id": box.id,
-                    "description": box.description,
-                    "box_number": box.box_number,
-                    "item_count": box.item_count,
-                    "returnable_count": box.returnable_count,
-                    "returned_count": box.returned_count,
-                }
-            )
+            element.update(box=_box_info(box))
         r.append(element)
 
     return r
 
 
+def _box_info(box):
+    """
+    Box information of returnable box items.
+
+    :param box: Box from `Box.objects.with_counts()`.
+    :type box: Box
+    :rtype: dict
+    """
+    return {
+        "id": box.id,
+        "description": box.description,
+        "box_number": box.box_number,
+        "item_count": box.item_count,
+        "returnable_count": box.returnable_count,
+        "returned_count": box.returned_count,
+    }
+
+
 @ajax_func('^item/compensable', method='GET', atomic=True)
 def compensable_items(request, vendor):
     vendor = int(vendor)
@@ -474,21 +495,24 @@ def compensable_items(request, vendor):
 
 @ajax_func('^box/list$', method='GET')
 def box_list(request, vendor):
+    # Boxes are hidden as whole, so the representative item tells whether the box is hidden.
+    boxes = Box.objects \
+        .with_counts() \
+        .filter(representative_item__vendor__id=vendor, representative_item__hidden=False) \
+        .order_by("pk")
+
     out_boxes = []
-    boxes = Box.objects.filter(item__vendor__id=vendor, item__hidden=False).distinct()
     for box in boxes:
         data = box.as_dict()
-        items = box.get_items()
-        data["items_brought_total"] = items.filter(state__in=(Item.BROUGHT, Item.STAGED, Item.SOLD, Item.RETURNED))\
-            .count()
-        data["items_sold"] = items.filter(state=Item.SOLD).count()
-        data["items_compensated"] = items.filter(state=Item.COMPENSATED).count()
-        data["items_returnable"] = items.filter(state__in=(Item.BROUGHT, Item.STAGED)).count()
+        data["items_brought_total"] = box.items_brought_total
+        data["items_sold"] = box.items_sold
+        data["items_compensated"] = box.items_compensated
+        data["items_returnable"] = box.items_returnable
         out_boxes.append(data)
     return out_boxes
 
 
-@ajax_func('^item/checkin$', atomic=True)
+@ajax_func('^item/checkin$', atomic=True, query_budget=14)
 def item_checkin(request, code):
     item = _get_item_or_404(code)
     if not item.vendor.terms_accepted:
@@ -513,7 +537,7 @@ def item_checkin(request, code):
     return item_mode_change(request, code, Item.ADVERTISED, Item.BROUGHT)
 
 
-@ajax_func('^item/checkout$', atomic=True)
+@ajax_func('^item/checkout$', atomic=True, query_budget=13)
 def item_checkout(request, code, vendor=None):
     item = _get_item_or_404(code)
     if vendor == "":
@@ -531,29 +555,11 @@ def item_checkout(request, code, vendor=None):
         items = box.get_items().select_for_update().filter(state=Item.BROUGHT)
 
         ItemStateLog.objects.log_states(item_set=items, new_state=Item.RETURNED, request=request)
-        items.update(state=Item.RETURNED)
-
-        box_info = Box.objects \
-            .filter(pk=box.pk) \
-            .annotate(
-                item_count=Count("item"),
-                returnable_count=Count(models.Case(models.When(item__state=Item.BROUGHT, then=1),
-                                                   output_field=models.IntegerField())),
-                returned_count=Count(models.Case(models.When(item__state=Item.RETURNED, then=1),
-                                                 output_field=models.IntegerField()))
-            ) \
-            .values("item_count", "returnable_count", "returned_count")[0]
+        changed = items.update(state=Item.RETURNED)
 
         ret = box.representative_item.as_dict()
-        ret["box"] = {
-            "id": box.id,
-            "description": box.description,
-            "box_number": box.box_number,
-            "item_count": box_info["item_count"],
-            "returnable_count": box_info["returnable_count"],
-            "returned_count": box_info["returned_count"],
-            "changed": items.count(),
-        }
+        ret["box"] = _box_info(Box.objects.with_counts().get(pk=box.pk))
+        ret["box"]["changed"] = changed
         return ret
     else:
         return item_mode_change(request, code, (Item.BROUGHT, Item.ADVERTISED), Item.RETURNED,
@@ -569,8 +575,8 @@ def item_compensate_start(request, vendor):
     if not Vendor.objects.filter(pk=vendor_id).exists():
         raise AjaxError(RET_BAD_REQUEST)
 
-    clerk = Clerk.objects.get(pk=request.session["clerk"])
-    counter = Counter.objects.get(pk=request.session["counter"])
+    clerk = get_clerk(request)
+    counter = get_counter(request)
 
     receipt = Receipt()
     receipt.clerk = clerk
@@ -594,8 +600,7 @@ def item_compensate(request, code):
     item_dict = item_mode_change(request, code, Item.SOLD, Item.COMPENSATED)
 
     ReceiptItem.objects.create(item=item, receipt=receipt)
-    receipt.calculate_total()
-    receipt.save()
+    receipt.add_to_total(item.price)
 
     return item_dict
 
@@ -610,6 +615,9 @@ def item_compensate_end(request):
 
     provision = Provision(vendor_id=vendor_id, receipt=receipt)
     if provision.has_provision:
+        # Provisions are attributed to the vendor by receipt items, so a receipt without items does not count.
+        if ReceiptItem.objects.filter(receipt=receipt).exists():
+            VendorLedger.objects.add_provision(vendor_id, provision.provision)
         ReceiptExtraRow.objects.create(
             type=ReceiptExtraRow.TYPE_PROVISION,
             value=provision.provision,
@@ -655,32 +663,13 @@ def vendor_get(request, id=None, code=None):
 
 
 @ajax_func('^vendor/find$', method='GET')
-def vendor_find(request, q):
-    clauses = []
-    for part in q.split():
-        try:
-            clause = Q(id=int(part))
-        except ValueError:
-            clause = Q()
-
-        clause = clause | (
-            Q(user__username__icontains=part) |
-            Q(user__first_name__icontains=part) |
-            Q(user__last_name__icontains=part) |
-            Q(user__email__icontains=part)
-        )
-        clause = clause | (Q(person__isnull=False) & (
-            Q(person__first_name__icontains=part) |
-            Q(person__last_name__icontains=part) |
-            Q(person__email__icontains=part)
-        ))
-
-        clauses.append(clause)
-
-    return [
-        v.as_dict()
-        for v in Vendor.objects.filter(*clauses).all()
-    ]
+def vendor_find(request, q, limit=None):
+    try:
+        limit = int(limit) if limit else search.DEFAULT_LIMIT
+    except ValueError:
+        raise AjaxError(RET_BAD_REQUEST, "limit must be a number")
+    vendors, _more = search.paginate(search.vendor_search_query(q), 0, limit)
+    return [v.as_dict() for v in vendors]
 
 
 @ajax_func('^vendor/token/create$', method='POST', atomic=True)
@@ -725,7 +714,7 @@ def vendor_token_create(request, vendor_id):
         raise AjaxError(RET_CONFLICT, _("Gave up code generation."))
 
 
-@ajax_func('^receipt/start$', atomic=True)
+@ajax_func('^receipt/start$', atomic=True, query_budget=5)
 def receipt_start(request):
     if "receipt" in request.session:
         raise AjaxError(RET_CONFLICT, "There is already an active receipt on this counter!")
@@ -745,7 +734,7 @@ def receipt_start(request):
     return receipt.as_dict()
 
 
-@ajax_func('^item/reserve$', atomic=True)
+@ajax_func('^item/reserve$', atomic=True, query_budget=14)
 def item_reserve(request, code):
     item = _get_item_or_404(code)
     receipt_id = request.session["receipt"]
@@ -758,9 +747,7 @@ def item_reserve(request, code):
         item.save()
 
         ReceiptItem.objects.create(item=item, receipt=receipt)
-        # receipt.items.create(item=item)
-        receipt.calculate_total()
-        receipt.save()
+        receipt.add_to_total(item.price)
 
         ret = item.as_dict()
         ret.update(total=receipt.total_cents)
@@ -772,7 +759,82 @@ def item_reserve(request, code):
         raise AjaxError(RET_CONFLICT)
 
 
-@ajax_func('^item/release$', atomic=True)
+def _reservation_messages(items):
+    """
+    Raise AjaxError naming the first item that cannot be reserved.
+
+    :return: Messages of reservable items by item pk, see `raise_if_item_not_available`.
+    :rtype: dict
+    """
+    messages = {}
+    for item in items:
+        try:
+            message = raise_if_item_not_available(item)
+        except AjaxError as e:
+            raise AjaxError(e.status, u"{0}: {1}".format(item.code, e.message))
+        if item.state not in (Item.ADVERTISED, Item.BROUGHT, Item.MISSING):
+            raise AjaxError(RET_CONFLICT, _(u"Item {0} is in unexpected state: {1}").format(
+                item.code, item.get_state_display()))
+        if message is not None:
+            messages[item.pk] = message
+    return messages
+
+
+@ajax_func('^item/reserve_many$', atomic=True)
+def item_reserve_many(request, codes):
+    """
+    Reserve several items to the active receipt at once. Either all given items are reserved or none.
+
+    :param codes: Whitespace separated list of item codes, in the order they were read.
+    :type codes: str
+    :return: Dict with reserved `items` in given order, and new receipt `total`.
+    """
+    codes = codes.split()
+    if not codes:
+        raise AjaxError(RET_BAD_REQUEST, "No codes given.")
+    if len(set(codes)) != len(codes):
+        raise AjaxError(RET_BAD_REQUEST, "Same code given more than once.")
+
+    # Locked before the items, so that the receipt cannot be ended while items are added to it.
+    receipt = get_receipt(request.session["receipt"], for_update=True)
+    if receipt.status != Receipt.PENDING:
+        raise AjaxError(RET_CONFLICT, _(u"Receipt is not pending: {0}").format(receipt.get_status_display()))
+
+    items = {
+        item.code: item
+        for item in Item.objects.select_for_update().filter(code__in=codes)
+    }
+    missing = [code for code in codes if code not in items]
+    if missing:
+        raise Http404(_(u"No item found matching '{0}'").format(missing[0]))
+    items = [items[code] for code in codes]
+
+    messages = _reservation_messages(items)
+
+    ItemStateLog.objects.log_states(items, Item.STAGED, request=request)
+    Item.objects.filter(pk__in=[item.pk for item in items]).update(state=Item.STAGED)
+    ReceiptItem.objects.bulk_create(
+        ReceiptItem(item=item, receipt=receipt)
+        for item in items
+    )
+
+    receipt.add_to_total(sum(item.price for item in items))
+
+    ret_items = []
+    for item in items:
+        item.state = Item.STAGED
+        data = item.as_dict()
+        if item.pk in messages:
+            data.update(_message=messages[item.pk])
+        ret_items.append(data)
+
+    return {
+        "items": ret_items,
+        "total": receipt.total_cents,
+    }
+
+
+@ajax_func('^item/release$', atomic=True, query_budget=21)
 def item_release(request, code):
     item = _get_item_or_404(code)
     receipt_id = request.session["receipt"]
@@ -784,7 +846,9 @@ def item_release(request, code):
         raise AjaxError(RET_CONFLICT, ", ".join(remove_form.errors))
 
     remove_form.save(request)
-    return remove_form.removal_entry.as_dict()
+    ret = remove_form.removal_entry.as_dict()
+    ret.update(total=remove_form.receipt.total_cents)
+    return ret
 
 
 def _get_active_receipt(request, id, allowed_states=(Receipt.PENDING,)):
@@ -800,7 +864,8 @@ def _get_active_receipt(request, id, allowed_states=(Receipt.PENDING,)):
         receipt_id = arg_id
         logger.warning("Active receipt is being read without it being in session: %i", receipt_id)
 
-    receipt = receipt = get_receipt(receipt_id)
+    # Locked, so that a concurrent item_reserve_many cannot add items to a receipt being ended.
+    receipt = get_receipt(receipt_id, for_update=True)
     if receipt.status not in allowed_states:
         if not in_session and receipt.status == Receipt.FINISHED:
             raise AjaxError(RET_CONFLICT, "Receipt {} was already ended at {}".format(receipt_id, receipt.end_time))
@@ -809,7 +874,7 @@ def _get_active_receipt(request, id, allowed_states=(Receipt.PENDING,)):
     return receipt, receipt_id
 
 
-@ajax_func('^receipt/finish$', atomic=True)
+@ajax_func('^receipt/finish$', atomic=True, query_budget=16)
 def receipt_finish(request, id):
     receipt, receipt_id = _get_active_receipt(request, id)
 
@@ -817,10 +882,9 @@ def receipt_finish(request, id):
     receipt.status = Receipt.FINISHED
     receipt.save()
 
-    receipt_items = Item.objects.filter(receipt=receipt, receiptitem__action=ReceiptItem.ADD)
-    for item in receipt_items:
-        ItemStateLog.objects.log_state(item=item, new_state=Item.SOLD, request=request)
-    receipt_items.update(state=Item.SOLD)
+    receipt_items = list(Item.objects.filter(receipt=receipt, receiptitem__action=ReceiptItem.ADD))
+    ItemStateLog.objects.log_states(receipt_items, Item.SOLD, request=request)
+    Item.objects.filter(pk__in=[item.pk for item in receipt_items]).update(state=Item.SOLD)
 
     del request.session["receipt"]
     return receipt.as_dict()
@@ -832,15 +896,16 @@ def receipt_abort(request, id):
 
     # For all ADDed items, add REMOVE-entries and return the real Item's back to available.
     added_items = ReceiptItem.objects.filter(receipt_id=receipt_id, action=ReceiptItem.ADD)
-    for receipt_item in added_items.only("item"):
-        item = receipt_item.item
+    items = list(Item.objects.filter(receiptitem__in=added_items))
 
-        ReceiptItem(item=item, receipt=receipt, action=ReceiptItem.REMOVE).save()
+    ReceiptItem.objects.bulk_create(
+        ReceiptItem(item=item, receipt=receipt, action=ReceiptItem.REMOVE)
+        for item in items
+    )
 
-        if item.state != Item.BROUGHT:
-            ItemStateLog.objects.log_state(item=item, new_state=Item.BROUGHT, request=request)
-            item.state = Item.BROUGHT
-            item.save()
+    changed_items = [item for item in items if item.state != Item.BROUGHT]
+    ItemStateLog.objects.log_states(changed_items, Item.BROUGHT, request=request)
+    Item.objects.filter(pk__in=[item.pk for item in changed_items]).update(state=Item.BROUGHT)
 
     # Update ADDed items to be REMOVED_LATER. This must be done after the real Items have
     # been updated, and the REMOVE-entries added, as this will change the result set of
@@ -908,6 +973,18 @@ def receipt_pending(request):
     return list(map(lambda i: i.as_dict(), receipts))
 
 
+@ajax_func('^events/counter$', method='GET', overseer=True, staff_override=True)
+def events_counter(request, counter=None):
+    """
+    Server-Sent Events of receipt changes of a counter, the current counter by default.
+    """
+    if counter is None:
+        counter_id = get_counter(request).pk
+    else:
+        counter_id = get_object_or_404(Counter, identifier=counter).pk
+    return event_stream_response(request, counter_channel(counter_id))
+
+
 @ajax_func('^receipt/compensated', method='GET')
 def receipt_compensated(request, vendor):
     receipts = Receipt.objects.filter(
@@ -928,19 +1005,14 @@ def get_barcodes(request, codes=None):
     :return: List of barcode images encoded in data-url.
     :rtype: list[str]
     """
-    from .templatetags.kirppu_tags import barcode_dataurl
+    from .barcodes import barcode_cache, expected_width
     from json import loads
 
     codes = loads(codes)
     if isinstance(codes, string_types):
         codes = [codes]
 
-    # XXX: This does ignore the width assertion. Beware with style sheets...
-    outs = [
-        barcode_dataurl(code, "png", None)
-        for code in codes
-    ]
-    return outs
+    return barcode_cache.get_many(codes, "png", expected_width)
 
 
 @ajax_func('^item/abandon$')
@@ -988,6 +1060,6 @@ def stats_registration_data(request, prices="false"):
 @ajax_func('^stats/group_sales$', method='GET', staff_override=True)
 def stats_group_sales_data(request, type_id, prices="false"):
     item_type = ItemType.objects.get(id=int(type_id))
-    formatter = stats.SalesData(as_prices=prices == "true", extra_filter=dict(item__itemtype=item_type))
+    formatter = stats.SalesData(as_prices=prices == "true", extra_filter=dict(itemtype=item_type))
     log_generator = stats.iterate_logs(formatter)
     return StreamingHttpResponse(log_generator, content_type='text/csv')
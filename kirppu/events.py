@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, print_function, absolute_import
+
+import json
+import time
+from timeit import default_timer
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.http.response import StreamingHttpResponse
+
+__author__ = 'codez'
+
+__all__ = [
+    "EventBus",
+    "event_bus",
+    "counter_channel",
+    "event_stream_response",
+    "vendor_channel",
+]
+
+
+def vendor_channel(vendor_id):
+    return "vendor:{}".format(vendor_id)
+
+
+def counter_channel(counter_id):
+    return "counter:{}".format(counter_id)
+
+
+class EventBus(object):
+    """
+    Channels of numbered events, stored in Django cache `settings.KIRPPU_EVENT_CACHE`.
+
+    Each channel has a sequence number of its latest event, and each event is kept for
+    `settings.KIRPPU_EVENT_TIME` seconds. Readers remember the number of the last event they have seen
+    and read events after it, so any worker can serve any reader as long as the cache is shared.
+    """
+    PREFIX = "kirppu:events:"
+
+    # Most events returned by one read. Older ones are skipped if a reader is further behind.
+    MAX_READ = 100
+
+    @property
+    def cache(self):
+        return caches[settings.KIRPPU_EVENT_CACHE]
+
+    @classmethod
+    def _seq_key(cls, channel):
+        return "{}{}:seq".format(cls.PREFIX, channel)
+
+    @classmethod
+    def _event_key(cls, channel, number):
+        return "{}{}:{}".format(cls.PREFIX, channel, number)
+
+    def publish(self, channel, event_type, data):
+        """
+        Add an event to a channel.
+
+        :param channel: Channel name, from `vendor_channel` or `counter_channel`.
+        :param event_type: Type of the event, given to clients as SSE event name.
+        :type event_type: str
+        :param data: JSON serializable event data.
+        :return: Number of the event.
+        :rtype: int
+        """
+        cache = self.cache
+        seq_key = self._seq_key(channel)
+        cache.add(seq_key, 0, timeout=None)
+        try:
+            number = cache.incr(seq_key)
+        except ValueError:
+            # Evicted between add and incr.
+            cache.add(seq_key, 1, timeout=None)
+            number = cache.incr(seq_key)
+        cache.set(self._event_key(channel, number), (event_type, data), timeout=settings.KIRPPU_EVENT_TIME)
+        return number
+
+    def publish_on_commit(self, channel, event_type, data):
+        """
+        Publish an event when the current transaction commits, or immediately if there is no transaction.
+        """
+        transaction.on_commit(lambda: self.publish(channel, event_type, data))
+
+    def last(self, channel):
+        """
+        :return: Number of the latest event of the channel, zero if there are none.
+        :rtype: int
+        """
+        return self.cache.get(self._seq_key(channel), 0)
+
+    def read(self, channel, after):
+        """
+        Read events after a known event.
+
+        :param channel: Channel name.
+        :param after: Number of the last event already seen.
+        :type after: int
+        :return: List of event number, type and data, and the number to continue from.
+        :rtype: (list[(int, str, object)], int)
+        """
+        last = self.last(channel)
+        if after > last:
+            # Sequence has been evicted and restarted.
+            after = 0
+        if after == last:
+            return [], last
+
+        first = max(after + 1, last - self.MAX_READ + 1)
+        keys = [self._event_key(channel, number) for number in range(first, last + 1)]
+        found = self.cache.get_many(keys)
+        events = [
+            (number, found[key][0], found[key][1])
+            for number, key in zip(range(first, last + 1), keys)
+            if key in found
+        ]
+        return events, last
+
+    def stream(self, channel, after=None, duration=None, interval=None, sleep=time.sleep):
+        """
+        Server-Sent Events stream of a channel.
+
+        The stream ends after `duration` seconds; the EventSource of the client then reconnects
+        with the last event id it got, so a worker is not held by one client indefinitely.
+        With zero duration, the default, the stream ends after one read, and the client polls by reconnecting.
+
+        :param channel: Channel name.
+        :param after: Number of the last event already seen (Last-Event-ID), or None to get only new events.
+        :type after: int | None
+        :param duration: Seconds to stream. Default is `settings.KIRPPU_EVENT_STREAM_TIME`.
+        :param interval: Seconds between reads. Default is `settings.KIRPPU_EVENT_POLL_INTERVAL`.
+        :return: Generator of SSE text parts.
+        """
+        duration = settings.KIRPPU_EVENT_STREAM_TIME if duration is None else duration
+        interval = settings.KIRPPU_EVENT_POLL_INTERVAL if interval is None else interval
+        if after is None:
+            after = self.last(channel)
+
+        yield "retry: {}\n\n".format(int(interval * 1000) + 1000)
+        end = default_timer() + duration
+        while True:
+            events, after = self.read(channel, after)
+            if events:
+                yield "".join(
+                    "id: {}\nevent: {}\ndata: {}\n\n".format(number, event_type, json.dumps(data))
+                    for number, event_type, data in events
+                )
+            else:
+                # Keeps the connection alive, and lets the client resume from here after reconnecting.
+                yield "id: {}\n\n".format(after)
+            if default_timer() >= end:
+                return
+            sleep(interval)
+
+
+event_bus = EventBus()
+
+
+def event_stream_response(request, channel):
+    """
+    Streaming response of the events of a channel, continuing after the `Last-Event-ID` of the request.
+
+    :param request: Request of an EventSource.
+    :param channel: Channel name.
+    :rtype: StreamingHttpResponse
+    """
+    last_id = request.META.get("HTTP_LAST_EVENT_ID", "")
+    after = int(last_id) if last_id.isdigit() else None
+    response = StreamingHttpResponse(event_bus.stream(channel, after), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # Do not let nginx buffer the stream.
+    response["X-Accel-Buffering"] = "no"
+    return response
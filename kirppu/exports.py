@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, print_function, absolute_import
+
+from collections import namedtuple
+import csv
+import datetime
+import json
+import zlib
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.six import PY3, text_type
+
+from .models import Item, ItemStateLog, ReceiptItem
+
+__author__ = 'codez'
+
+__all__ = [
+    "EXPORTS",
+    "csv_lines",
+    "export_rows",
+    "gzip_stream",
+    "ndjson_lines",
+    "parse_time",
+]
+
+# Number of rows fetched with one query.
+CHUNK_SIZE = 2000
+
+Export = namedtuple("Export", "model columns fields time_field vendor_field")
+
+# Exported data sets. First field must be the primary key of the model, as the rows are fetched in its order.
+EXPORTS = {
+    "items": Export(
+        model=Item,
+        columns=("id", "code", "name", "price", "vendor_id", "state", "type", "itemtype_id", "adult",
+                 "abandoned", "hidden", "lost_property", "box_id"),
+        fields=("id", "code", "name", "price", "vendor_id", "state", "type", "itemtype_id", "adult",
+                "abandoned", "hidden", "lost_property", "box_id"),
+        time_field=None,
+        vendor_field="vendor_id",
+    ),
+    # One row per receipt item, with the receipt fields repeated.
+    "receipts": Export(
+        model=ReceiptItem,
+        columns=("id", "receipt_id", "receipt_type", "receipt_status", "receipt_total", "clerk_id", "counter_id",
+                 "start_time", "end_time", "item_code", "vendor_id", "price", "action", "add_time"),
+        fields=("id", "receipt_id", "receipt__type", "receipt__status", "receipt__total", "receipt__clerk_id",
+                "receipt__counter_id", "receipt__start_time", "receipt__end_time", "item__code",
+                "item__vendor_id", "item__price", "action", "add_time"),
+        time_field="receipt__start_time",
+        vendor_field="item__vendor_id",
+    ),
+    "logs": Export(
+        model=ItemStateLog,
+        columns=("id", "time", "item_code", "vendor_id", "old_state", "new_state", "clerk_id", "counter_id"),
+        fields=("id", "time", "item__code", "item__vendor_id", "old_state", "new_state", "clerk_id", "counter_id"),
+        time_field="time",
+        vendor_field="item__vendor_id",
+    ),
+}
+
+
+def parse_time(value):
+    """
+    Parse ISO date or date and time. Date means the start of the day in current time zone.
+
+    :type value: str
+    :rtype: datetime.datetime
+    :raises ValueError: If the value is not a date.
+    """
+    result = parse_datetime(value)
+    if result is None:
+        date = parse_date(value)
+        if date is None:
+            raise ValueError("Invalid date: {}".format(value))
+        result = datetime.datetime.combine(date, datetime.time())
+    if timezone.is_naive(result):
+        result = timezone.make_aware(result)
+    return result
+
+
+def export_rows(name, start=None, end=None, vendor=None, chunk_size=CHUNK_SIZE):
+    """
+    Iterate rows of an export in primary key order.
+
+    Rows are fetched `chunk_size` rows at a time, each chunk continuing from the last primary key of
+    the previous one, so memory use does not depend on the size of the table on any database backend.
+
+    :param name: Key of `EXPORTS`.
+    :param start: Include only rows at or after this time.
+    :type start: datetime.datetime | None
+    :param end: Include only rows before this time.
+    :type end: datetime.datetime | None
+    :param vendor: Include only rows of this vendor id.
+    :type vendor: int | None
+    :param chunk_size: Number of rows fetched with one query.
+    :return: Iterator of value tuples in the order of export columns.
+    :raises ValueError: If the export cannot be filtered by time.
+    """
+    export = EXPORTS[name]
+    query = export.model.objects.all()
+    if start is not None or end is not None:
+        if export.time_field is None:
+            raise ValueError("Export {} cannot be filtered by time.".format(name))
+        if start is not None:
+            query = query.filter(**{export.time_field + "__gte": start})
+        if end is not None:
+            query = query.filter(**{export.time_field + "__lt": end})
+    if vendor is not None:
+        query = query.filter(**{export.vendor_field: vendor})
+    return _iterate_chunks(query.order_by("pk").values_list(*export.fields), chunk_size)
+
+
+def _iterate_chunks(query, chunk_size):
+    last = None
+    while True:
+        chunk = query if last is None else query.filter(pk__gt=last)
+        rows = list(chunk[:chunk_size])
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            return
+        last = rows[-1][0]
+
+
+class _Echo(object):
+    """File-like object returning what is written, for streaming csv.writer output."""
+    def write(self, value):
+        return value
+
+
+def _csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, datetime.datetime):
+        value = value.isoformat()
+    value = text_type(value)
+    return value if PY3 else value.encode("utf-8")
+
+
+def csv_lines(columns, rows):
+    """
+    :param columns: Header row.
+    :param rows: Iterable of value sequences.
+    :return: Generator of CSV lines, header line first.
+    """
+    writer = csv.writer(_Echo())
+    yield writer.writerow([_csv_value(column) for column in columns])
+    for row in rows:
+        yield writer.writerow([_csv_value(value) for value in row])
+
+
+def ndjson_lines(columns, rows):
+    """
+    :param columns: Keys of the objects.
+    :param rows: Iterable of value sequences.
+    :return: Generator of lines of one JSON object each.
+    """
+    for row in rows:
+        yield json.dumps(dict(zip(columns, row)), cls=DjangoJSONEncoder, sort_keys=True) + "\n"
+
+
+def gzip_stream(parts, level=6):
+    """
+    Compress text parts into gzip format while they are iterated.
+
+    :param parts: Iterable of text.
+    :param level: Compression level.
+    :return: Generator of gzip data parts.
+    :rtype: collections.Iterable[bytes]
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for part in parts:
+        if isinstance(part, text_type):
+            part = part.encode("utf-8")
+        data = compressor.compress(part)
+        if data:
+            yield data
+    yield compressor.flush()
@@ -334,8 +334,7 @@ class ItemRemoveForm(forms.Form):
         removal_entry = ReceiptItem(item=self.item, receipt=self.receipt, action=ReceiptItem.REMOVE)
         removal_entry.save()
 
-        self.receipt.calculate_total()
-        self.receipt.save()
+        self.receipt.add_to_total(-self.item.price)
 
         if self.item.state != Item.BROUGHT:
             ItemStateLog.objects.log_state(item=self.item, new_state=Item.BROUGHT, request=request)
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, print_function, absolute_import
+
+import threading
+
+from django.conf import settings
+from django.db import connection
+from django.utils.crypto import salted_hmac
+from django.utils.six.moves import range
+
+from .models import Item, Sequence
+from .util import FeistelPermutation, b32_encode, pack
+
+__author__ = 'codez'
+
+__all__ = [
+    "ItemCodeAllocator",
+    "item_codes",
+]
+
+
+class ItemCodeAllocator(object):
+    """
+    Allocator of unique item codes.
+
+    Codes are numbers of Sequence `SEQUENCE` mapped through a permutation of the data bits keyed by
+    `settings.KIRPPU_ITEM_CODE_KEY`, so they are unique and cannot be guessed from each other.
+    Codes may still collide with existing codes that were not made from the sequence, like random codes
+    of older items or codes made with another key, so allocated codes are checked with one query per
+    `Item.BULK_BATCH_SIZE` codes, and codes already in use are skipped.
+
+    Each process reserves `settings.KIRPPU_ITEM_CODE_BLOCK` numbers at a time in a transaction of its
+    own. Inside a transaction the block is reserved with another database connection, so that the sequence
+    row is not locked until the current transaction ends, which would serialize all item registrations.
+    Numbers of a rolled back transaction are then left unused, which is harmless.
+    A database without row locks, like SQLite, locks all of it for the first writing transaction, and the
+    other connection would wait for the current transaction, so there missing numbers are allocated in the
+    current transaction instead.
+    """
+    SEQUENCE = "item_code"
+    CHECKSUM_BITS = 4
+
+    def __init__(self, code_bits=Item.CODE_BITS):
+        self._data_bits = code_bits - self.CHECKSUM_BITS
+        self._lock = threading.Lock()
+        self._next = 0
+        self._end = 0
+        self._permutation = None  # type: FeistelPermutation
+
+    @property
+    def permutation(self):
+        if self._permutation is None:
+            key = salted_hmac("kirppu.item_codes", "", secret=settings.KIRPPU_ITEM_CODE_KEY).digest()
+            self._permutation = FeistelPermutation(self._data_bits, key)
+        return self._permutation
+
+    def allocate(self, count):
+        """
+        :param count: Number of codes to allocate.
+        :type count: int
+        :return: List of new unique codes.
+        :rtype: list[str]
+        """
+        codes = []
+        used = set()
+        while len(codes) < count:
+            new = [self.code(number) for number in self._numbers(count - len(codes))]
+            for i in range(0, len(new), Item.BULK_BATCH_SIZE):
+                used.update(
+                    Item.objects.filter(code__in=new[i:i + Item.BULK_BATCH_SIZE]).values_list("code", flat=True))
+            for code in new:
+                if code not in used:
+                    used.add(code)
+                    codes.append(code)
+        return codes
+
+    def code(self, number):
+        """
+        Code of a sequence number.
+
+        :param number: Sequence number, at least one.
+        :type number: int
+        :rtype: str
+        :raises OverflowError: If the number is too large for the code.
+        """
+        value = self.permutation(number)
+        while value == 0:
+            # Zero is not a valid code. Walking the cycle of the permutation keeps the mapping one-to-one.
+            value = self.permutation(value)
+        return b32_encode(pack([(self._data_bits, value)], checksum_bits=self.CHECKSUM_BITS))
+
+    def _numbers(self, count):
+        numbers = []
+        with self._lock:
+            while len(numbers) < count:
+                if self._next >= self._end:
+                    size = max(count - len(numbers), settings.KIRPPU_ITEM_CODE_BLOCK)
+                    first = self._reserve(size)
+                    if first is None:
+                        break
+                    self._next = first
+                    self._end = first + size
+                take = min(count - len(numbers), self._end - self._next)
+                numbers.extend(range(self._next, self._next + take))
+                self._next += take
+
+        missing = count - len(numbers)
+        if missing:
+            first = Sequence.objects.allocate(self.SEQUENCE, missing)
+            numbers.extend(range(first, first + missing))
+        return numbers
+
+    def _reserve(self, size):
+        """
+        Reserve a block of numbers in a transaction of its own.
+
+        :param size: Number of numbers to reserve.
+        :type size: int
+        :return: First reserved number, or None if it cannot be reserved outside the current transaction.
+        :rtype: int | None
+        """
+        if not connection.in_atomic_block:
+            return Sequence.objects.allocate(self.SEQUENCE, size)
+        if not connection.features.has_select_for_update:
+            return None
+
+        # Database connections are per thread, so a thread of its own gets a connection in autocommit mode.
+        result = []
+
+        def reserve():
+            try:
+                result.append(Sequence.objects.allocate(self.SEQUENCE, size))
+            except Exception as e:
+                result.append(e)
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=reserve, name="kirppu-item-codes")
+        thread.start()
+        thread.join()
+        if isinstance(result[0], Exception):
+            raise result[0]
+        return result[0]
+
+
+item_codes = ItemCodeAllocator()
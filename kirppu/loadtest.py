@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, print_function, absolute_import
+
+from collections import Counter as Tally, namedtuple
+from decimal import Decimal
+import json
+import random
+import threading
+from timeit import default_timer
+
+from django.contrib.auth import get_user_model
+from django.db import DatabaseError, connections
+from django.test import Client
+from django.urls import reverse
+from django.utils.timezone import now
+
+from .checkout_api import AJAX_FUNCTIONS
+from .models import Box, Clerk, Counter, Item, ItemType, Vendor
+
+__author__ = 'codez'
+
+__all__ = [
+    "LoadTest",
+    "LoadTestResult",
+    "SimulatedCounter",
+    "percentile",
+    "seed",
+]
+
+# Statuses that mean another counter got to the resource first.
+CONFLICT_STATUSES = (409, 423)
+
+Dataset = namedtuple("Dataset", "stations vendors")
+Station = namedtuple("Station", "counter clerk_code")
+VendorData = namedtuple("VendorData", "id items boxes")
+
+
+def percentile(values, pct):
+    """
+    Nearest-rank percentile.
+
+    >>> percentile([4, 1, 3, 2], 50)
+    2
+    >>> percentile([4, 1, 3, 2], 99)
+    4
+    >>> percentile([], 50) is None
+    True
+
+    :param values: Values to find the percentile of.
+    :type values: list
+    :param pct: Percentile, 0-100.
+    :type pct: int | float
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(-(-len(ordered) * pct // 100)) - 1))
+    return ordered[rank]
+
+
+def seed(prefix, vendors=20, items=50, boxes=2, box_size=10, stations=4, rng=None):
+    """
+    Create an event dataset for load testing: vendors with items and boxes, counters, and clerks.
+    Everything created is named with `prefix`.
+
+    :param prefix: Prefix of user names, item names and counter identifiers.
+    :type prefix: str
+    :param vendors: Number of vendors.
+    :param items: Number of single items per vendor.
+    :param boxes: Number of boxes per vendor.
+    :param box_size: Number of items in each box.
+    :param stations: Number of counters, each with its own clerk.
+    :param rng: Random source of item prices.
+    :type rng: random.Random | None
+    :rtype: Dataset
+    """
+    rng = rng or random.Random()
+    user_model = get_user_model()
+
+    item_type = ItemType.objects.order_by("order").first()
+    if item_type is None:
+        item_type = ItemType.objects.create(key=prefix[:24], order=0, title=prefix)
+
+    vendor_data = []
+    for i in range(vendors):
+        user = user_model.objects.create(username="{}_vendor_{}".format(prefix, i))
+        vendor = Vendor.objects.create(user=user, terms_accepted=now())
+        new_items = Item.new_many([
+            dict(
+                name="{} item {}".format(prefix, n),
+                price=Decimal(rng.randint(2, 80)) / 2,
+                vendor=vendor,
+                itemtype=item_type,
+            )
+            for n in range(items)
+        ])
+        new_boxes = [
+            Box.new(
+                name="{} box item".format(prefix),
+                description="{} box {}".format(prefix, n),
+                price="1.50",
+                count=box_size,
+                bundle_size=1,
+                vendor=vendor,
+                itemtype=item_type,
+            )
+            for n in range(boxes)
+        ]
+        vendor_data.append(VendorData(
+            vendor.id,
+            [item.code for item in new_items],
+            [box.representative_item.code for box in new_boxes],
+        ))
+
+    station_data = []
+    for i, clerk in enumerate(Clerk.generate_empty_clerks(stations)):
+        clerk.user = user_model.objects.create(username="{}_clerk_{}".format(prefix, i))
+        clerk.save()
+        counter = Counter.objects.create(identifier="{}_{}".format(prefix, i)[:32], name="{} {}".format(prefix, i))
+        station_data.append(Station(counter.identifier, clerk.get_code()))
+
+    return Dataset(station_data, vendor_data)
+
+
+class LoadTestResult(object):
+    """
+    Latencies and statuses of API calls by function name.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.statuses = {}
+        self.elapsed = 0.0
+
+    def add(self, name, seconds, status):
+        with self._lock:
+            self.latencies.setdefault(name, []).append(seconds)
+            self.statuses.setdefault(name, Tally())[status] += 1
+
+    def summary(self):
+        """
+        :return: Rows of function name, calls, calls per second, conflicts, other errors,
+            and p50, p95 and p99 latencies in milliseconds.
+        :rtype: list[tuple]
+        """
+        rows = []
+        for name in sorted(self.latencies):
+            latencies = self.latencies[name]
+            statuses = self.statuses[name]
+            conflicts = sum(statuses[status] for status in CONFLICT_STATUSES + ("locked",))
+            errors = sum(count for status, count in statuses.items() if status not in (200, 202)) - conflicts
+            rows.append((
+                name,
+                len(latencies),
+                len(latencies) / self.elapsed if self.elapsed else 0.0,
+                conflicts,
+                errors,
+            ) + tuple(1000 * percentile(latencies, pct) for pct in (50, 95, 99)))
+        return rows
+
+    def report(self):
+        """
+        :return: The summary as text table.
+        :rtype: str
+        """
+        lines = ["{:<24} {:>7} {:>8} {:>9} {:>7} {:>8} {:>8} {:>8}".format(
+            "function", "calls", "calls/s", "conflicts", "errors", "p50 ms", "p95 ms", "p99 ms")]
+        for row in self.summary():
+            lines.append("{:<24} {:>7} {:>8.1f} {:>9} {:>7} {:>8.1f} {:>8.1f} {:>8.1f}".format(*row))
+        lines.append("Total time {:.2f} s".format(self.elapsed))
+        return "\n".join(lines)
+
+
+class SimulatedCounter(object):
+    """
+    Checkout counter calling the checkout API through Django test client.
+    """
+    def __init__(self, station, result, host, rng):
+        self.station = station
+        self.result = result
+        self.rng = rng
+        self.client = Client(HTTP_HOST=host)
+
+    def call(self, name, **params):
+        """
+        Call API function and record its latency and status.
+
+        :return: Decoded response, or None if the call did not succeed.
+        """
+        func = AJAX_FUNCTIONS[name]
+        method = getattr(self.client, func.method.lower())
+        start = default_timer()
+        try:
+            response = method(reverse(func.view), params)
+            status = response.status_code
+        except DatabaseError as e:
+            response = None
+            status = "locked" if "lock" in str(e).lower() else type(e).__name__
+        self.result.add(name, default_timer() - start, status)
+        if status not in (200, 202):
+            return None
+        return json.loads(response.content.decode("utf-8")) if response.content else {}
+
+    def login(self):
+        self.call("clerk_login", code=self.station.clerk_code, counter=self.station.counter)
+
+    def check_in(self, codes):
+        """
+        :return: Box numbers of checked in boxes.
+        :rtype: list[int]
+        """
+        box_numbers = []
+        for code in codes:
+            item = self.call("item_checkin", code=code)
+            if item is not None and "box" in item:
+                # Box was given a number, check in the whole box.
+                box_number = item["box"]["box_number"]
+                if self.call("box_checkin", code=code, box_info=box_number) is not None:
+                    box_numbers.append(box_number)
+        return box_numbers
+
+    def sell(self, receipts, box_numbers):
+        """
+        :return: Codes of sold single items.
+        :rtype: list[str]
+        """
+        sold = []
+        for codes in receipts:
+            receipt = self.call("receipt_start")
+            if receipt is None:
+                continue
+            reserved = [code for code in codes if self.call("item_reserve", code=code) is not None]
+            if box_numbers and self.rng.random() < 0.3:
+                # Boxes are shared between counters, which gives some competition for the same items.
+                self.call("box_item_reserve", box_number=self.rng.choice(box_numbers),
+                          box_item_count=self.rng.randint(1, 3))
+            if self.call("receipt_finish", id=receipt["id"]) is not None:
+                sold.extend(reserved)
+        return sold
+
+    def return_items(self, vendor, codes):
+        for code in codes:
+            self.call("item_checkout", code=code, vendor=vendor)
+
+    def compensate(self, vendor, codes):
+        if self.call("item_compensate_start", vendor=vendor) is None:
+            return
+        for code in codes:
+            self.call("item_compensate", code=code)
+        self.call("item_compensate_end")
+
+
+class LoadTest(object):
+    """
+    Simulate an event day on a seeded `Dataset`: every counter logs in, checks in items and boxes,
+    sells items in receipts, returns unsold items to vendors and compensates sold items.
+    The counters run concurrently, each in its own thread and database connection,
+    and all counters finish a phase before the next phase starts.
+    """
+    def __init__(self, dataset, host="localhost", sell_ratio=0.7, receipt_size=5, rng=None):
+        """
+        :param dataset: Data to run on, from `seed`.
+        :type dataset: Dataset
+        :param host: Host name used in requests. Must be allowed by ALLOWED_HOSTS.
+        :param sell_ratio: Fraction of single items to sell.
+        :param receipt_size: Maximum number of single items in a receipt.
+        :type rng: random.Random | None
+        """
+        self.dataset = dataset
+        self.sell_ratio = sell_ratio
+        self.receipt_size = receipt_size
+        self.rng = rng or random.Random()
+        self.result = LoadTestResult()
+        self.counters = [
+            SimulatedCounter(station, self.result, host, random.Random(self.rng.random()))
+            for station in dataset.stations
+        ]
+
+    def _parallel(self, work):
+        """
+        Run `work(counter, index)` for every counter concurrently.
+
+        :return: Return values in the order of counters.
+        """
+        results = [None] * len(self.counters)
+
+        def run(index):
+            try:
+                results[index] = work(self.counters[index], index)
+            finally:
+                if threading.current_thread() is not main:
+                    connections.close_all()
+
+        main = threading.current_thread()
+        if len(self.counters) == 1:
+            run(0)
+            return results
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(len(self.counters))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def _share(self, values, index):
+        return values[index::len(self.counters)]
+
+    def run(self):
+        """
+        :rtype: LoadTestResult
+        """
+        vendors = self.dataset.vendors
+        start = default_timer()
+
+        self._parallel(lambda counter, i: counter.login())
+
+        codes = [code for vendor in vendors for code in vendor.items + vendor.boxes]
+        self.rng.shuffle(codes)
+        box_numbers = sum(self._parallel(lambda counter, i: counter.check_in(self._share(codes, i))), [])
+
+        for_sale = [code for vendor in vendors for code in vendor.items]
+        self.rng.shuffle(for_sale)
+        for_sale = for_sale[:int(len(for_sale) * self.sell_ratio)]
+        receipts = []
+        while for_sale:
+            size = self.rng.randint(1, self.receipt_size)
+            receipts.append(for_sale[:size])
+            for_sale = for_sale[size:]
+        sold = set(sum(self._parallel(lambda counter, i: counter.sell(self._share(receipts, i), box_numbers)), []))
+
+        def return_and_compensate(counter, i):
+            for vendor in self._share(vendors, i):
+                counter.return_items(vendor.id, [code for code in vendor.items if code not in sold] + vendor.boxes)
+                counter.compensate(vendor.id, [code for code in vendor.items if code in sold])
+        self._parallel(return_and_compensate)
+
+        self.result.elapsed = default_timer() - start
+        return self.result
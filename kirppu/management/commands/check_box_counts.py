@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+
+from kirppu.models import BoxItemCounts
+
+__author__ = 'codez'
+
+
+class Command(BaseCommand):
+    help = "Compare box item counts to values calculated from items."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--fix", action="store_true", help="Replace wrong counts with calculated ones.")
+
+    def handle(self, *args, **options):
+        differences = BoxItemCounts.objects.verify(fix=options["fix"])
+        for box_id, field, stored, calculated in differences:
+            self.stdout.write("Box {}: {} is {}, calculated {}".format(box_id, field, stored, calculated))
+
+        if not differences:
+            self.stdout.write("All box counts are consistent.")
+        elif options["fix"]:
+            self.stdout.write("Fixed {} values.".format(len(differences)))
+        else:
+            raise CommandError("{} values differ. Run with --fix to correct them.".format(len(differences)))
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+
+from kirppu.models import VendorLedger
+
+__author__ = 'codez'
+
+
+class Command(BaseCommand):
+    help = "Compare vendor ledgers to values calculated from items and receipts."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--fix", action="store_true", help="Replace wrong ledger values with calculated ones.")
+
+    def handle(self, *args, **options):
+        differences = VendorLedger.objects.verify(fix=options["fix"])
+        for vendor_id, field, ledger_value, calculated in differences:
+            self.stdout.write("Vendor {}: {} is {}, calculated {}".format(vendor_id, field, ledger_value, calculated))
+
+        if not differences:
+            self.stdout.write("All ledgers are consistent.")
+        elif options["fix"]:
+            self.stdout.write("Fixed {} values.".format(len(differences)))
+        else:
+            raise CommandError("{} values differ. Run with --fix to correct them.".format(len(differences)))
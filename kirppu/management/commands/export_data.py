@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import io
+
+from django.core.management.base import BaseCommand, CommandError
+
+from kirppu import exports
+
+__author__ = 'codez'
+
+
+class Command(BaseCommand):
+    help = "Export items, receipt items or item state logs as CSV or NDJSON."
+
+    def add_arguments(self, parser):
+        parser.add_argument("export", choices=sorted(exports.EXPORTS), help="Data to export.")
+        parser.add_argument("--format", choices=("csv", "ndjson"), default="csv", help="Output format. Default: csv")
+        parser.add_argument("--output", "-o", default=None, help="Output file. Default: standard output.")
+        parser.add_argument("--gzip", action="store_true", default=False, help="Compress the output file.")
+        parser.add_argument("--start", default=None, help="Export rows at or after this ISO date or time.")
+        parser.add_argument("--end", default=None, help="Export rows before this ISO date or time.")
+        parser.add_argument("--vendor", type=int, default=None, help="Export rows of this vendor id.")
+        parser.add_argument("--chunk-size", type=int, default=exports.CHUNK_SIZE,
+                            help="Rows fetched with one query. Default: %(default)s")
+
+    def handle(self, *args, **options):
+        if options["gzip"] and options["output"] is None:
+            raise CommandError("--gzip needs --output.")
+        try:
+            start = exports.parse_time(options["start"]) if options["start"] else None
+            end = exports.parse_time(options["end"]) if options["end"] else None
+            rows = exports.export_rows(options["export"], start=start, end=end, vendor=options["vendor"],
+                                       chunk_size=options["chunk_size"])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        columns = exports.EXPORTS[options["export"]].columns
+        if options["format"] == "csv":
+            parts = exports.csv_lines(columns, rows)
+        else:
+            parts = exports.ndjson_lines(columns, rows)
+
+        if options["output"] is None:
+            for part in parts:
+                self.stdout.write(part, ending="")
+        elif options["gzip"]:
+            with io.open(options["output"], "wb") as output:
+                for part in exports.gzip_stream(parts):
+                    output.write(part)
+        else:
+            with io.open(options["output"], "w", encoding="utf-8", newline="") as output:
+                for part in parts:
+                    output.write(part)
@@ -1,53 +1,51 @@
-from collections import defaultdict
 from decimal import Decimal
+import shutil
 import sys
 import re
+import tempfile
 
-from django.core.exceptions import ObjectDoesNotExist
 from django.db import transaction
 from django.utils.dateparse import parse_datetime
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
-try:
-    from typing import Dict, List
-except ImportError:
-    class _AbstractType(object):
-        def __getitem__(self, item): pass
-    Dict = _AbstractType()
-    List = _AbstractType()
-
-from kirppu.models import Item, Vendor
+from kirppu.models import Item, ItemType, Vendor
 from kirppuauth.models import User
 
 
 # noinspection SpellCheckingInspection,PyPep8Naming
 class PostgreDumpParser(object):
-    def __init__(self, file_name):
-        self._file_name = file_name
-        self._data = defaultdict(list)  # type: Dict[str, List[Dict[str, str]]]
-
-    @property
-    def data(self):
-        return self._data
-
-    def parse(self, handle=None):
-        with (handle or open(self._file_name, "r")) as stream:
-            current_line_data = None
-            for line in stream:
-                if line.endswith("\n"):
-                    line = line[:-1]
-                if current_line_data is not None:
-                    if line == "\\.":
-                        current_line_data = None
-                        continue
-                    if self.parse_STDIN(line, *current_line_data):
-                        continue
-
-                if line.strip() == "":
-                    continue
-
-                if line.startswith("COPY "):
-                    current_line_data = self.parse_COPY(line)
+    """
+    Streaming parser of `COPY` blocks of a PostgreSQL dump.
+
+    Rows of a block are read from the stream only while they are iterated, and rows not iterated
+    are skipped when the next block is requested, so a dump of any size is parsed in constant memory.
+    """
+    def __init__(self, handle):
+        self._handle = handle
+
+    def blocks(self):
+        """
+        Iterate `COPY` blocks of the dump.
+
+        :return: Generator of table name and iterator of its rows, each row being a dict of column names
+            and unconverted values. The rows must be iterated before requesting the next block.
+        """
+        for line in self._handle:
+            if line.startswith("COPY "):
+                table, columns = self.parse_COPY(line.rstrip("\n"))
+                rows = self._rows(columns)
+                yield table, rows
+                # Skip rows the caller did not use.
+                for _ in rows:
+                    pass
+
+    def _rows(self, columns):
+        for line in self._handle:
+            if line.endswith("\n"):
+                line = line[:-1]
+            if line == "\\.":
+                return
+            yield self.parse_STDIN(line, columns)
 
     @staticmethod
     def parse_COPY(line):
@@ -59,16 +57,12 @@ class PostgreDumpParser(object):
         columns = m.group("columns").split(", ")
         return table, columns
 
-    def parse_STDIN(self, line, table, columns):
+    @staticmethod
+    def parse_STDIN(line, columns):
         parts = line.split("\t")
         assert len(parts) == len(columns), "Sizes differ: {} != {}: {}".format(len(parts), len(columns), line)
 
-        data = {
-            column: value
-            for column, value in zip(columns, parts)
-        }
-
-        self._data[table].append(data)
+        return dict(zip(columns, parts))
 
 
 class TypeConverter(object):
@@ -126,77 +120,128 @@ UserColumnTypes = {
 
 VendorColumnTypes = {
     "terms_accepted": "datetime",
+    "user_id": "int",
     "id": "int",
 }
 
+TableColumnTypes = {
+    "kirppu_item": ItemColumnTypes,
+    "kirppuauth_user": UserColumnTypes,
+    "kirppu_vendor": VendorColumnTypes,
+}
 
-# noinspection SpellCheckingInspection
-class DbConverter(object):
-    def __init__(self, table_name):
-        self._table_name = table_name
-        self._result = []
-
-    def parse(self, data):
-        p = getattr(self, "_parse_" + self._table_name)
-        return [
-            p(row)
-            for row in data
-        ]
 
-    @staticmethod
-    def _parse_kirppu_item(row):
-        attrs = {
-            col: getattr(TypeConverter, ItemColumnTypes[col])(row[col])
-            for col in [
-                "hidden",
-                "lost_property",
-                "box_id",
-                "vendor_id",
-                "code",
-                "abandoned",
-                "type",
-                "price",
-                "printed",
-                "adult",
-                "itemtype",
-                "name",
-            ]
-        }
-        r = Item(**attrs)
-        return r
+def typed_rows(table, rows):
+    """
+    Convert values of known columns of the table while the rows are iterated. Other columns are dropped.
 
-    @staticmethod
-    def _parse_kirppuauth_user(row):
-        attrs = {
-            col: getattr(TypeConverter, UserColumnTypes[col])(row[col])
-            for col in [
-                "password",
-                "last_login",
-                "is_superuser",
-                "username",
-                "first_name",
-                "last_name",
-                "email",
-                "is_staff",
-                "is_active",
-                "date_joined",
-                "phone",
-                "last_checked",
-            ]
+    :param table: Table name, key of `TableColumnTypes`.
+    :param rows: Rows from `PostgreDumpParser.blocks`.
+    :return: Generator of rows with converted values.
+    """
+    converters = [
+        (column, getattr(TypeConverter, type_name))
+        for column, type_name in TableColumnTypes[table].items()
+    ]
+    for row in rows:
+        yield {
+            column: converter(row[column])
+            for column, converter in converters
+            if column in row
         }
-        r = User(**attrs)
-        return r
 
-    @staticmethod
-    def _parse_kirppu_vendor(row):
-        attrs = {
-            col: getattr(TypeConverter, VendorColumnTypes[col])(row[col])
-            for col in [
-                "terms_accepted",
-            ]
-        }
-        r = Vendor(**attrs)
-        return r
+
+def _batches(iterable, size):
+    batch = []
+    for value in iterable:
+        batch.append(value)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# noinspection SpellCheckingInspection
+class DbImporter(object):
+    """
+    Import users, vendors and items from dump blocks. Users and vendors must be imported before items.
+    """
+    USER_FIELDS = ("password", "last_login", "is_superuser", "username", "first_name", "last_name", "email",
+                   "is_staff", "is_active", "date_joined", "phone", "last_checked")
+    ITEM_FIELDS = ("hidden", "lost_property", "code", "abandoned", "type", "price", "printed", "adult", "name")
+
+    def __init__(self, batch_size=1000, progress=None):
+        """
+        :param batch_size: Number of items created with one query.
+        :param progress: Function called with table name and number of rows imported so far.
+        :type progress: callable | None
+        """
+        self.batch_size = batch_size
+        self._progress = progress or (lambda table, count: None)
+        self._users = {}  # Old user id -> User
+        self._vendors = {}  # Old vendor id -> new vendor id
+        self._item_types = dict(ItemType.objects.values_list("key", "id"))
+        self.counts = {}
+
+    def _count(self, table, count):
+        self.counts[table] = self.counts.get(table, 0) + count
+        self._progress(table, self.counts[table])
+
+    def import_kirppuauth_user(self, rows):
+        for batch in _batches(rows, self.batch_size):
+            existing = {
+                user.username: user
+                for user in User.objects.filter(username__in=[row["username"] for row in batch])
+            }
+            for row in batch:
+                user = existing.get(row["username"])
+                if user is None:
+                    user = User(**{field: row[field] for field in self.USER_FIELDS if field in row})
+                    user.save()
+                self._users[row["id"]] = user
+            self._count("kirppuauth_user", len(batch))
+
+    def import_kirppu_vendor(self, rows):
+        users = list(self._users.values())
+        for batch in _batches(rows, self.batch_size):
+            user_ids = [self._user_of(row, users).id for row in batch]
+            existing = dict(Vendor.objects.filter(user__in=user_ids).values_list("user_id", "id"))
+            for row, user_id in zip(batch, user_ids):
+                vendor_id = existing.get(user_id)
+                if vendor_id is None:
+                    vendor_id = Vendor.objects.create(user_id=user_id, terms_accepted=row.get("terms_accepted")).id
+                    existing[user_id] = vendor_id
+                self._vendors[row["id"]] = vendor_id
+            self._count("kirppu_vendor", len(batch))
+
+    def _user_of(self, vendor_row, users):
+        if vendor_row.get("user_id") is not None:
+            if vendor_row["user_id"] not in self._users:
+                raise CommandError("Vendor {} has unknown user {}.".format(vendor_row["id"], vendor_row["user_id"]))
+            return self._users[vendor_row["user_id"]]
+        if len(users) == 1:
+            # Pre-processed dump of a single vendor.
+            return users[0]
+        raise CommandError("Vendor {} has no user.".format(vendor_row["id"]))
+
+    def _item(self, row):
+        attrs = {field: row[field] for field in self.ITEM_FIELDS if row.get(field) is not None}
+        try:
+            attrs["vendor_id"] = self._vendors[row["vendor_id"]]
+        except KeyError:
+            raise CommandError("Item {} has unknown vendor {}.".format(row["id"], row["vendor_id"]))
+        # Ids of the old database mean nothing here, so item types are matched only by their key.
+        try:
+            attrs["itemtype_id"] = self._item_types[row["itemtype"]]
+        except KeyError:
+            raise CommandError("Item {} has unknown item type {}.".format(row["id"], row.get("itemtype")))
+        return Item(**attrs)
+
+    def import_kirppu_item(self, rows):
+        for batch in _batches((self._item(row) for row in rows), self.batch_size):
+            Item.store_many(batch, batch_size=self.batch_size)
+            self._count("kirppu_item", len(batch))
 
 
 class Command(BaseCommand):
@@ -205,55 +250,42 @@ class Command(BaseCommand):
     One part of Item-data pre-work: grep -P '^\d+\t[^\t]+\t[^\t]+\t[^\t]+\t\w\w\t\w+\t\w\t\w\t@@@\t.*$'
     """
 
+    # Tables in import order.
+    TABLES = ("kirppuauth_user", "kirppu_vendor", "kirppu_item")
+
     def add_arguments(self, parser):
         parser.add_argument("file", type=str, nargs="?")
+        parser.add_argument("--batch-size", type=int, default=1000,
+                            help="Number of items created with one query. Default: %(default)s")
+        parser.add_argument("--dry-run", action="store_true", default=False,
+                            help="Import in a transaction that is rolled back at the end.")
 
     def handle(self, *args, **options):
         f_name = options.get("file")
         if f_name is None:
-            parser = PostgreDumpParser("stdin")
-            parser.parse(sys.stdin)
+            # Tables are read in import order, one pass each, which needs a seekable file.
+            handle = tempfile.TemporaryFile("w+")
+            shutil.copyfileobj(sys.stdin, handle)
         else:
-            parser = PostgreDumpParser(f_name)
-            parser.parse()
-
-        results = {}
-        for table, data in parser.data.items():
-            converter = DbConverter(table)
-            results[table] = converter.parse(data)
-
-        user = results["kirppuauth_user"]
-        assert len(user) == 1
-        user = user[0]
-
-        vendor = results["kirppu_vendor"]
-        assert len(vendor) == 1
-        vendor = vendor[0]
-
-        items = results["kirppu_item"]
-        assert len(items) > 0
-
-        with transaction.atomic():
-            # Create the user if it doesn't exist. user is predefined for exception to use.
-            try:
-                user = User.objects.get(username=user.username)
-            except ObjectDoesNotExist:
-                user.save()
-
-            # Create vendor if it doesn't exist. vendor is predefined for exception to use.
-            try:
-                vendor = Vendor.objects.get(user=user)
-            except ObjectDoesNotExist:
-                vendor.user = user
-                vendor.save()
-
-            # TODO: Create boxes..
-
-            # Create items for the vendor.
-            for item in items:
-                item.vendor = vendor
-                item.save()
-
-        for table in results.keys():
-            # noinspection PyProtectedMember
-            print("\n".join("{} {}: {}".format(r._meta.object_name, r.pk, str(r)) for r in results[table]))
+            handle = open(f_name, "r")
+
+        verbosity = options["verbosity"]
+
+        def progress(table, count):
+            if verbosity >= 1:
+                self.stdout.write("{}: {}".format(table, count))
+
+        importer = DbImporter(batch_size=options["batch_size"], progress=progress)
+        with handle, transaction.atomic():
+            for table in self.TABLES:
+                handle.seek(0)
+                for block_table, rows in PostgreDumpParser(handle).blocks():
+                    if block_table == table:
+                        getattr(importer, "import_" + table)(typed_rows(table, rows))
+
+            if options["dry_run"]:
+                transaction.set_rollback(True)
+
+        for table in self.TABLES:
+            self.stdout.write("{} {}: {}".format(
+                "Would import" if options["dry_run"] else "Imported", table, importer.counts.get(table, 0)))
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import logging
+import random
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.crypto import get_random_string
+from django.utils.six.moves import input
+
+from kirppu.loadtest import LoadTest, seed
+
+__author__ = 'codez'
+
+
+class Command(BaseCommand):
+    help = "Seed an event dataset to the database and simulate an event day on it with concurrent counters, " \
+           "reporting throughput, latencies and lock conflicts of checkout API functions. " \
+           "Do not run against a production database."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--counters", type=int, default=4, help="Number of concurrent counters. Default: 4")
+        parser.add_argument("--vendors", type=int, default=20, help="Number of vendors. Default: 20")
+        parser.add_argument("--items", type=int, default=50, help="Single items per vendor. Default: 50")
+        parser.add_argument("--boxes", type=int, default=2, help="Boxes per vendor. Default: 2")
+        parser.add_argument("--box-size", type=int, default=10, help="Items per box. Default: 10")
+        parser.add_argument("--sell-ratio", type=float, default=0.7,
+                            help="Fraction of single items sold. Default: 0.7")
+        parser.add_argument("--receipt-size", type=int, default=5, help="Maximum items in a receipt. Default: 5")
+        parser.add_argument("--seed", type=int, default=None, help="Random seed, for repeatable runs.")
+        parser.add_argument("--host", default=None,
+                            help="Host name of requests. Default: first of ALLOWED_HOSTS, or localhost.")
+        parser.add_argument("--noinput", "--no-input", action="store_false", dest="interactive",
+                            help="Do not ask for confirmation before writing to the database.")
+
+    def handle(self, *args, **options):
+        if not settings.KIRPPU_CHECKOUT_ACTIVE:
+            raise CommandError("Checkout API is available only when KIRPPU_CHECKOUT_ACTIVE is set.")
+
+        if options["interactive"]:
+            answer = input("This writes test data to database {}. Continue? [y/N] ".format(
+                settings.DATABASES["default"]["NAME"]))
+            if answer.lower() != "y":
+                raise CommandError("Cancelled.")
+
+        host = options["host"]
+        if host is None:
+            hosts = [h.lstrip(".") for h in settings.ALLOWED_HOSTS if h != "*"]
+            host = hosts[0] if hosts else "localhost"
+
+        rng = random.Random(options["seed"])
+        prefix = "load_" + get_random_string(6).lower()
+
+        self.stdout.write("Seeding data with prefix {}...".format(prefix))
+        dataset = seed(
+            prefix,
+            vendors=options["vendors"],
+            items=options["items"],
+            boxes=options["boxes"],
+            box_size=options["box_size"],
+            stations=options["counters"],
+            rng=rng,
+        )
+
+        # Failed requests are reported in the summary. Do not log a traceback of each.
+        logging.getLogger("django.request").setLevel(logging.CRITICAL)
+
+        self.stdout.write("Running with {} counters...".format(options["counters"]))
+        result = LoadTest(
+            dataset,
+            host=host,
+            sell_ratio=options["sell_ratio"],
+            receipt_size=options["receipt_size"],
+            rng=rng,
+        ).run()
+        self.stdout.write(result.report())
@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from kirppu.models import ItemStateBucket
+
+__author__ = 'codez'
+
+
+class Command(BaseCommand):
+    help = "Re-create statistics buckets from the whole ItemStateLog. Needed once after upgrading to buckets."
+
+    def handle(self, *args, **options):
+        count = ItemStateBucket.objects.rebuild()
+        self.stdout.write("Created {} buckets.".format(count))
@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from kirppu.models import VendorSearchTerm
+
+__author__ = 'codez'
+
+
+class Command(BaseCommand):
+    help = "Re-create vendor search terms, e.g. after changing users outside of Django."
+
+    def handle(self, *args, **options):
+        count = VendorSearchTerm.objects.rebuild()
+        self.stdout.write("Indexed {} vendors.".format(count))
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+import io
+
+from django.core.management.base import BaseCommand
+
+from kirppu.settlement import settlement_rows, stream_csv, stream_json
+
+__author__ = 'codez'
+
+
+class Command(BaseCommand):
+    help = "Write settlement of all vendors: sold, compensated, unpaid and abandoned items, and provisions."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--format", choices=("csv", "json"), default="csv", help="Output format. Default: csv")
+        parser.add_argument("--output", "-o", default=None, help="Output file. Default: standard output.")
+
+    def handle(self, *args, **options):
+        stream = stream_csv if options["format"] == "csv" else stream_json
+        if options["output"] is None:
+            for part in stream(settlement_rows()):
+                self.stdout.write(part, ending="")
+        else:
+            with io.open(options["output"], "w", encoding="utf-8", newline="") as output:
+                for part in stream(settlement_rows()):
+                    output.write(part)
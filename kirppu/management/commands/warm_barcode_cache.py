@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from kirppu.barcodes import barcode_cache, expected_width
+from kirppu.models import Item
+
+__author__ = 'codez'
+
+
+class Command(BaseCommand):
+    help = "Render barcodes of all visible items to the barcode cache, and show cache hit statistics of the run."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--format", default="png", help="Image format to render. Default: png")
+
+    def handle(self, *args, **options):
+        codes = list(Item.objects.filter(hidden=False).values_list("code", flat=True))
+        batch = Item.BULK_BATCH_SIZE
+        for i in range(0, len(codes), batch):
+            barcode_cache.get_many(codes[i:i + batch], options["format"], expected_width)
+        self.stdout.write("Rendered {} barcodes.".format(len(codes)))
+
+        self.stdout.write("Cache hits: {hits}, misses: {misses}".format(**barcode_cache.stats()))
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 19:30
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kirppu', '0025_add_statistics_permission'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ItemStateBucket',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('time', models.DateTimeField()),
+                ('old_state', models.CharField(blank=True, choices=[('AD', 'Advertised'), ('BR', 'Brought to event'), ('ST', 'Staged for selling'), ('SO', 'Sold'), ('MI', 'Missing'), ('RE', 'Returned to vendor'), ('CO', 'Compensated to vendor')], max_length=2)),
+                ('new_state', models.CharField(choices=[('AD', 'Advertised'), ('BR', 'Brought to event'), ('ST', 'Staged for selling'), ('SO', 'Sold'), ('MI', 'Missing'), ('RE', 'Returned to vendor'), ('CO', 'Compensated to vendor')], max_length=2)),
+                ('count', models.IntegerField(default=0)),
+                ('price', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('itemtype', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='kirppu.ItemType')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='itemstatebucket',
+            unique_together=set([('time', 'itemtype', 'old_state', 'new_state')]),
+        ),
+    ]
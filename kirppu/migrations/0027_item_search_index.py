@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+
+from django.db import migrations, transaction, DatabaseError
+
+logger = logging.getLogger(__name__)
+
+# Trigram indexes for the case insensitive (name) and sensitive (code) contains-searches of item search.
+# Django implements icontains on PostgreSQL with UPPER(), so the index must be on the same expression.
+INDEXES = (
+    ("kirppu_item_name_trgm", 'UPPER("name"::text) gin_trgm_ops'),
+    ("kirppu_item_code_trgm", '"code" gin_trgm_ops'),
+)
+
+
+def create_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    try:
+        with transaction.atomic():
+            schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    except DatabaseError as e:
+        logger.warning("pg_trgm extension is not available, item search is not indexed: %s", e)
+        return
+    for name, expression in INDEXES:
+        schema_editor.execute('CREATE INDEX IF NOT EXISTS {} ON "kirppu_item" USING gin ({})'.format(
+            name, expression))
+
+
+def drop_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    for name, _ in INDEXES:
+        schema_editor.execute("DROP INDEX IF EXISTS {}".format(name))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kirppu', '0026_itemstatebucket'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
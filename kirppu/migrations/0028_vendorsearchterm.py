@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 19:42
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# noinspection PyPep8Naming
+def index_vendors(apps, schema_editor):
+    # Same as VendorSearchTermManager.terms_of, which cannot be used with historical models.
+    db_alias = schema_editor.connection.alias
+    Vendor = apps.get_model("kirppu", "Vendor")
+    VendorSearchTerm = apps.get_model("kirppu", "VendorSearchTerm")
+
+    terms = []
+    for vendor in Vendor.objects.using(db_alias).select_related("user", "person"):
+        user = vendor.user
+        values = [user.username, user.first_name, user.last_name, user.email]
+        if vendor.person is not None:
+            person = vendor.person
+            values.extend((person.first_name, person.last_name, person.email))
+        words = set()
+        for value in values:
+            words.update(word[:254] for word in (value or "").lower().split())
+        terms.extend(VendorSearchTerm(vendor=vendor, term=word) for word in words)
+    VendorSearchTerm.objects.using(db_alias).bulk_create(terms, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kirppu', '0027_item_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VendorSearchTerm',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(db_index=True, max_length=254)),
+                ('vendor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='kirppu.Vendor')),
+            ],
+        ),
+        migrations.RunPython(
+            code=index_vendors,
+            reverse_code=migrations.RunPython.noop,
+        ),
+    ]
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 19:50
+from __future__ import unicode_literals
+
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+import django.db.models.deletion
+
+
+# noinspection PyPep8Naming
+def create_ledgers(apps, schema_editor):
+    # Same as VendorLedgerManager.calculate, for all vendors at once.
+    db_alias = schema_editor.connection.alias
+    Item = apps.get_model("kirppu", "Item")
+    ReceiptExtraRow = apps.get_model("kirppu", "ReceiptExtraRow")
+    VendorLedger = apps.get_model("kirppu", "VendorLedger")
+
+    ledgers = {}
+
+    def ledger(vendor_id):
+        if vendor_id not in ledgers:
+            ledgers[vendor_id] = VendorLedger(vendor_id=vendor_id)
+        return ledgers[vendor_id]
+
+    for state, count_field, sum_field in (("SO", "sold_count", "sold_sum"),
+                                          ("CO", "compensated_count", "compensated_sum")):
+        rows = Item.objects.using(db_alias) \
+            .filter(state=state) \
+            .values("vendor") \
+            .annotate(item_count=Count("id"), price_sum=Sum("price")) \
+            .order_by()
+        for row in rows:
+            setattr(ledger(row["vendor"]), count_field, row["item_count"])
+            setattr(ledger(row["vendor"]), sum_field, row["price_sum"])
+
+    extras = ReceiptExtraRow.objects.using(db_alias) \
+        .filter(type="PRO", receipt__type="COMPENSATION") \
+        .values_list("id", "value", "receipt__receiptitem__item__vendor") \
+        .distinct()
+    for _, value, vendor_id in set(extras):
+        if vendor_id is not None:
+            entry = ledger(vendor_id)
+            entry.provisions = Decimal(entry.provisions) + value
+
+    VendorLedger.objects.using(db_alias).bulk_create(ledgers.values(), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kirppu', '0028_vendorsearchterm'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VendorLedger',
+            fields=[
+                ('vendor', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='kirppu.Vendor')),
+                ('sold_count', models.IntegerField(default=0)),
+                ('sold_sum', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('compensated_count', models.IntegerField(default=0)),
+                ('compensated_sum', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('provisions', models.DecimalField(decimal_places=2, default=0, help_text='Sum of provisions in compensation receipts.', max_digits=12)),
+            ],
+        ),
+        migrations.RunPython(
+            code=create_ledgers,
+            reverse_code=migrations.RunPython.noop,
+        ),
+    ]
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 20:09
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count
+import django.db.models.deletion
+
+
+# noinspection PyPep8Naming
+def create_counts(apps, schema_editor):
+    # Same as BoxItemCountsManager.calculate, for all boxes at once.
+    db_alias = schema_editor.connection.alias
+    Item = apps.get_model("kirppu", "Item")
+    BoxItemCounts = apps.get_model("kirppu", "BoxItemCounts")
+
+    fields = {
+        "BR": "brought_count",
+        "ST": "staged_count",
+        "SO": "sold_count",
+        "RE": "returned_count",
+        "CO": "compensated_count",
+    }
+    counts = {}
+    rows = Item.objects.using(db_alias) \
+        .filter(box__isnull=False, state__in=fields.keys()) \
+        .values("box", "state") \
+        .annotate(item_count=Count("id")) \
+        .order_by()
+    for row in rows:
+        if row["box"] not in counts:
+            counts[row["box"]] = BoxItemCounts(box_id=row["box"])
+        setattr(counts[row["box"]], fields[row["state"]], row["item_count"])
+
+    BoxItemCounts.objects.using(db_alias).bulk_create(counts.values(), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kirppu', '0029_vendorledger'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BoxItemCounts',
+            fields=[
+                ('box', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='counts', serialize=False, to='kirppu.Box')),
+                ('brought_count', models.IntegerField(default=0)),
+                ('staged_count', models.IntegerField(default=0)),
+                ('sold_count', models.IntegerField(default=0)),
+                ('returned_count', models.IntegerField(default=0)),
+                ('compensated_count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(
+            code=create_counts,
+            reverse_code=migrations.RunPython.noop,
+        ),
+    ]
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 20:11
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+# noinspection PyPep8Naming
+def create_box_number_sequence(apps, schema_editor):
+    # Continue from the highest box number assigned so far, as Box.assign_box_number did.
+    db_alias = schema_editor.connection.alias
+    Box = apps.get_model("kirppu", "Box")
+    Sequence = apps.get_model("kirppu", "Sequence")
+
+    last_number = Box.objects.using(db_alias).aggregate(last_number=models.Max("box_number"))["last_number"]
+    Sequence.objects.using(db_alias).create(name="box_number", value=last_number or 0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kirppu', '0030_boxitemcounts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Sequence',
+            fields=[
+                ('name', models.CharField(max_length=32, primary_key=True, serialize=False)),
+                ('value', models.BigIntegerField(default=0, help_text='Last allocated number.')),
+            ],
+        ),
+        migrations.RunPython(
+            code=create_box_number_sequence,
+            reverse_code=migrations.RunPython.noop,
+        ),
+    ]
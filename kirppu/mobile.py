@@ -2,9 +2,11 @@
 from collections import OrderedDict
 from decimal import Decimal
 import textwrap
+import uuid
 
 from django.conf import settings
 from django.core import signing
+from django.core.cache import caches
 from django.db import transaction, models
 from django.db.models import Count
 from django.http import HttpResponseRedirect
@@ -12,10 +14,13 @@ from django.http.response import HttpResponseForbidden, HttpResponse
 from django.shortcuts import render
 from django.urls import reverse
 from django.utils import timezone
-from django.utils.translation import gettext_lazy as _
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
+from django.utils.translation import get_language, gettext_lazy as _
 from ipware.ip import get_ip
 from ratelimit.utils import is_ratelimited
 
+from .events import event_stream_response, vendor_channel
 from .models import Item, TemporaryAccessPermit, Vendor, TemporaryAccessPermitLog, Box
 from .templatetags.kirppu_tags import format_price
 from .util import first, shorten_text
@@ -164,6 +169,135 @@ def _data_view(request, permit):
         vendor.mobile_view_visited = True
         vendor.save(update_fields=("mobile_view_visited",))
 
+    snapshot = _vendor_status_snapshot(vendor)
+    as_text = request.GET.get("type") == "txt"
+    return _conditional_status_response(
+        request, snapshot, as_text, lambda: _render_status(request, vendor, snapshot, as_text))
+
+
+def _conditional_status_response(request, snapshot, as_text, make_response):
+    """
+    Respond with Not Modified if the client already has the status page of the snapshot.
+
+    :param snapshot: Status snapshot of the vendor, see `_vendor_status_snapshot`.
+    :param as_text: Is the text version of the page requested?
+    :type as_text: bool
+    :param make_response: Function returning the full response when it is needed.
+    :type make_response: callable
+    :rtype: HttpResponse
+    """
+    etag = quote_etag("{}-{}-{}".format(snapshot["version"], "txt" if as_text else "html", get_language()))
+    not_modified = get_conditional_response(request, etag=etag)
+    if not_modified is not None:
+        return not_modified
+
+    response = make_response()
+    response["ETag"] = etag
+    # Let browsers keep the page, but always ask whether it has changed.
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def _render_status(request, vendor, snapshot, as_text):
+    tables = OrderedDict()
+    for key, rows, total in snapshot["tables"]:
+        table = tables[key] = TableContents(spec=TABLES[key])
+        table.items = rows
+        table.sum = total
+    max_price_width = snapshot["price_width"]
+
+    if as_text:
+        sign_data = {}
+        total_items = 0
+        for key, table in tables.items():
+            if key == "registered":
+                continue
+            items = [_sign_data(i) for i in table.items]
+            total_items += len(items)
+            sign_data[key] = items
+            sign_data[key + "_s"] = str(table.sum)
+
+        if total_items > 0:
+            sign_data["vendor"] = vendor.id
+            signature = signing.dumps(sign_data, compress=True)
+            signature = "\n".join(textwrap.wrap(signature, 78, break_on_hyphens=False))
+        else:
+            signature = None
+
+        response = render(request, "kirppu/vendor_status.txt", {
+            "tables": tables,
+            "price_width": max_price_width,
+            "vendor": vendor.id,
+            "signature": signature,
+        }, content_type="text/plain; charset=utf-8")
+    else:
+        response = render(request, "kirppu/vendor_status.html", {
+            "tables": tables,
+            "CURRENCY": settings.KIRPPU_CURRENCY,
+            "vendor": vendor.id,
+        })
+    return response
+
+
+def _vendor_status_version_key(vendor_id):
+    return "kirppu:vendor_status:{}:version".format(vendor_id)
+
+
+def invalidate_vendor_status(vendor_ids):
+    """
+    Make cached status snapshots of the vendors invalid. Called when items of the vendors change.
+
+    The snapshots are invalidated immediately and again when the current transaction commits,
+    so that a snapshot made from data of before the commit is not used after it.
+
+    :param vendor_ids: Ids of the vendors.
+    :type vendor_ids: collections.Iterable[int]
+    """
+    keys = [_vendor_status_version_key(vendor_id) for vendor_id in set(vendor_ids)]
+    if not keys:
+        return
+
+    def invalidate():
+        caches[settings.KIRPPU_VENDOR_STATUS_CACHE].set_many(
+            {key: uuid.uuid4().hex for key in keys}, timeout=None)
+    invalidate()
+    transaction.on_commit(invalidate)
+
+
+def _vendor_status_snapshot(vendor):
+    """
+    Get status tables of the vendor from cache, or build and cache them.
+
+    :type vendor: Vendor
+    :return: Dict with version of the snapshot, rows and sum of each table, and maximum price width.
+    :rtype: dict
+    """
+    cache = caches[settings.KIRPPU_VENDOR_STATUS_CACHE]
+    version_key = _vendor_status_version_key(vendor.id)
+    snapshot_key = "kirppu:vendor_status:{}".format(vendor.id)
+    found = cache.get_many([version_key, snapshot_key])
+
+    version = found.get(version_key)
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(version_key, version, timeout=None):
+            version = cache.get(version_key, version)
+    snapshot = found.get(snapshot_key)
+    if snapshot is not None and snapshot["version"] == version:
+        return snapshot
+
+    # The version was read before the items, so a change during building makes this snapshot unused.
+    tables, max_price_width = _build_tables(vendor)
+    snapshot = {
+        "version": version,
+        "tables": [(key, table.items, table.sum) for key, table in tables.items()],
+        "price_width": max_price_width,
+    }
+    cache.set(snapshot_key, snapshot, timeout=settings.KIRPPU_VENDOR_STATUS_CACHE_TIME)
+    return snapshot
+
+
+def _build_tables(vendor):
     items = Item.objects \
         .filter(vendor=vendor, hidden=False) \
         .select_related("box") \
@@ -216,35 +350,7 @@ def _data_view(request, permit):
                     table.sum += price_value * price_multiplier
                 break
 
-    if request.GET.get("type") == "txt":
-        sign_data = {}
-        total_items = 0
-        for key, table in tables.items():
-            if key == "registered":
-                continue
-            items = [_sign_data(i) for i in table.items]
-            total_items += len(items)
-            sign_data[key] = items
-            sign_data[key + "_s"] = str(table.sum)
-
-        if total_items > 0:
-            sign_data["vendor"] = vendor.id
-            signature = signing.dumps(sign_data, compress=True)
-            signature = "\n".join(textwrap.wrap(signature, 78, break_on_hyphens=False))
-        else:
-            signature = None
-
-        return render(request, "kirppu/vendor_status.txt", {
-            "tables": tables,
-            "price_width": max_price_width,
-            "vendor": vendor.id,
-            "signature": signature,
-        }, content_type="text/plain; charset=utf-8")
-    return render(request, "kirppu/vendor_status.html", {
-        "tables": tables,
-        "CURRENCY": settings.KIRPPU_CURRENCY,
-        "vendor": vendor.id,
-    })
+    return tables, max_price_width
 
 
 def _item(item):
@@ -298,11 +404,7 @@ def _is_permit_valid(request):
 def index(request):
     # FIXME: Implement a better way to enable the link. db-options...
     from .models import UIText
-    try:
-        login_text = UIText.objects.get(identifier="mobile_login")
-        if "--enable--" not in login_text.text:
-            raise UIText.DoesNotExist()
-    except UIText.DoesNotExist:
+    if "--enable--" not in UIText.get_text("mobile_login", ""):
         return HttpResponseForbidden(_("This location is not in use."))
 
     if request.user.is_authenticated:
@@ -315,6 +417,29 @@ def index(request):
             return _login_view(request)
 
 
+def events(request):
+    """
+    Server-Sent Events of item state changes of the vendor, for the vendor status page.
+    Access is the same as in `index`.
+    """
+    from .models import UIText
+    if "--enable--" not in UIText.get_text("mobile_login", ""):
+        return HttpResponseForbidden(_("This location is not in use."))
+
+    if request.user.is_authenticated:
+        try:
+            vendor = Vendor.get_vendor(request)
+        except Vendor.DoesNotExist:
+            vendor = None
+    else:
+        permit = _is_permit_valid(request)
+        vendor = permit.vendor if permit else None
+    if vendor is None:
+        return HttpResponseForbidden()
+
+    return event_stream_response(request, vendor_channel(vendor.id))
+
+
 def logout(request):
     # TODO: Check session and temporary_codes, remove both.
     if _PERMIT_SESSION_KEY in request.session:
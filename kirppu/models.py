@@ -1,17 +1,22 @@
 from __future__ import unicode_literals, print_function, absolute_import
+import logging
 import random
 from decimal import Decimal
 from django.core.exceptions import ValidationError, ImproperlyConfigured
 from django.core.validators import RegexValidator, MinLengthValidator
 from django.db import models
-from django.db.models import Sum
-from django.db import transaction
+from django.db.models import Sum, Count, F
+from django.db.models.functions import TruncMinute
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from django.db import transaction, IntegrityError
 from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.translation import ugettext_lazy as _
 from django.utils.module_loading import import_string
 from django.utils.six import text_type, PY3
 from django.conf import settings
+from .events import counter_channel, event_bus, vendor_channel
 from .utils import model_dict_fn, format_datetime, short_description
 
 from .util import (
@@ -33,6 +38,13 @@ if settings.KIRPPU_AUTO_CLERK and not settings.DEBUG:
 
 User = settings.AUTH_USER_MODEL
 
+logger = logging.getLogger(__name__)
+
+
+def _batches(values, size):
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
 
 def decimal_to_transport(value):
     return long(value * Item.FRACTION)
@@ -353,13 +365,180 @@ class Vendor(models.Model):
         return self._dict_by_user()
 
 
+class VendorSearchTermManager(models.Manager):
+    @staticmethod
+    def terms_of(vendor):
+        """
+        Get the search terms of a vendor: lower case words of names and emails of user and person.
+
+        :type vendor: Vendor
+        :rtype: set[str]
+        """
+        user = vendor.user
+        values = [user.username, user.first_name, user.last_name, user.email]
+        if vendor.person is not None:
+            person = vendor.person
+            values.extend((person.first_name, person.last_name, person.email))
+
+        max_length = VendorSearchTerm._meta.get_field("term").max_length
+        terms = set()
+        for value in values:
+            terms.update(word[:max_length] for word in (value or "").lower().split())
+        return terms
+
+    @transaction.atomic
+    def update_vendors(self, vendors):
+        """
+        Replace search terms of given vendors.
+
+        :type vendors: list[Vendor] | django.db.models.QuerySet
+        """
+        vendors = list(vendors)
+        if not vendors:
+            return
+        self.filter(vendor__in=vendors).delete()
+        self.bulk_create([
+            VendorSearchTerm(vendor=vendor, term=term)
+            for vendor in vendors
+            for term in self.terms_of(vendor)
+        ], batch_size=500)
+
+    def rebuild(self):
+        """
+        Replace all search terms.
+
+        :return: Number of vendors indexed.
+        :rtype: int
+        """
+        vendors = Vendor.objects.select_related("user", "person")
+        self.update_vendors(vendors)
+        return vendors.count()
+
+
+class VendorSearchTerm(models.Model):
+    """
+    Denormalized search words of vendors, for prefix searching vendors. Kept up to date on save of
+    Vendor, Person and User.
+    """
+    objects = VendorSearchTermManager()
+
+    vendor = models.ForeignKey(Vendor, on_delete=models.CASCADE)
+    term = models.CharField(max_length=254, db_index=True)
+
+
+@receiver(post_save, sender=Vendor)
+def _vendor_saved(sender, instance, raw=False, update_fields=None, **kwargs):
+    # Skip saves not touching the user or person whose fields are searched, such as mobile view visits.
+    if raw or (update_fields and not set(update_fields) & {"user", "user_id", "person", "person_id"}):
+        return
+    VendorSearchTerm.objects.update_vendors([instance])
+
+
+@receiver(post_save, sender=Person)
+def _person_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        VendorSearchTerm.objects.update_vendors(Vendor.objects.filter(person=instance).select_related("user"))
+
+
+@receiver(post_save, sender=User)
+def _user_saved(sender, instance, raw=False, update_fields=None, **kwargs):
+    # Skip saves not touching searched fields, such as last_login update on every login.
+    if raw or (update_fields and not set(update_fields) & {"username", "first_name", "last_name", "email"}):
+        return
+    VendorSearchTerm.objects.update_vendors(Vendor.objects.filter(user=instance).select_related("person"))
+
+
 def validate_positive(value):
     if value < 0.0:
         raise ValidationError(_(u"Value cannot be negative"))
 
 
+def _count_if(**condition):
+    return models.Count(models.Case(models.When(then=1, **condition), output_field=models.IntegerField()))
+
+
+class SequenceManager(models.Manager):
+    def allocate(self, name, count=1, initial=None):
+        """
+        Allocate consecutive numbers from a named sequence with a single row update.
+
+        The sequence row stays locked until the current transaction ends, and the numbers are released
+        if it is rolled back, so allocated numbers have no gaps.
+
+        :param name: Name of the sequence.
+        :type name: str
+        :param count: Number of numbers to allocate.
+        :type count: int
+        :param initial: Function returning the last number already in use. It is called only if the
+            sequence does not exist yet. Default is zero.
+        :type initial: callable | None
+        :return: First allocated number. The numbers are `first` ... `first + count - 1`.
+        :rtype: int
+        """
+        with transaction.atomic():
+            sequence = self.filter(name=name)
+            if sequence.update(value=F("value") + count) == 0:
+                start = initial() if initial is not None else 0
+                try:
+                    with transaction.atomic():
+                        self.create(name=name, value=start + count)
+                    return start + 1
+                except IntegrityError:
+                    # Another request created the sequence after our update.
+                    sequence.update(value=F("value") + count)
+            return sequence.values_list("value", flat=True).get() - count + 1
+
+
+@python_2_unicode_compatible
+class Sequence(models.Model):
+    """
+    Named number sequence, for allocating unique numbers without scanning the numbered table.
+    """
+    objects = SequenceManager()
+
+    name = models.CharField(max_length=32, primary_key=True)
+    value = models.BigIntegerField(default=0, help_text="Last allocated number.")
+
+    def __str__(self):
+        return u"{name}: {value}".format(name=self.name, value=self.value)
+
+
+class BoxManager(models.Manager):
+    def with_counts(self):
+        """
+        Get Boxes with their representative item and item type joined and item counts annotated,
+        so that listing boxes is a single query regardless of the number of boxes.
+
+        The annotations are `visible_item_count` (used by `Box.get_item_count`), `item_count`,
+        `items_brought_total`, `items_sold`, `items_compensated`, `items_returnable`,
+        `returnable_count` and `returned_count`.
+
+        Further `filter` calls must not join items, as that would multiply the counts. Filter by
+        `representative_item` instead. Conditions on items may be given to `exclude`, which tests
+        them in a subquery.
+
+        :rtype: django.db.models.QuerySet
+        """
+        return self.get_queryset() \
+            .select_related("representative_item__itemtype") \
+            .annotate(
+                item_count=models.Count("item"),
+                visible_item_count=_count_if(item__hidden=False),
+                items_brought_total=_count_if(item__state__in=(Item.BROUGHT, Item.STAGED, Item.SOLD, Item.RETURNED)),
+                items_sold=_count_if(item__state=Item.SOLD),
+                items_compensated=_count_if(item__state=Item.COMPENSATED),
+                items_returnable=_count_if(item__state__in=(Item.BROUGHT, Item.STAGED)),
+                returnable_count=_count_if(item__state=Item.BROUGHT),
+                returned_count=_count_if(item__state=Item.RETURNED),
+            )
+
+
 @python_2_unicode_compatible
 class Box(models.Model):
+    # Name of the Sequence of box numbers.
+    BOX_NUMBER_SEQUENCE = "box_number"
+
+    objects = BoxManager()
 
     description = models.CharField(max_length=256)
     representative_item = models.ForeignKey("Item", on_delete=models.CASCADE, related_name="+")
@@ -444,6 +623,9 @@ class Box(models.Model):
         :return: Number of items in the box.
         :rtype: Decimal
         """
+        if hasattr(self, "visible_item_count"):
+            # Annotated by BoxManager.with_counts.
+            return self.visible_item_count
         item_count = Item.objects.filter(box=self.id).exclude(hidden=True).count()
         return item_count
 
@@ -495,6 +677,7 @@ class Box(models.Model):
 
     def set_hidden(self, value):
         Item.objects.filter(box=self).update(hidden=value)
+        _vendor_items_changed([self.representative_item.vendor_id])
 
     def is_printed(self):
         """
@@ -514,13 +697,22 @@ class Box(models.Model):
         return self.representative_item
 
     def assign_box_number(self):
-        if self.box_number is None:
-            box_state = Box.objects.aggregate(last_number=models.Max("box_number"))
-            new_number = (box_state["last_number"] or 0) + 1
+        if self.box_number is not None:
+            return
+        with transaction.atomic():
+            # Lock the box, so that it is not given two numbers by concurrent check-ins.
+            current = Box.objects.select_for_update().values_list("box_number", flat=True).get(pk=self.pk)
+            if current is not None:
+                self.box_number = current
+                return
 
-            self.box_number = new_number
+            self.box_number = Sequence.objects.allocate(self.BOX_NUMBER_SEQUENCE, initial=self._last_box_number)
             self.save(update_fields=["box_number"])
 
+    @staticmethod
+    def _last_box_number():
+        return Box.objects.aggregate(last_number=models.Max("box_number"))["last_number"] or 0
+
     @classmethod
     def new(cls, *args, **kwargs):
         """
@@ -555,12 +747,10 @@ class Box(models.Model):
             )
 
             # Create rest of the items for the box.
-            for i in range(count - 1):
-                Item.new(
-                    name=item_title,
-                    box=obj,
-                    **kwargs
-                )
+            Item.new_many([
+                dict(name=item_title, box=obj, **kwargs)
+                for _ in range(count - 1)
+            ])
 
         return obj
 
@@ -633,6 +823,9 @@ class Item(models.Model):
 
     CODE_BITS = 40
 
+    # Rows per query in bulk operations. Keeps the number of query parameters within SQLite limits.
+    BULK_BATCH_SIZE = 500
+
     code = models.CharField(
         max_length=16,
         blank=True,
@@ -745,36 +938,99 @@ class Item(models.Model):
         obj.full_clean()
         obj.save()
 
-        ItemStateLog.objects.create(item=obj, old_state="", new_state=obj.state)
+        log = ItemStateLog.objects.create(item=obj, old_state="", new_state=obj.state)
+        ItemStateBucket.objects.record([log])
 
         return obj
 
+    @classmethod
+    def new_many(cls, items):
+        """
+        Construct and store several new Items at once, generating their barcodes in batches.
+
+        :param items: Constructor keyword arguments of each Item.
+        :type items: list[dict]
+        :return: New stored Item objects, in the order of `items`.
+        :rtype: list[Item]
+        """
+        objs = [cls(**kwargs) for kwargs in items]
+        if not objs:
+            return objs
+
+        # Codes are generated before the transaction, so that they can come from the block reserved by this process.
+        # Related objects are validated from the first item only, as each of them costs a query.
+        related = [f.name for f in cls._meta.get_fields() if f.many_to_one and f.concrete]
+        for i, (obj, code) in enumerate(zip(objs, cls.gen_barcodes(len(objs)))):
+            obj.code = code
+            obj.full_clean(exclude=related if i > 0 else None, validate_unique=False)
+
+        cls.store_many(objs)
+        return objs
+
+    @classmethod
+    def store_many(cls, objs, batch_size=None):
+        """
+        Store several new Items at once, recording them like saving each of them would.
+
+        :param objs: Unsaved Items with their codes set.
+        :type objs: list[Item]
+        :param batch_size: Number of items stored with one query. Default: `BULK_BATCH_SIZE`.
+        :type batch_size: int | None
+        """
+        if not objs:
+            return
+        batch_size = batch_size or cls.BULK_BATCH_SIZE
+        with transaction.atomic():
+            # Bulk creation does not send pre_save to _item_creating. A missing ledger is calculated
+            # from the stored items, so the new items must be recorded before they are stored.
+            VendorLedger.objects.record_changes((obj, "", obj.state) for obj in objs)
+            BoxItemCounts.objects.record_changes((obj, "", obj.state) for obj in objs)
+            cls.objects.bulk_create(objs, batch_size=batch_size)
+            if objs[0].pk is None:
+                # Backend did not return the ids.
+                pks = {}
+                for batch in _batches([obj.code for obj in objs], batch_size):
+                    pks.update(cls.objects.filter(code__in=batch).values_list("code", "pk"))
+                for obj in objs:
+                    obj.pk = pks[obj.code]
+
+            logs = ItemStateLog.objects.bulk_create([
+                ItemStateLog(item=obj, old_state="", new_state=obj.state)
+                for obj in objs
+            ], batch_size=batch_size)
+            ItemStateBucket.objects.record(logs)
+            _vendor_items_changed(obj.vendor_id for obj in objs)
+
     @classmethod
     def gen_barcode(cls):
         """
-        Generate new random barcode for item.
+        Generate new barcode for item.
 
         Format of the code:
-            random:     36 bits
+            data:       36 bits
             checksum:    4 bits
             -------------------
             total:      40 bits
 
+        The data is a sequence number mapped through a secret permutation, see `kirppu.item_codes`.
 
         :return: The newly generated code.
         :rtype: str
         """
-        checksum_bits = 4
-        data_bits = cls.CODE_BITS - checksum_bits
-        key = None
-        i_max = 2 ** data_bits - 1
-        while key is None or Item.objects.filter(code=key).exists():
-            key = b32_encode(
-                pack([
-                    (data_bits, random.randint(1, i_max)),
-                ], checksum_bits=checksum_bits)
-            )
-        return key
+        return cls.gen_barcodes(1)[0]
+
+    @classmethod
+    def gen_barcodes(cls, count):
+        """
+        Generate several new barcodes, see `gen_barcode`.
+
+        :param count: Number of codes to generate.
+        :type count: int
+        :return: List of unique, unused codes.
+        :rtype: list[str]
+        """
+        from .item_codes import item_codes
+        return item_codes.allocate(count)
 
     def is_locked(self):
         return self.state != Item.ADVERTISED
@@ -827,10 +1083,16 @@ class UIText(models.Model):
 
     @classmethod
     def get_text(cls, identifier, default=None):
-        try:
-            return UIText.objects.values_list("text", flat=True).get(identifier=identifier)
-        except UIText.DoesNotExist:
-            return default
+        from .text_cache import ui_text_cache
+        return ui_text_cache.get(identifier, default)
+
+
+@receiver(post_save, sender=UIText)
+@receiver(post_delete, sender=UIText)
+def _ui_text_changed(sender, raw=False, **kwargs):
+    from .text_cache import ui_text_cache
+    # Before commit, other processes could load the old texts again under the new version.
+    transaction.on_commit(ui_text_cache.invalidate)
 
 
 @python_2_unicode_compatible
@@ -853,6 +1115,16 @@ class Counter(models.Model):
         return u"{1} ({0})".format(self.identifier, self.name)
 
 
+@receiver(post_save, sender=Clerk)
+@receiver(post_delete, sender=Clerk)
+@receiver(post_save, sender=Counter)
+@receiver(post_delete, sender=Counter)
+def _checkout_identity_changed(sender, **kwargs):
+    from .ajax_util import invalidate_checkout_identities
+    # Before commit, other workers could cache the old objects again under the new version.
+    transaction.on_commit(invalidate_checkout_identities)
+
+
 @python_2_unicode_compatible
 class ReceiptItem(models.Model):
     ADD = "ADD"
@@ -912,6 +1184,13 @@ class Receipt(models.Model):
     end_time = models.DateTimeField(null=True, blank=True)
     type = models.CharField(choices=TYPES, max_length=16, default=TYPE_PURCHASE)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Receipt, cls).from_db(db, field_names, values)
+        # Status of the latest receipt event, see `_receipt_saved`.
+        instance._published_status = instance.__dict__.get("status")
+        return instance
+
     def items_list(self):
         return [row.as_dict() for row in self.receiptitem_set.order_by("add_time")]
 
@@ -938,7 +1217,12 @@ class Receipt(models.Model):
         type_display=lambda self: self.get_type_display(),
     )
 
-    def calculate_total(self):
+    def aggregate_total(self):
+        """
+        Calculate the total from receipt rows, without changing the stored total.
+
+        :rtype: Decimal
+        """
         result = ReceiptItem.objects.filter(action=ReceiptItem.ADD, receipt=self)\
             .aggregate(price_total=Sum("item__price"))
         extras = ReceiptExtraRow.objects.filter(receipt=self).aggregate(extras_total=Sum("value"))
@@ -946,9 +1230,39 @@ class Receipt(models.Model):
         price_total = result["price_total"]
         extras_total = extras["extras_total"]
 
-        self.total = (price_total or 0) + (extras_total or 0)
+        return (price_total or 0) + (extras_total or 0)
+
+    def calculate_total(self):
+        self.total = self.aggregate_total()
         return self.total
 
+    def add_to_total(self, delta):
+        """
+        Atomically add `delta` to the stored total and refresh `self.total` from the database.
+        The receipt rows causing the change must be saved before calling this.
+
+        If `settings.KIRPPU_VERIFY_RECEIPT_TOTALS` is set, the new total is also compared to
+        the one calculated from receipt rows, and any drift is logged.
+
+        :param delta: Amount to add. Negative when removing rows.
+        :type delta: Decimal
+        """
+        Receipt.objects.filter(pk=self.pk).update(total=F("total") + delta)
+        self.refresh_from_db(fields=("total",))
+
+        if settings.KIRPPU_VERIFY_RECEIPT_TOTALS:
+            drift = self.total_drift()
+            if drift:
+                logger.error("Receipt %i total %s differs from its rows by %s", self.pk, self.total, drift)
+
+    def total_drift(self):
+        """
+        :return: Difference between the stored total and the total calculated from rows.
+            Zero if the stored total is correct.
+        :rtype: Decimal
+        """
+        return self.total - self.aggregate_total()
+
     def __str__(self):
         return "{type}: {start} / {clerk}".format(
             type=self.get_type_display(),
@@ -957,6 +1271,24 @@ class Receipt(models.Model):
         )
 
 
+def _publish_receipt(receipt):
+    event_bus.publish_on_commit(counter_channel(receipt.counter_id), "receipt", {
+        "id": receipt.pk,
+        "status": receipt.status,
+        "type": receipt.type,
+        "total": receipt.total_cents,
+        "clerk": receipt.clerk_id,
+    })
+
+
+@receiver(post_save, sender=Receipt)
+def _receipt_saved(sender, instance, created=False, raw=False, **kwargs):
+    # Only status changes are published, not every change of the total while items are added.
+    if not raw and (created or instance.status != getattr(instance, "_published_status", None)):
+        _publish_receipt(instance)
+        instance._published_status = instance.status
+
+
 @python_2_unicode_compatible
 class ReceiptExtraRow(models.Model):
     TYPE_PROVISION = "PRO"
@@ -998,6 +1330,23 @@ class ReceiptNote(models.Model):
         return text_type(self.timestamp) + u" / " + text_type(self.clerk) + u" @ " + text_type(self.receipt_id)
 
 
+def _publish_item_states(logs):
+    """
+    Publish state changes of items to the event channels of their vendors when the transaction commits.
+
+    :type logs: list[ItemStateLog]
+    """
+    by_vendor = {}
+    for log in logs:
+        by_vendor.setdefault(log.item.vendor_id, []).append({
+            "code": log.item.code,
+            "old_state": log.old_state,
+            "state": log.new_state,
+        })
+    for vendor_id, changes in by_vendor.items():
+        event_bus.publish_on_commit(vendor_channel(vendor_id), "items", changes)
+
+
 class ItemStateLogManager(models.Manager):
     @staticmethod
     def _make_log_state(request, doit):
@@ -1018,12 +1367,18 @@ class ItemStateLogManager(models.Manager):
 
     def log_state(self, item, new_state, request):
         def actual(counter, clerk):
-            return self.create(
+            log = self.create(
                 item=item,
                 old_state=item.state,
                 new_state=new_state,
                 clerk=clerk,
                 counter=counter)
+            ItemStateBucket.objects.record([log])
+            VendorLedger.objects.record([log])
+            BoxItemCounts.objects.record([log])
+            _vendor_items_changed([item.vendor_id])
+            _publish_item_states([log])
+            return log
         return self._make_log_state(request, actual)
 
     def log_states(self, item_set, new_state, request):
@@ -1038,7 +1393,13 @@ class ItemStateLogManager(models.Manager):
                 )
                 for item in item_set
             ]
-            return self.bulk_create(objs)
+            logs = self.bulk_create(objs)
+            ItemStateBucket.objects.record(logs)
+            VendorLedger.objects.record(logs)
+            BoxItemCounts.objects.record(logs)
+            _vendor_items_changed(log.item.vendor_id for log in logs)
+            _publish_item_states(logs)
+            return logs
         return self._make_log_state(request, actual)
 
 
@@ -1075,6 +1436,427 @@ class ItemStateLog(models.Model):
         )
 
 
+class ItemStateBucketManager(models.Manager):
+    @staticmethod
+    def bucket_time(time):
+        return time.replace(second=0, microsecond=0)
+
+    def record(self, logs):
+        """
+        Add state changes to their buckets. Must be called before a changed price of the item is saved,
+        so that the item leaves its old state with the price it entered it with.
+
+        :param logs: Saved log entries. The `item` of each entry is read for item type and price.
+        :type logs: list[ItemStateLog]
+        """
+        deltas = {}
+        for log in logs:
+            key = (self.bucket_time(log.time), log.item.itemtype_id, log.old_state, log.new_state)
+            count, price = deltas.get(key, (0, Decimal(0)))
+            deltas[key] = (count + 1, price + log.item.price)
+        self._add(deltas)
+
+    def record_price_change(self, item, old_price):
+        """
+        Add price change of an item to the bucket of its current state, so that price sums of states
+        stay balanced. The change is recorded without old state and with zero count.
+
+        :param item: Item with its new price and current state.
+        :type item: Item
+        :param old_price: Price of the item before the change.
+        """
+        difference = Decimal(item.price) - Decimal(old_price)
+        if difference:
+            key = (self.bucket_time(timezone.now()), item.itemtype_id, "", item.state)
+            self._add({key: (0, difference)})
+
+    def _add(self, deltas):
+        # Buckets are updated in key order, so that concurrent transactions lock them in the same order.
+        for (time, itemtype_id, old_state, new_state), (count, price) in sorted(deltas.items()):
+            bucket = self.filter(time=time, itemtype_id=itemtype_id, old_state=old_state, new_state=new_state)
+            if bucket.update(count=F("count") + count, price=F("price") + price) > 0:
+                continue
+            try:
+                with transaction.atomic():
+                    self.create(time=time, itemtype_id=itemtype_id, old_state=old_state, new_state=new_state,
+                                count=count, price=price)
+            except IntegrityError:
+                # Another request created the bucket after our update.
+                bucket.update(count=F("count") + count, price=F("price") + price)
+
+    @transaction.atomic
+    def rebuild(self):
+        """
+        Replace all buckets with ones calculated from whole ItemStateLog.
+
+        :return: Number of buckets created.
+        :rtype: int
+        """
+        self.all().delete()
+        rows = ItemStateLog.objects \
+            .annotate(minute=TruncMinute("time")) \
+            .values("minute", "item__itemtype", "old_state", "new_state") \
+            .annotate(log_count=Count("id"), price_sum=Sum("item__price")) \
+            .order_by()
+        buckets = [
+            ItemStateBucket(
+                time=self.bucket_time(row["minute"]),
+                itemtype_id=row["item__itemtype"],
+                old_state=row["old_state"],
+                new_state=row["new_state"],
+                count=row["log_count"],
+                price=row["price_sum"],
+            )
+            for row in rows
+        ]
+        self.bulk_create(buckets, batch_size=500)
+        return len(buckets)
+
+
+class ItemStateBucket(models.Model):
+    """
+    Count and price sum of ItemStateLog entries per minute, item type and state change.
+    Maintained by ItemStateLogManager, so statistics graphs need not replay the whole log.
+    """
+    objects = ItemStateBucketManager()
+
+    time = models.DateTimeField()
+    itemtype = models.ForeignKey(ItemType, on_delete=models.CASCADE)
+    old_state = models.CharField(
+        choices=Item.STATE,
+        max_length=2,
+        blank=True,
+    )
+    new_state = models.CharField(
+        choices=Item.STATE,
+        max_length=2,
+    )
+    count = models.IntegerField(default=0)
+    price = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = (
+            ("time", "itemtype", "old_state", "new_state"),
+        )
+
+
+class VendorLedgerManager(models.Manager):
+    # Fields tracking items in each state.
+    STATE_FIELDS = {
+        Item.SOLD: ("sold_count", "sold_sum"),
+        Item.COMPENSATED: ("compensated_count", "compensated_sum"),
+    }
+    FIELDS = ("sold_count", "sold_sum", "compensated_count", "compensated_sum", "provisions")
+
+    @classmethod
+    def calculate(cls, vendor_id):
+        """
+        Calculate ledger values of a vendor from items and receipts.
+
+        :param vendor_id: Vendor to calculate.
+        :type vendor_id: int
+        :return: Values of `FIELDS`.
+        :rtype: dict
+        """
+        result = {}
+        for state, (count_field, sum_field) in cls.STATE_FIELDS.items():
+            values = Item.objects \
+                .filter(vendor_id=vendor_id, state=state) \
+                .aggregate(count=Count("id"), sum=Sum("price"))
+            result[count_field] = values["count"]
+            result[sum_field] = values["sum"] or Decimal(0)
+
+        # Provisions are attributed to vendor by the items of the receipt.
+        provisions = ReceiptExtraRow.objects.filter(
+            type=ReceiptExtraRow.TYPE_PROVISION,
+            receipt__type=Receipt.TYPE_COMPENSATION,
+            receipt__receiptitem__item__vendor_id=vendor_id,
+        ).distinct().aggregate(value=Sum("value"))
+        result["provisions"] = provisions["value"] or Decimal(0)
+        return result
+
+    def get_for(self, vendor_id):
+        """
+        Get ledger of a vendor, calculating it if the vendor does not have one yet.
+
+        :param vendor_id: Vendor.
+        :type vendor_id: int
+        :rtype: VendorLedger
+        """
+        try:
+            return self.get(vendor_id=vendor_id)
+        except VendorLedger.DoesNotExist:
+            return self._add(vendor_id, {}) or self.get(vendor_id=vendor_id)
+
+    def record(self, logs):
+        """
+        Add state changes to ledgers of item vendors. Must be called before the state change is saved.
+
+        :param logs: Log entries. The `item` of each entry is read for vendor and price.
+        :type logs: list[ItemStateLog]
+        """
+        self.record_changes((log.item, log.old_state, log.new_state) for log in logs)
+
+    def record_changes(self, changes):
+        """
+        Add state changes to ledgers of item vendors.
+
+        :param changes: Tuples of item, old state and new state. Empty state means item creation.
+        :type changes: collections.Iterable[(Item, str, str)]
+        """
+        deltas = {}
+        for item, old_state, new_state in changes:
+            for state, sign in ((old_state, -1), (new_state, 1)):
+                fields = self.STATE_FIELDS.get(state)
+                if fields is None:
+                    continue
+                delta = deltas.setdefault(item.vendor_id, {})
+                count_field, sum_field = fields
+                delta[count_field] = delta.get(count_field, 0) + sign
+                delta[sum_field] = delta.get(sum_field, Decimal(0)) + sign * item.price
+
+        # Ledgers are updated in vendor order, so that concurrent transactions lock them in the same order.
+        for vendor_id, delta in sorted(deltas.items()):
+            delta = {field: value for field, value in delta.items() if value}
+            if delta:
+                self._add(vendor_id, delta)
+
+    def add_provision(self, vendor_id, value):
+        """
+        Add a charged provision to ledger of a vendor. Must be called before the provision row is saved.
+        """
+        self._add(vendor_id, {"provisions": value})
+
+    def _add(self, vendor_id, delta):
+        ledger = self.filter(vendor_id=vendor_id)
+        if not delta:
+            if ledger.exists():
+                return None
+        elif ledger.update(**{field: F(field) + value for field, value in delta.items()}) > 0:
+            return None
+
+        # Missing ledger is created from the current state, which does not yet include this change.
+        values = self.calculate(vendor_id)
+        for field, value in delta.items():
+            values[field] += value
+        try:
+            with transaction.atomic():
+                return self.create(vendor_id=vendor_id, **values)
+        except IntegrityError:
+            # Another request created the ledger after our update.
+            if delta:
+                ledger.update(**{field: F(field) + value for field, value in delta.items()})
+            return None
+
+    def verify(self, fix=False):
+        """
+        Compare ledgers to values calculated from items and receipts.
+
+        :param fix: Replace differing ledger values with the calculated ones.
+        :type fix: bool
+        :return: List of differences as tuples of vendor id, field name, ledger value and calculated value.
+        :rtype: list[(int, str, Decimal|int, Decimal|int)]
+        """
+        differences = []
+        for ledger in self.order_by("vendor_id"):
+            calculated = self.calculate(ledger.vendor_id)
+            wrong = {
+                field: value
+                for field, value in calculated.items()
+                if getattr(ledger, field) != value
+            }
+            differences.extend(
+                (ledger.vendor_id, field, getattr(ledger, field), value)
+                for field, value in sorted(wrong.items())
+            )
+            if fix and wrong:
+                self.filter(pk=ledger.pk).update(**wrong)
+        return differences
+
+
+class VendorLedger(models.Model):
+    """
+    Running totals of a vendor needed for compensation and provision calculation.
+    Maintained by ItemStateLogManager, item creation and item compensation.
+    Changes made outside of them, such as in admin, are found with `VendorLedgerManager.verify`.
+    """
+    objects = VendorLedgerManager()
+
+    vendor = models.OneToOneField(Vendor, on_delete=models.CASCADE, primary_key=True)
+    sold_count = models.IntegerField(default=0)
+    sold_sum = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    compensated_count = models.IntegerField(default=0)
+    compensated_sum = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    provisions = models.DecimalField(max_digits=12, decimal_places=2, default=0,
+                                     help_text="Sum of provisions in compensation receipts.")
+
+
+class BoxItemCountsManager(models.Manager):
+    # Fields counting items of the box in each state.
+    STATE_FIELDS = {
+        Item.BROUGHT: "brought_count",
+        Item.STAGED: "staged_count",
+        Item.SOLD: "sold_count",
+        Item.RETURNED: "returned_count",
+        Item.COMPENSATED: "compensated_count",
+    }
+
+    @classmethod
+    def calculate(cls, box_id):
+        """
+        Calculate item counts of a box from its items.
+
+        :param box_id: Box to calculate.
+        :type box_id: int
+        :return: Values of count fields.
+        :rtype: dict
+        """
+        return Item.objects.filter(box_id=box_id).aggregate(**{
+            field: _count_if(state=state)
+            for state, field in cls.STATE_FIELDS.items()
+        })
+
+    def get_for(self, box_id):
+        """
+        Get counts of a box, calculating them if the box does not have them yet.
+
+        :param box_id: Box.
+        :type box_id: int
+        :rtype: BoxItemCounts
+        """
+        try:
+            return self.get(box_id=box_id)
+        except BoxItemCounts.DoesNotExist:
+            return self._add(box_id, {}) or self.get(box_id=box_id)
+
+    def record(self, logs):
+        """
+        Add state changes to counts of item boxes. Must be called before the state change is saved.
+
+        :param logs: Log entries. The `item` of each entry is read for box.
+        :type logs: list[ItemStateLog]
+        """
+        self.record_changes((log.item, log.old_state, log.new_state) for log in logs)
+
+    def record_changes(self, changes):
+        """
+        Add state changes to counts of item boxes. Items not in a box are ignored.
+
+        :param changes: Tuples of item, old state and new state. Empty state means item creation.
+        :type changes: collections.Iterable[(Item, str, str)]
+        """
+        deltas = {}
+        for item, old_state, new_state in changes:
+            if item.box_id is None:
+                continue
+            for state, sign in ((old_state, -1), (new_state, 1)):
+                field = self.STATE_FIELDS.get(state)
+                if field is not None:
+                    delta = deltas.setdefault(item.box_id, {})
+                    delta[field] = delta.get(field, 0) + sign
+
+        # Counts are updated in box order, so that concurrent transactions lock them in the same order.
+        for box_id, delta in sorted(deltas.items()):
+            delta = {field: value for field, value in delta.items() if value}
+            if delta:
+                self._add(box_id, delta)
+
+    def _add(self, box_id, delta):
+        counts = self.filter(box_id=box_id)
+        if not delta:
+            if counts.exists():
+                return None
+        elif counts.update(**{field: F(field) + value for field, value in delta.items()}) > 0:
+            return None
+
+        # Missing counts are created from the current state, which does not yet include this change.
+        values = self.calculate(box_id)
+        for field, value in delta.items():
+            values[field] += value
+        try:
+            with transaction.atomic():
+                return self.create(box_id=box_id, **values)
+        except IntegrityError:
+            # Another request created the counts after our update.
+            if delta:
+                counts.update(**{field: F(field) + value for field, value in delta.items()})
+            return None
+
+    def verify(self, fix=False):
+        """
+        Compare box counts to values calculated from items.
+
+        :param fix: Replace differing counts with the calculated ones.
+        :type fix: bool
+        :return: List of differences as tuples of box id, field name, stored value and calculated value.
+        :rtype: list[(int, str, int, int)]
+        """
+        differences = []
+        for counts in self.order_by("box_id"):
+            calculated = self.calculate(counts.box_id)
+            wrong = {
+                field: value
+                for field, value in calculated.items()
+                if getattr(counts, field) != value
+            }
+            differences.extend(
+                (counts.box_id, field, getattr(counts, field), value)
+                for field, value in sorted(wrong.items())
+            )
+            if fix and wrong:
+                self.filter(pk=counts.pk).update(**wrong)
+        return differences
+
+
+class BoxItemCounts(models.Model):
+    """
+    Number of items of a box in each state, so that available box items need not be counted on every scan.
+    Maintained by ItemStateLogManager and item creation, like VendorLedger.
+    """
+    objects = BoxItemCountsManager()
+
+    box = models.OneToOneField(Box, on_delete=models.CASCADE, primary_key=True, related_name="counts")
+    brought_count = models.IntegerField(default=0)
+    staged_count = models.IntegerField(default=0)
+    sold_count = models.IntegerField(default=0)
+    returned_count = models.IntegerField(default=0)
+    compensated_count = models.IntegerField(default=0)
+
+
+@receiver(post_save, sender=Vendor)
+def _vendor_created(sender, instance, created=False, raw=False, **kwargs):
+    if created and not raw:
+        VendorLedger.objects.create(vendor=instance)
+        # Drop status snapshot of a possible earlier vendor of the same id.
+        _vendor_items_changed([instance.id])
+
+
+@receiver(pre_save, sender=Item)
+def _item_creating(sender, instance, raw=False, **kwargs):
+    # Recorded before saving, as a missing ledger is calculated from the stored items.
+    if instance._state.adding and not raw:
+        VendorLedger.objects.record_changes([(instance, "", instance.state)])
+        BoxItemCounts.objects.record_changes([(instance, "", instance.state)])
+
+
+def _vendor_items_changed(vendor_ids):
+    from .mobile import invalidate_vendor_status
+    invalidate_vendor_status(vendor_ids)
+
+
+@receiver(post_save, sender=Item)
+@receiver(post_delete, sender=Item)
+def _item_changed(sender, instance, raw=False, **kwargs):
+    if not raw:
+        _vendor_items_changed([instance.vendor_id])
+
+
+@receiver(post_save, sender=Box)
+def _box_changed(sender, instance, raw=False, **kwargs):
+    if not raw and instance.representative_item_id is not None:
+        _vendor_items_changed([instance.representative_item.vendor_id])
+
+
 def default_temporary_access_permit_expiry():
     return timezone.now() + timezone.timedelta(minutes=settings.KIRPPU_SHORT_CODE_EXPIRATION_TIME_MINUTES)
 
@@ -2,54 +2,137 @@
 from decimal import Decimal
 
 from django.conf import settings
-from django.db.models import Sum, Q
+from django.db.models import Count, Sum, Q
 
-from .models import ReceiptExtraRow, Receipt, Item, ReceiptItem
+from .models import Item, ReceiptItem, VendorLedger
+from .provision_arrays import group_by_vendor, price_arrays
 
 __author__ = 'codez'
 
 
+def prices_provision(function):
+    """
+    Adapt a price array provision function (see `provision_arrays`) to take item query.
+
+    :param function: Price array provision function.
+    :type function: callable
+    :return: Provision function taking query of items.
+    :rtype: callable
+    """
+    def provision(items):
+        # Item id is included so that distinct queries do not merge items of equal price.
+        rows = items.values_list("pk", "price", "itemtype_id")
+        return function(*price_arrays((price, item_type) for _, price, item_type in rows))
+    provision.prices_function = function
+    return provision
+
+
+def get_provision_function():
+    """
+    Get provision function taking query of items from settings: `KIRPPU_POST_PROVISION_PRICES`
+    if it is set, otherwise `KIRPPU_POST_PROVISION`.
+
+    :rtype: callable
+    """
+    prices_function = getattr(settings, "KIRPPU_POST_PROVISION_PRICES", None)
+    if prices_function is not None:
+        return prices_provision(prices_function)
+    return settings.KIRPPU_POST_PROVISION
+
+
+def batch_provisions(function=None, vendor_ids=None):
+    """
+    Calculate total provisions of sold and compensated items of all vendors with one query.
+
+    :param function: Price array provision function. Default is `KIRPPU_POST_PROVISION_PRICES`.
+    :type function: callable | None
+    :param vendor_ids: Vendors to calculate, or None for all vendors with sold or compensated items.
+    :type vendor_ids: list[int] | None
+    :return: Provision by vendor id. Vendors without sold or compensated items are not included.
+    :rtype: dict[int, Decimal|None]
+    """
+    function = function or settings.KIRPPU_POST_PROVISION_PRICES
+    if function is None:
+        raise ValueError("Batch provisions need a price array provision function.")
+
+    items = Item.objects.filter(state__in=(Item.SOLD, Item.COMPENSATED))
+    if vendor_ids is not None:
+        items = items.filter(vendor_id__in=vendor_ids)
+    groups = group_by_vendor(items.values_list("vendor_id", "price", "itemtype_id").order_by().iterator())
+    return {
+        vendor_id: function(prices, item_types)
+        for vendor_id, (prices, item_types) in groups.items()
+    }
+
+
 class Provision(object):
+    """
+    Provision of a vendor compensation.
+
+    Sums of sold items and previously charged provisions are read from the vendor's `VendorLedger`.
+    A price array provision function that depends only on item totals (see `provision_arrays`) is
+    calculated from the ledger too. Other provision functions get a query of the items they should
+    calculate the provision for.
+    """
     def __init__(self, vendor_id, receipt=None, provision_function=None):
         self._vendor_id = vendor_id
+        self._ledger = ledger = VendorLedger.objects.get_for(vendor_id)
 
         self._vendor_items = vendor_items = Item.objects.filter(vendor__id=vendor_id)
 
         # Amount of total provision based on sold (=sold/compensated) items.
         if receipt is None:
             total_compensation_items = vendor_items.filter(state__in=(Item.SOLD, Item.COMPENSATED))
+            total_count = ledger.sold_count + ledger.compensated_count
+            total_sum = ledger.sold_sum + ledger.compensated_sum
+            self._receipt_count, self._receipt_sum = 0, Decimal(0)
         else:
             # Include already compensated items and items being compensated.
             # Items that are recently sold should not change the compensation WITHIN a receipt.
             query = Q(state=Item.COMPENSATED) | Q(receiptitem__receipt=receipt)
             total_compensation_items = vendor_items.filter(query).distinct()
+            # Items being compensated are already in compensated state.
+            total_count = ledger.compensated_count
+            total_sum = ledger.compensated_sum
+            receipt_items = ReceiptItem.objects.filter(receipt=receipt, action=ReceiptItem.ADD) \
+                .aggregate(count=Count("id"), sum=Sum("item__price"))
+            self._receipt_count, self._receipt_sum = receipt_items["count"], receipt_items["sum"] or Decimal(0)
 
-        self._total_compensation_items = total_compensation_items
         self._receipt = receipt
 
         self._sub_total = None
         self._provision_result = None
         self._provision_fix_result = None
 
-        self._provision_function = provision_function or settings.KIRPPU_POST_PROVISION
+        self._provision_function = provision_function or get_provision_function()
+        prices_function = getattr(self._provision_function, "prices_function", None)
+        if getattr(prices_function, "totals_only", False):
+            self._totals_function = prices_function.from_totals
+        else:
+            self._totals_function = None
 
-        if not total_compensation_items:
+        if total_count + self._receipt_count == 0:
             self._provision = None
         else:
-            self._provision = self._provision_function(
-                total_compensation_items
-            )
+            self._provision = self._items_provision(total_compensation_items, total_count, total_sum)
 
             if self._provision is not None:
-                if receipt is None:
-                    self._sum_for_compensation = \
-                        vendor_items.filter(state=Item.SOLD).aggregate(sum=Sum("price"))["sum"]
-                else:
-                    self._sum_for_compensation = \
-                        ReceiptItem.objects.filter(receipt=receipt, action=ReceiptItem.ADD) \
-                                           .aggregate(sum=Sum("item__price"))["sum"]
-                if self._sum_for_compensation is None:
-                    self._sum_for_compensation = Decimal(0)
+                self._sum_for_compensation = ledger.sold_sum if receipt is None else self._receipt_sum
+
+    def _items_provision(self, items, count, price_sum):
+        """
+        Calculate provision of items, from their totals if the provision function allows it.
+
+        :param items: Query of the items.
+        :param count: Number of the items.
+        :type count: int
+        :param price_sum: Total price of the items.
+        :type price_sum: Decimal
+        :rtype: Decimal | None
+        """
+        if self._totals_function is not None:
+            return self._totals_function(count, int((price_sum * 100).to_integral_value()))
+        return self._provision_function(items)
 
     @property
     def has_provision(self):
@@ -61,20 +144,16 @@ class Provision(object):
         :return: Provision value for current items and provision fix for total.
         :rtype: (ReceiptExtraRow, ReceiptExtraRow)
         """
-        extras = ReceiptExtraRow.objects.filter(
-            type=ReceiptExtraRow.TYPE_PROVISION,
-            receipt__type=Receipt.TYPE_COMPENSATION,
-            receipt__receiptitem__item__vendor_id=self._vendor_id,
-        ).distinct()
-        extras = extras.aggregate(extras_value=Sum("value"))
-        previous_provisions = extras["extras_value"] or Decimal(0)
+        previous_provisions = self._ledger.provisions
 
         provision_now = -min(self._provision + previous_provisions, self._sum_for_compensation)
         previous_items = self._vendor_items.filter(state=Item.COMPENSATED)
+        previous_count = self._ledger.compensated_count - self._receipt_count
+        previous_sum = self._ledger.compensated_sum - self._receipt_sum
         if self._receipt:
             # Due no state for staged for compensation, exclude current receipt from fix calculations.
             previous_items = previous_items.exclude(receipt=self._receipt)
-        old_target_provision = self._provision_function(previous_items)
+        old_target_provision = self._items_provision(previous_items, previous_count, previous_sum)
         provision_fixup_value = -(old_target_provision + previous_provisions)
 
         assert provision_now <= provision_fixup_value
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Provision functions over item price arrays.
+
+A price array provision function is called with two equally long arrays, prices of items in cents and
+item type ids of the items, and returns the provision as Decimal, or None for no provision. The arrays are
+NumPy int64 arrays when NumPy is installed, and `array.array` otherwise. Functions written for both work
+through the iteration and `sum` interfaces of the arrays.
+
+A function whose provision depends only on the item count and the total price may tell it with a true
+`totals_only` attribute, and provide method `from_totals(count, cents)`. The provision of a vendor is
+then calculated from its ledger without reading the items.
+
+This module does not depend on models, so the functions can be used in settings::
+
+    from kirppu.provision_arrays import PercentageProvision
+    KIRPPU_POST_PROVISION_PRICES = PercentageProvision(10, step="0.50")
+"""
+from __future__ import unicode_literals, print_function, absolute_import
+
+from array import array
+from decimal import Decimal, ROUND_CEILING
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__author__ = 'codez'
+
+__all__ = [
+    "PercentageProvision",
+    "group_by_vendor",
+    "price_arrays",
+]
+
+
+def _cents(price):
+    return int((Decimal(price) * 100).to_integral_value())
+
+
+def _array(values):
+    if numpy is not None:
+        return numpy.array(values, dtype=numpy.int64)
+    return array(str("l"), values)
+
+
+def price_arrays(rows):
+    """
+    Build price and item type arrays.
+
+    >>> prices, item_types = price_arrays([(Decimal("1.25"), 1), (Decimal("2.00"), 2)])
+    >>> list(prices), list(item_types)
+    ([125, 200], [1, 2])
+
+    :param rows: Item prices and item type ids.
+    :type rows: collections.Iterable[(Decimal, int)]
+    :return: Prices in cents and item type ids.
+    """
+    prices = []
+    item_types = []
+    for price, item_type in rows:
+        prices.append(_cents(price))
+        item_types.append(item_type)
+    return _array(prices), _array(item_types)
+
+
+def group_by_vendor(rows):
+    """
+    Build price and item type arrays of each vendor.
+
+    >>> groups = group_by_vendor([(1, Decimal("1.00"), 3), (2, Decimal("0.50"), 3), (1, Decimal("2.00"), 4)])
+    >>> sorted((vendor, list(prices), list(types)) for vendor, (prices, types) in groups.items())
+    [(1, [100, 200], [3, 4]), (2, [50], [3])]
+
+    :param rows: Vendor ids, item prices and item type ids.
+    :type rows: collections.Iterable[(int, Decimal, int)]
+    :return: Price and item type arrays by vendor id.
+    :rtype: dict
+    """
+    vendors = []
+    prices = []
+    item_types = []
+    for vendor_id, price, item_type in rows:
+        vendors.append(vendor_id)
+        prices.append(_cents(price))
+        item_types.append(item_type)
+
+    if numpy is not None:
+        vendors = numpy.array(vendors, dtype=numpy.int64)
+        prices = numpy.array(prices, dtype=numpy.int64)
+        item_types = numpy.array(item_types, dtype=numpy.int64)
+        order = numpy.argsort(vendors, kind="mergesort")
+        vendors, prices, item_types = vendors[order], prices[order], item_types[order]
+        ids, starts = numpy.unique(vendors, return_index=True)
+        bounds = list(starts[1:]) + [len(vendors)]
+        return {
+            int(vendor_id): (prices[start:end], item_types[start:end])
+            for vendor_id, start, end in zip(ids, starts, bounds)
+        }
+
+    groups = {}
+    for vendor_id, price, item_type in zip(vendors, prices, item_types):
+        group = groups.get(vendor_id)
+        if group is None:
+            group = groups[vendor_id] = ([], [])
+        group[0].append(price)
+        group[1].append(item_type)
+    return {vendor_id: (_array(p), _array(t)) for vendor_id, (p, t) in groups.items()}
+
+
+class PercentageProvision(object):
+    """
+    Provision of a percentage of item prices, rounded up to multiple of `step`.
+
+    >>> PercentageProvision(10, step="0.50")(_array([125, 200, 1000]), _array([1, 1, 2]))
+    Decimal('1.50')
+    >>> PercentageProvision(10, item_types=[2])(_array([125, 200, 1000]), _array([1, 1, 2]))
+    Decimal('1.00')
+    >>> PercentageProvision(10)(_array([]), _array([]))
+    Decimal('0.00')
+    >>> PercentageProvision(10, step="0.50").from_totals(3, 1325)
+    Decimal('1.50')
+    """
+    def __init__(self, percent, step="0.01", item_types=None):
+        """
+        :param percent: Percentage of prices to take as provision.
+        :type percent: int | str | Decimal
+        :param step: Rounding step of the provision.
+        :type step: str | Decimal
+        :param item_types: Ids of item types to take provision of, or None for all.
+        :type item_types: list[int] | None
+        """
+        self.percent = Decimal(percent)
+        self.step = _cents(step)
+        self.item_types = set(item_types) if item_types is not None else None
+
+    def _total(self, prices, item_types):
+        if numpy is not None:
+            prices = numpy.asarray(prices)
+            if self.item_types is not None:
+                prices = prices[numpy.isin(numpy.asarray(item_types), list(self.item_types))]
+            return int(prices.sum())
+        if self.item_types is None:
+            return sum(prices)
+        return sum(price for price, item_type in zip(prices, item_types) if item_type in self.item_types)
+
+    @property
+    def totals_only(self):
+        return self.item_types is None
+
+    def __call__(self, prices, item_types):
+        return self.from_totals(len(prices), self._total(prices, item_types))
+
+    def from_totals(self, count, cents):
+        """
+        Provision of items of all item types from their count and total price.
+
+        :param count: Number of items.
+        :type count: int
+        :param cents: Total price of the items in cents.
+        :type cents: int
+        :rtype: Decimal
+        """
+        if count == 0:
+            return Decimal("0.00")
+        cents = cents * self.percent / 100
+        steps = (cents / self.step).to_integral_value(rounding=ROUND_CEILING)
+        return (steps * self.step / 100).quantize(Decimal(".01"))
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, print_function, absolute_import
+
+from decimal import Decimal, InvalidOperation
+
+from django.db.models import Q
+
+from .models import Item, Vendor, VendorSearchTerm
+
+__author__ = 'codez'
+
+__all__ = [
+    "DEFAULT_LIMIT",
+    "MAX_LIMIT",
+    "item_search_query",
+    "paginate",
+    "vendor_search_query",
+]
+
+# Number of results returned, if not specified.
+DEFAULT_LIMIT = 100
+
+# Maximum number of results returned at once.
+MAX_LIMIT = 1000
+
+
+def _price(value):
+    try:
+        value = Decimal(value)
+    except (InvalidOperation, TypeError, ValueError):
+        return None
+    return value if value.is_finite() else None
+
+
+def item_search_query(query="", code="", vendor=None, min_price=None, max_price=None, types=(), states=()):
+    """
+    Build query of Items matching given search terms.
+
+    The text searches use case insensitive `contains` lookups. On PostgreSQL these are served by
+    trigram indexes when pg_trgm extension is available (see migration 0027). On other databases,
+    such as SQLite, they are plain scans which are still limited by `paginate`.
+
+    :param query: Whitespace separated words that must each be found in item name. A full barcode
+        matches also the item code.
+    :type query: str
+    :param code: Part of item code.
+    :type code: str
+    :param vendor: Vendor id.
+    :param min_price: Minimum price, ignored if not a number.
+    :param max_price: Maximum price, ignored if not a number.
+    :param types: Keys of item types.
+    :type types: list[str]
+    :param states: Item states.
+    :type states: list[str]
+    :return: Items with their type and vendor loaded, in stable order.
+    :rtype: django.db.models.QuerySet
+    """
+    clauses = []
+
+    if types:
+        clauses.append(Q(itemtype__key__in=types))
+
+    code = code.strip()
+    if code:
+        clauses.append(Q(code__contains=code))
+
+    if vendor:
+        clauses.append(Q(vendor=vendor))
+
+    if states:
+        clauses.append(Q(state__in=states))
+
+    for part in query.split():
+        p = Q(name__icontains=part)
+        if Item.is_item_barcode(part):
+            p |= Q(code=part)
+        clauses.append(p)
+
+    min_price = _price(min_price)
+    if min_price is not None:
+        clauses.append(Q(price__gte=min_price))
+
+    max_price = _price(max_price)
+    if max_price is not None:
+        clauses.append(Q(price__lte=max_price))
+
+    return Item.objects \
+        .filter(*clauses) \
+        .select_related("itemtype", "vendor__user", "vendor__person") \
+        .order_by("id")
+
+
+def vendor_search_query(query):
+    """
+    Build query of Vendors matching given search terms.
+
+    Words are matched against the prefixes of `VendorSearchTerm` rows, so that the search is served
+    by the term index instead of scanning user and person tables.
+
+    :param query: Whitespace separated words that must each be a prefix of a word in the vendor's
+        user or person names or emails, or the vendor id.
+    :type query: str
+    :return: Vendors with their user and person loaded, in stable order.
+    :rtype: django.db.models.QuerySet
+    """
+    clauses = []
+    for part in query.split():
+        clause = Q(pk__in=VendorSearchTerm.objects.filter(term__startswith=part.lower()).values("vendor"))
+        if part.isdigit():
+            clause |= Q(id=int(part))
+        clauses.append(clause)
+
+    return Vendor.objects \
+        .filter(*clauses) \
+        .select_related("user", "person") \
+        .order_by("id")
+
+
+def paginate(queryset, offset=0, limit=DEFAULT_LIMIT):
+    """
+    Get one page of results. One extra row is read to tell whether there are more results, so
+    no separate count query is needed.
+
+    :param queryset: Query to paginate. Must be ordered.
+    :param offset: Number of results to skip.
+    :type offset: int
+    :param limit: Maximum number of results to return. Capped to `MAX_LIMIT`.
+    :type limit: int
+    :return: List of results, and whether there are more results after them.
+    :rtype: (list, bool)
+    """
+    offset = max(0, offset)
+    limit = max(1, min(limit, MAX_LIMIT))
+    results = list(queryset[offset:offset + limit + 1])
+    return results[:limit], len(results) > limit
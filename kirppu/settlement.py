@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, print_function, absolute_import
+
+from collections import OrderedDict
+from decimal import Decimal
+import json
+
+from django.conf import settings
+from django.db import models
+from django.utils.six import text_type
+
+from .exports import csv_lines
+from .models import Item, Receipt, ReceiptExtraRow, Vendor
+from .provision import batch_provisions
+
+__author__ = 'codez'
+
+__all__ = [
+    "COLUMNS",
+    "settlement_rows",
+    "stream_csv",
+    "stream_json",
+]
+
+# Report columns. Provision values are negative, as in receipts.
+COLUMNS = (
+    "vendor_id",
+    "name",
+    "email",
+    "sold_count",  # Sold items, including compensated ones.
+    "sold_sum",
+    "compensated_count",
+    "compensated_sum",
+    "unpaid_count",  # Sold items not yet compensated.
+    "unpaid_sum",
+    "provision",  # Total provision of all sold items.
+    "provision_charged",  # Provision and provision balancing rows in compensation receipts.
+    "payable",  # Amount still to pay to vendor: unpaid items minus provision not yet charged.
+    "abandoned_count",
+    "abandoned_sum",
+)
+
+_SOLD = (Item.SOLD, Item.COMPENSATED)
+
+
+def _sum_if(field, **condition):
+    return models.Sum(models.Case(
+        models.When(then=field, **condition),
+        default=0,
+        output_field=models.DecimalField(max_digits=12, decimal_places=2),
+    ))
+
+
+def _count_if(**condition):
+    return models.Count(models.Case(models.When(then=1, **condition), output_field=models.IntegerField()))
+
+
+def _item_totals():
+    rows = Item.objects \
+        .values("vendor") \
+        .annotate(
+            sold_count=_count_if(state__in=_SOLD),
+            sold_sum=_sum_if("price", state__in=_SOLD),
+            compensated_count=_count_if(state=Item.COMPENSATED),
+            compensated_sum=_sum_if("price", state=Item.COMPENSATED),
+            unpaid_count=_count_if(state=Item.SOLD),
+            unpaid_sum=_sum_if("price", state=Item.SOLD),
+            abandoned_count=_count_if(abandoned=True),
+            abandoned_sum=_sum_if("price", abandoned=True),
+        ) \
+        .order_by()
+    return {row.pop("vendor"): row for row in rows}
+
+
+def _charged_provisions():
+    # Extra rows are attributed to vendors by the items of their receipts, as in Provision.
+    extras = ReceiptExtraRow.objects \
+        .filter(receipt__type=Receipt.TYPE_COMPENSATION) \
+        .values_list("id", "value", "receipt__receiptitem__item__vendor") \
+        .distinct()
+    charged = {}
+    for _, value, vendor_id in set(extras):
+        if vendor_id is not None:
+            charged[vendor_id] = charged.get(vendor_id, Decimal(0)) + value
+    return charged
+
+
+def _target_provisions(totals):
+    if getattr(settings, "KIRPPU_POST_PROVISION_PRICES", None) is not None:
+        return batch_provisions()
+
+    # Query based provision function must be called for each vendor.
+    function = settings.KIRPPU_POST_PROVISION
+    return {
+        vendor_id: function(Item.objects.filter(vendor_id=vendor_id, state__in=_SOLD))
+        for vendor_id, row in totals.items()
+        if row["sold_count"]
+    }
+
+
+def settlement_rows():
+    """
+    Settlement of every vendor, in vendor id order.
+
+    Item totals, charged provisions and target provisions (with `KIRPPU_POST_PROVISION_PRICES`) are
+    each calculated with a single grouped query. With only `KIRPPU_POST_PROVISION` set, the provision
+    function is called for each vendor with sold items.
+
+    :return: Generator of row dicts with keys of `COLUMNS`.
+    """
+    totals = _item_totals()
+    charged = _charged_provisions()
+    provisions = _target_provisions(totals)
+    zero = Decimal(0)
+    empty = {
+        "sold_count": 0, "sold_sum": zero, "compensated_count": 0, "compensated_sum": zero,
+        "unpaid_count": 0, "unpaid_sum": zero, "abandoned_count": 0, "abandoned_sum": zero,
+    }
+
+    vendors = Vendor.objects.select_related("user", "person").order_by("id")
+    for vendor in vendors.iterator():
+        row = OrderedDict()
+        row["vendor_id"] = vendor.id
+        if vendor.person is not None:
+            row["name"] = vendor.person.full_name()
+            row["email"] = vendor.person.email
+        else:
+            row["name"] = "{} {}".format(vendor.user.first_name, vendor.user.last_name).strip()
+            row["email"] = vendor.user.email
+        row.update(totals.get(vendor.id, empty))
+
+        provision = -(provisions.get(vendor.id) or zero)
+        provision_charged = charged.get(vendor.id, zero)
+        row["provision"] = provision
+        row["provision_charged"] = provision_charged
+        row["payable"] = row["unpaid_sum"] + provision - provision_charged
+        yield OrderedDict((column, row[column]) for column in COLUMNS)
+
+
+def stream_csv(rows):
+    """
+    :param rows: Rows from `settlement_rows`.
+    :return: Generator of CSV lines, header line first.
+    """
+    return csv_lines(COLUMNS, (row.values() for row in rows))
+
+
+def _json_default(value):
+    if isinstance(value, Decimal):
+        return text_type(value)
+    raise TypeError(repr(value))
+
+
+def stream_json(rows):
+    """
+    :param rows: Rows from `settlement_rows`.
+    :return: Generator of parts of a JSON list of row objects. Decimals are strings.
+    """
+    separator = "["
+    for row in rows:
+        yield separator + json.dumps(row, default=_json_default)
+        separator = ",\n"
+    yield "[]" if separator == "[" else "]\n"
@@ -4,17 +4,20 @@ from datetime import datetime, timedelta
 
 import pytz
 from django.conf import settings
+from django.core.cache import cache
 from django.db import models
-from django.db.models import F
+from django.db.models import Sum
 from django.utils.translation import ugettext as _
 
-from .models import Item, ItemType, ItemStateLog
+from .models import Box, Item, ItemType, ItemStateBucket, Vendor
 
 __author__ = 'codez'
 
 __all__ = (
     "ItemCountData",
     "ItemEurosData",
+    "ItemStatistics",
+    "general_statistics",
     "iterate_logs",
     "RegistrationData",
     "SalesData",
@@ -64,9 +67,16 @@ class ItemCollectionData(object):
     GROUP_ITEM_TYPE = "itemtype"
     GROUP_VENDOR = "vendor"
 
-    def __init__(self, group_by):
+    def __init__(self, group_by, raw_data=None):
+        """
+        :param group_by: Grouping of rows, `GROUP_ITEM_TYPE` or `GROUP_VENDOR`.
+        :param raw_data: Pre-calculated rows, such as from `ItemStatistics`. If not given, the rows are queried.
+        :type raw_data: list[dict] | None
+        """
         self._group_by = group_by
-        self._raw_data = self._populate(Item.objects.values(group_by))
+        if raw_data is None:
+            raw_data = self._populate(Item.objects.values(group_by))
+        self._raw_data = raw_data
 
         if group_by == self.GROUP_ITEM_TYPE:
             self._init_for_item_type()
@@ -105,11 +115,9 @@ class ItemCollectionData(object):
 
     def _init_for_vendor(self):
         # Order vendor data by their id.
-        self._raw_data = self._raw_data.order_by("vendor_id")
-
         data = OrderedDict(
             (row["vendor"], row)
-            for row in self._raw_data
+            for row in sorted(self._raw_data, key=lambda row: row["vendor"])
         )
         self._data = data
 
@@ -128,6 +136,16 @@ class ItemCollectionData(object):
         return self._data.keys()
 
     def _populate(self, query):
+        # Return a result list that contains values for all states, sum and the value for group_by per list item.
+        # query must be already made group_by with query.values.
+        return query.annotate(**self.aggregates())
+
+    @classmethod
+    def aggregates(cls):
+        """
+        :return: Aggregate expressions for each key of PROPERTIES and ABANDONED_PROPERTIES.
+        :rtype: dict
+        """
         raise NotImplementedError()
 
     def __repr__(self):
@@ -170,24 +188,22 @@ class ItemCollectionRow(object):
 
 
 class ItemCountData(ItemCollectionData):
-    def _populate(self, query):
-        # Count items per state. query must be already made group_by with query.values.
+    @classmethod
+    def aggregates(cls):
+        # Count items per state.
         states = {
             key: models.Count(models.Case(models.When(state=p, then=1), output_field=models.IntegerField()))
-            for key, p in self.PROPERTIES.items()
+            for key, p in cls.PROPERTIES.items()
             if p is not None
         }
         abandoned = {
             key: models.Count(models.Case(models.When(
                 models.Q(state=p) & models.Q(abandoned=True), then=1), output_field=models.IntegerField()))
-            for key, p in self.ABANDONED_PROPERTIES.items()
+            for key, p in cls.ABANDONED_PROPERTIES.items()
         }
         states.update(abandoned)
-        # Return a result list that contains counts for all states, sum and the value for group_by per list item.
-        return query.annotate(
-            sum=models.Count("id"),
-            **states
-        )
+        states["sum"] = models.Count("id")
+        return states
 
     def data_set(self, key, name):
         return ItemCountRow(key, self._data[key], name)
@@ -203,28 +219,26 @@ class ItemEurosData(ItemCollectionData):
         super(ItemEurosData, self).__init__(*args, **kwargs)
         self.use_cents = False
 
-    def _populate(self, query):
-        # Count item prices per state. query must be already made group_by with query.values.
+    @classmethod
+    def aggregates(cls):
+        # Count item prices per state.
         p_field = Item._meta.get_field("price")
         decimals, digits = p_field.decimal_places, p_field.max_digits
         states = {
             key: models.Sum(models.Case(models.When(state=p, then=models.F("price")),
                                         output_field=models.DecimalField(decimal_places=decimals, max_digits=digits)))
-            for key, p in self.PROPERTIES.items()
+            for key, p in cls.PROPERTIES.items()
             if p is not None
         }
         abandoned = {
             key: models.Sum(models.Case(models.When(
                 models.Q(state=p) & models.Q(abandoned=True),
                 then=models.F("price")), output_field=models.DecimalField(decimal_places=decimals, max_digits=digits)))
-            for key, p in self.ABANDONED_PROPERTIES.items()
+            for key, p in cls.ABANDONED_PROPERTIES.items()
         }
         states.update(abandoned)
-        # Return a result list that contains prices for all states, sum and the value for group_by per list item.
-        return query.annotate(
-            sum=models.Sum("price"),
-            **states
-        )
+        states["sum"] = models.Sum("price")
+        return states
 
     def data_set(self, key, name):
         return ItemEurosRow(self.use_cents, key, self._data[key], name)
@@ -243,6 +257,147 @@ class ItemEurosRow(ItemCollectionRow):
         return value
 
 
+class ItemStatistics(object):
+    """
+    Item counts and euros per state, for both item type and vendor groupings.
+
+    All values are calculated with a single query grouped by both item type and vendor,
+    which is then folded to the two groupings. The result is cached for
+    `settings.KIRPPU_STATS_CACHE_TIME` seconds.
+    """
+    CACHE_KEY = "kirppu:stats:items"
+    KINDS = (
+        ("count", ItemCountData),
+        ("euros", ItemEurosData),
+    )
+    GROUPS = (ItemCollectionData.GROUP_ITEM_TYPE, ItemCollectionData.GROUP_VENDOR)
+
+    def __init__(self, data):
+        self._data = data
+
+    @classmethod
+    def get(cls):
+        """
+        :return: Cached statistics, or newly calculated ones if the cache has expired.
+        :rtype: ItemStatistics
+        """
+        return cls(cache.get_or_set(cls.CACHE_KEY, cls.collect, settings.KIRPPU_STATS_CACHE_TIME))
+
+    @classmethod
+    def collect(cls):
+        """
+        Run the statistics query.
+
+        :return: Rows for each kind and grouping: `{kind: {group_by: [row, ...]}}`.
+        :rtype: dict
+        """
+        annotations = {}
+        kind_keys = []
+        for kind, data_class in cls.KINDS:
+            aggregates = data_class.aggregates()
+            kind_keys.append((kind, list(aggregates.keys())))
+            annotations.update(("%s_%s" % (kind, key), value) for key, value in aggregates.items())
+
+        folded = {
+            kind: {group_by: {} for group_by in cls.GROUPS}
+            for kind, _ in cls.KINDS
+        }
+        for row in Item.objects.values(*cls.GROUPS).annotate(**annotations).order_by():
+            for kind, keys in kind_keys:
+                for group_by in cls.GROUPS:
+                    group_key = row[group_by]
+                    target = folded[kind][group_by].get(group_key)
+                    if target is None:
+                        target = folded[kind][group_by][group_key] = {group_by: group_key}
+                    for key in keys:
+                        target[key] = target.get(key, 0) + (row["%s_%s" % (kind, key)] or 0)
+
+        return {
+            kind: {group_by: list(rows.values()) for group_by, rows in groups.items()}
+            for kind, groups in folded.items()
+        }
+
+    def count_data(self, group_by):
+        """
+        :rtype: ItemCountData
+        """
+        return ItemCountData(group_by, raw_data=self._data["count"][group_by])
+
+    def euros_data(self, group_by):
+        """
+        :rtype: ItemEurosData
+        """
+        return ItemEurosData(group_by, raw_data=self._data["euros"][group_by])
+
+
+def _percentage(part, total):
+    return (part * 100.0 / total) if total > 0 else 0
+
+
+def _conditional_count(then="id", **conditions):
+    return models.Count(models.Case(models.When(then=then, **conditions), output_field=models.IntegerField()))
+
+
+def general_statistics():
+    """
+    General statistics of items, boxes and vendors, cached like `ItemStatistics`.
+
+    :rtype: dict
+    """
+    return cache.get_or_set("kirppu:stats:general", _collect_general_statistics, settings.KIRPPU_STATS_CACHE_TIME)
+
+
+def _collect_general_statistics():
+    brought_states = (Item.BROUGHT, Item.STAGED, Item.SOLD, Item.COMPENSATED, Item.RETURNED)
+
+    items = Item.objects.aggregate(
+        registered=models.Count("id"),
+        deleted=_conditional_count(hidden=True),
+        brought=_conditional_count(state__in=brought_states),
+        sold=_conditional_count(state__in=(Item.STAGED, Item.SOLD, Item.COMPENSATED)),
+        printed_deleted=_conditional_count(hidden=True, printed=True),
+        deleted_brought=_conditional_count(hidden=True, state__in=brought_states),
+        printed_not_brought=_conditional_count(printed=True, state=Item.ADVERTISED),
+        items_in_box=_conditional_count(box__isnull=False),
+        items_in_deleted_boxes=_conditional_count(box__representative_item__hidden=True),
+        vendors=models.Count(models.Case(models.When(state__in=brought_states, then="vendor"),
+                                         output_field=models.IntegerField()), distinct=True),
+    )
+    vendors = Vendor.objects.aggregate(
+        total=models.Count("id"),
+        in_mobile_view=_conditional_count(mobile_view_visited=True),
+    )
+    boxes = Box.objects.aggregate(
+        registered=models.Count("id"),
+        deleted=_conditional_count(representative_item__hidden=True),
+    )
+
+    registered = items["registered"]
+    return {
+        "registered": registered,
+        "deleted": items["deleted"],
+        "deletedOfRegistered": _percentage(items["deleted"], registered),
+        "brought": items["brought"],
+        "broughtOfRegistered": _percentage(items["brought"], registered),
+        "broughtDeleted": items["deleted_brought"],
+        "printedDeleted": items["printed_deleted"],
+        "printedNotBrought": items["printed_not_brought"],
+        "sold": items["sold"],
+        "soldOfBrought": _percentage(items["sold"], items["brought"]),
+        "vendors": items["vendors"],
+        "vendorsTotal": vendors["total"],
+        "vendorsInMobileView": vendors["in_mobile_view"],
+
+        "itemsInBox": items["items_in_box"],
+        "itemsNotInBox": registered - items["items_in_box"],
+        "registeredBoxes": boxes["registered"],
+        "deletedBoxes": boxes["deleted"],
+        "deletedOfRegisteredBoxes": _percentage(boxes["deleted"], boxes["registered"]),
+        "itemsInDeletedBoxes": items["items_in_deleted_boxes"],
+        "itemsInDeletedBoxesOfRegistered": _percentage(items["items_in_deleted_boxes"], registered),
+    }
+
+
 # endregion
 
 
@@ -258,12 +413,11 @@ class GraphLog(object):
         self._as_prices = as_prices
         self._filter = extra_filter or dict()
 
-    def query(self, only):
+    def query(self):
         query = self._create_query()
         query = query.filter(**self._filter)
-        if self._as_prices:
-            return query.only("item__price", *only).annotate(value=F("item__price"))
-        return query.only(*only).annotate(value=models.Value(1, output_field=models.IntegerField()))
+        value = "price" if self._as_prices else "count"
+        return query.values("time", "old_state", "new_state").annotate(value=Sum(value)).order_by("time")
 
     @classmethod
     def datetime_to_js_time(cls, dt):
@@ -280,7 +434,7 @@ class RegistrationData(GraphLog):
     advertised_status = (Item.ADVERTISED,)
 
     def _create_query(self):
-        return ItemStateLog.objects.filter(new_state=Item.ADVERTISED)
+        return ItemStateBucket.objects.filter(new_state=Item.ADVERTISED)
 
     def get_log_str(self, bucket_time, balance):
         entry_time = self.datetime_to_js_time(bucket_time)
@@ -298,7 +452,7 @@ class SalesData(GraphLog):
     compensated_status = (Item.COMPENSATED, Item.RETURNED)
 
     def _create_query(self):
-        return ItemStateLog.objects.exclude(new_state=Item.ADVERTISED)
+        return ItemStateBucket.objects.exclude(new_state=Item.ADVERTISED)
 
     def get_log_str(self, bucket_time, balance):
         entry_time = self.datetime_to_js_time(bucket_time)
@@ -316,7 +470,7 @@ class SalesData(GraphLog):
 
 
 def iterate_logs(using):
-    """ Iterate through ItemStateLog objects returning current sum of each type of object at each timestamp.
+    """ Iterate through ItemStateBucket rows returning current sum of each type of object at each bucket.
 
     Example of returned CVS: js_time, advertized, brought, unsold, money, compensated
 
@@ -332,30 +486,26 @@ def iterate_logs(using):
     :return: JSON presentation of the objects, one item at a time.
 
     """
-    # Collect the data into buckets of size bucket_td to reduce the amount of data that has to be sent
-    # and parsed at client side.
+    # The buckets are one minute wide to reduce the amount of data that has to be sent and parsed at client side.
     balance = {item_type: 0 for item_type, _item_desc in Item.STATE}
     bucket_time = None
     bucket_td = timedelta(seconds=60)
 
-    only = "old_state", "new_state", "time"
-    entries = using.query(only)
-
-    for entry in entries.order_by("time"):
+    for entry in using.query():
         if bucket_time is None:
-            bucket_time = entry.time
+            bucket_time = entry["time"]
             # Start the graph before the first entry, such that everything starts at zero.
             yield using.get_log_str(bucket_time - bucket_td, balance)
-        if (entry.time - bucket_time) > bucket_td:
+        elif entry["time"] != bucket_time:
             # Fart out what was in the old bucket and start a new bucket.
             yield using.get_log_str(bucket_time, balance)
-            bucket_time = entry.time
+            bucket_time = entry["time"]
 
-        item_weight = entry.value
+        item_weight = entry["value"]
 
-        if entry.old_state:
-            balance[entry.old_state] -= item_weight
-        balance[entry.new_state] += item_weight
+        if entry["old_state"]:
+            balance[entry["old_state"]] -= item_weight
+        balance[entry["new_state"]] += item_weight
 
     # Fart out the last bucket.
     if bucket_time is not None:
@@ -6,33 +6,35 @@ import re
 from django import template
 from django.conf import settings
 from django.template import Node, TemplateSyntaxError
+from django.urls import reverse
 from django.utils.encoding import force_text
-from django.utils.lru_cache import lru_cache
 from django.utils.html import format_html
 from django.utils.safestring import mark_safe
 from django.utils.six import text_type
 
 import pubcode
-from ..models import UIText, UserAdapter
+from ..barcodes import barcode_cache, expected_width
+from ..models import UserAdapter
+from ..text_cache import ui_text_cache
 
 register = template.Library()
 
 
 @register.simple_tag
 def load_text(id_):
-    try:
-        return mark_safe(UIText.objects.get(identifier=id_).text)
-    except UIText.DoesNotExist:
-        if settings.DEBUG:
-            return format_html(
-                u'<span style="background-color: lightyellow;'
-                u' color: black;'
-                u' border: 1px solid gray;">'
-                u'Missing text {0}.</span>'.format(
-                    force_text(id_)
-                )
+    text = ui_text_cache.get(id_)
+    if text is not None:
+        return mark_safe(text)
+    if settings.DEBUG:
+        return format_html(
+            u'<span style="background-color: lightyellow;'
+            u' color: black;'
+            u' border: 1px solid gray;">'
+            u'Missing text {0}.</span>'.format(
+                force_text(id_)
             )
-        return u""
+        )
+    return u""
 
 
 @register.simple_tag
@@ -46,7 +48,7 @@ def load_texts(id_, wrap=None):
     :type wrap: str | unicode | None
     :return: str | unicode
     """
-    texts = UIText.objects.filter(identifier__startswith=id_).order_by("identifier").values_list("text", flat=True)
+    texts = ui_text_cache.starting_with(id_)
     if not texts:
         return u""
 
@@ -65,29 +67,30 @@ def load_texts(id_, wrap=None):
     return mark_safe(begin + joined.join(texts) + end)
 
 
-# Limit the size of the dict to a reasonable number so that we don't have
-# millions of dataurls cached.
-@lru_cache(maxsize=50000)
-def get_dataurl(code, ext, expect_width=143):
+def get_dataurl(code, ext, expect_width=143, cached=True):
     if not code:
         return ''
+    return barcode_cache.get(code, ext, expect_width, cached=cached)
+
+
+@register.simple_tag
+def barcode_dataurl(code, ext, expect_width=143, cached=True):
+    return get_dataurl(code, ext, expect_width, cached)
 
-    # Code the barcode entirely with charset B to make sure that the bacode is
-    # always the same width.
-    barcode = pubcode.Code128(code, charset='B')
-    data_url = barcode.data_url(image_format=ext, add_quiet_zone=True)
 
+def get_barcode_url(code, ext, expect_width=143):
+    if not code:
+        return ''
     # These measurements have to be exactly the same as the ones used in
     # price_tags.css. If they are not the image might be distorted enough
     # to not register on the scanner.
-    assert(expect_width is None or barcode.width(add_quiet_zone=True) == expect_width)
-
-    return data_url
+    assert(expect_width is None or expected_width(code) == expect_width)
+    return reverse("kirppu:barcode", kwargs={"code": code, "ext": ext})
 
 
 @register.simple_tag
-def barcode_dataurl(code, ext, expect_width=143):
-    return get_dataurl(code, ext, expect_width)
+def barcode_url(code, ext, expect_width=143):
+    return get_barcode_url(code, ext, expect_width)
 
 
 @register.simple_tag
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+import json
+
+from django.db import connection, transaction
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from kirppu.api_metrics import _logged_queries, api_metrics
+from kirppu.checkout_api import AJAX_FUNCTIONS
+from kirppu.models import Item
+
+from .factories import *
+from .api_access import api, apiOK
+
+__author__ = 'codez'
+
+
+# Budgets are for a deployment with a shared cache, where checkout identities are cached.
+@override_settings(KIRPPU_CHECKOUT_IDENTITY_CACHE_TIME=30)
+class ApiQueryBudgetTest(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.vendor = VendorFactory()
+        self.items = ItemFactory.create_batch(3, vendor=self.vendor, itemtype=ItemTypeFactory(), state=Item.ADVERTISED)
+        self.counter = CounterFactory()
+        self.clerk = ClerkFactory()
+        api_metrics.reset()
+
+    def tearDown(self):
+        api_metrics.reset()
+
+    def test_budgets(self):
+        with api_metrics.enable():
+            apiOK.clerk_login(self.client, {"code": self.clerk.get_code(), "counter": self.counter.identifier})
+            for item in self.items:
+                apiOK.item_find(self.client, {"code": item.code})
+                apiOK.item_checkin(self.client, {"code": item.code})
+
+            receipt = json.loads(apiOK.receipt_start(self.client).content.decode())
+            for item in self.items:
+                apiOK.item_reserve(self.client, {"code": item.code})
+            apiOK.item_release(self.client, {"code": self.items[0].code})
+            apiOK.receipt_finish(self.client, {"id": receipt["id"]})
+            apiOK.item_checkout(self.client, {"code": self.items[0].code})
+
+        budgets = {name: func.query_budget for name, func in AJAX_FUNCTIONS.items() if func.query_budget is not None}
+        self.assertEqual(8, len(budgets))
+        for name, budget in sorted(budgets.items()):
+            metrics = api_metrics.get(name)
+            self.assertIsNotNone(metrics, name)
+            self.assertLessEqual(metrics["max_queries"], budget, "{} exceeds its query budget".format(name))
+            self.assertEqual(0, metrics["over_budget"], name)
+
+    def test_budget_of_large_receipt(self):
+        apiOK.clerk_login(self.client, {"code": self.clerk.get_code(), "counter": self.counter.identifier})
+        items = ItemFactory.create_batch(30, vendor=self.vendor, itemtype=self.items[0].itemtype, state=Item.BROUGHT)
+        receipt = json.loads(apiOK.receipt_start(self.client).content.decode())
+        for item in items:
+            apiOK.item_reserve(self.client, {"code": item.code})
+        with api_metrics.enable():
+            apiOK.receipt_finish(self.client, {"id": receipt["id"]})
+        self.assertEqual(0, api_metrics.get("receipt_finish")["over_budget"])
+
+    def test_over_budget(self):
+        view = api_metrics.wrap(lambda request: apiOK.item_find(self.client, {"code": self.items[0].code}),
+                                query_budget=0)
+        apiOK.clerk_login(self.client, {"code": self.clerk.get_code(), "counter": self.counter.identifier})
+        with api_metrics.enable():
+            view(None)
+        self.assertEqual(1, api_metrics.get("<lambda>")["over_budget"])
+
+    def test_full_query_log(self):
+        connection.ensure_connection()
+        queries_log = connection.queries_log
+        queries_log.extend({"sql": "", "time": "0"} for _ in range(queries_log.maxlen))
+        try:
+            with _logged_queries(connection) as queries:
+                Item.objects.count()
+            self.assertEqual(1, len(queries))
+            self.assertEqual(queries_log.maxlen, len(connection.queries_log))
+        finally:
+            queries_log.clear()
+
+    def test_identity_cache(self):
+        apiOK.clerk_login(self.client, {"code": self.clerk.get_code(), "counter": self.counter.identifier})
+        apiOK.item_find(self.client, {"code": self.items[0].code})
+        with CaptureQueriesContext(connection) as cached:
+            apiOK.item_find(self.client, {"code": self.items[0].code})
+        with override_settings(KIRPPU_CHECKOUT_IDENTITY_CACHE_TIME=0):
+            with CaptureQueriesContext(connection) as uncached:
+                apiOK.item_find(self.client, {"code": self.items[0].code})
+        # Clerk and counter are loaded only without the cache.
+        self.assertEqual(len(cached) + 2, len(uncached))
+
+    def test_disabled(self):
+        apiOK.clerk_login(self.client, {"code": self.clerk.get_code(), "counter": self.counter.identifier})
+        self.assertIsNone(api_metrics.get("clerk_login"))
+
+
+@override_settings(KIRPPU_CHECKOUT_IDENTITY_CACHE_TIME=30)
+class IdentityCacheInvalidateTest(TransactionTestCase):
+    def setUp(self):
+        self.client = Client()
+        self.item = ItemFactory(state=Item.ADVERTISED)
+        self.clerk = ClerkFactory()
+        apiOK.clerk_login(self.client, {"code": self.clerk.get_code(), "counter": CounterFactory().identifier})
+
+    def test_changed_clerk(self):
+        apiOK.item_find(self.client, {"code": self.item.code})
+        with transaction.atomic():
+            self.clerk.generate_access_key()
+            self.clerk.save()
+            # Other workers would cache the clerk that is still committed.
+            apiOK.item_find(self.client, {"code": self.item.code})
+        # Changed clerk is loaded again.
+        self.assertEqual(401, api.item_find(self.client, {"code": self.item.code}).status_code)
+
+
+class ApiMetricsViewTest(TestCase):
+    def setUp(self):
+        self.client = Client()
+        api_metrics.reset()
+        api_metrics.record("item_find", queries=4, db_time=0.5, elapsed=1.0, size=100)
+
+    def tearDown(self):
+        api_metrics.reset()
+
+    def test_prometheus(self):
+        text = api_metrics.prometheus()
+        self.assertIn("# TYPE kirppu_api_requests_total counter\n", text)
+        self.assertIn('kirppu_api_requests_total{endpoint="item_find"} 1\n', text)
+        self.assertIn('kirppu_api_queries_max{endpoint="item_find"} 4\n', text)
+
+    @override_settings(KIRPPU_API_METRICS_TOKEN="secret")
+    def test_access(self):
+        url = reverse("kirppu:api_metrics_prometheus")
+        self.assertEqual(403, self.client.get(url).status_code)
+        self.assertEqual(403, self.client.get(url, HTTP_AUTHORIZATION="Bearer wrong").status_code)
+        response = self.client.get(url, HTTP_AUTHORIZATION="Bearer secret")
+        self.assertEqual(200, response.status_code)
+        self.assertIn(b'kirppu_api_seconds_total{endpoint="item_find"} 1.0', response.content)
+
+        user = UserFactory(is_staff=True)
+        user.set_password("pw")
+        user.save()
+        self.client.login(username=user.username, password="pw")
+        self.assertEqual(200, self.client.get(url).status_code)
+        response = self.client.get(reverse("kirppu:api_metrics"))
+        self.assertContains(response, "item_find")
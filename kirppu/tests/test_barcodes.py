@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from kirppu.barcodes import BarcodeCache, barcode_cache, expected_width
+from kirppu.templatetags.kirppu_tags import get_barcode_url, get_dataurl
+
+from .factories import *
+
+__author__ = 'codez'
+
+
+class BarcodeCacheTest(TestCase):
+    def setUp(self):
+        barcode_cache.cache.clear()
+        barcode_cache.reset_stats()
+
+    def test_cached(self):
+        code = "ABCD1234"
+        url = get_dataurl(code, "png")
+        self.assertTrue(url.startswith("data:image/png;base64,"))
+        self.assertEqual({"hits": 0, "misses": 1}, barcode_cache.stats())
+
+        self.assertEqual(url, get_dataurl(code, "png"))
+        self.assertEqual({"hits": 1, "misses": 1}, barcode_cache.stats())
+        self.assertEqual(url, BarcodeCache.render(code, "png")[0])
+
+    def test_not_cached(self):
+        url = get_dataurl("ABCD1234", "png", cached=False)
+        self.assertEqual(url, BarcodeCache.render("ABCD1234", "png")[0])
+        self.assertEqual({}, barcode_cache.cache.get_many([BarcodeCache._key("ABCD1234", "png")]))
+        self.assertEqual({"hits": 0, "misses": 0}, barcode_cache.stats())
+
+    def test_clerk_codes_not_cached(self):
+        user = UserFactory(is_staff=True)
+        ClerkFactory(user=user)
+        self.client.force_login(user)
+        self.assertEqual(200, self.client.get(reverse("kirppu:clerks")).status_code)
+        self.assertEqual({"hits": 0, "misses": 0}, barcode_cache.stats())
+
+    def test_many(self):
+        codes = ["box1", "box20", "box300"]
+        urls = barcode_cache.get_many(codes, "png", expected_width)
+        self.assertEqual(3, len(set(urls)))
+        self.assertEqual(urls, barcode_cache.get_many(codes, "png", expected_width))
+        self.assertEqual({"hits": 3, "misses": 3}, barcode_cache.stats())
+
+    def test_width(self):
+        self.assertEqual(143, expected_width("ABCD1234"))
+        with self.assertRaises(AssertionError):
+            get_dataurl("ABC", "png")
+
+        # Width is checked also for cached images.
+        get_dataurl("ABC", "png", None)
+        with self.assertRaises(AssertionError):
+            get_dataurl("ABC", "png")
+
+
+class BarcodeImageTest(TestCase):
+    def setUp(self):
+        barcode_cache.cache.clear()
+        barcode_cache.reset_stats()
+        self.item = ItemFactory()
+        self.clerk = ClerkFactory()
+        self.client.force_login(self.clerk.user)
+
+    def test_png(self):
+        url = get_barcode_url(self.item.code, "png")
+        self.assertEqual(reverse("kirppu:barcode", kwargs={"code": self.item.code, "ext": "png"}), url)
+
+        response = self.client.get(url)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual("image/png", response["Content-Type"])
+        self.assertTrue(response.content.startswith(b"\x89PNG"))
+        self.assertIn("private", response["Cache-Control"])
+        self.assertIn("max-age=", response["Cache-Control"])
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(304, response.status_code)
+
+    def test_svg(self):
+        response = self.client.get(get_barcode_url("box12", "svg", None))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual("image/svg+xml", response["Content-Type"])
+        self.assertIn('width="{}"'.format(expected_width("box12")), response.content.decode("utf-8"))
+
+    def test_unknown_format(self):
+        self.assertEqual(404, self.client.get(get_barcode_url("ABCD1234", "gif")).status_code)
+
+    def test_access(self):
+        url = get_barcode_url(self.item.code, "png")
+        self.client.logout()
+        self.assertEqual(302, self.client.get(url).status_code)
+
+        self.client.force_login(self.item.vendor.user)
+        self.assertEqual(200, self.client.get(url).status_code)
+        self.assertEqual(403, self.client.get(get_barcode_url(ItemFactory().code, "png")).status_code)
+        self.assertEqual(403, self.client.get(get_barcode_url("ABCD1234", "png")).status_code)
+
+    def test_unknown_code_expires(self):
+        key = BarcodeCache._key("ABCD1234", "file.png")
+        with override_settings(KIRPPU_BARCODE_UNKNOWN_CACHE_TIME=0):
+            self.assertEqual(200, self.client.get(get_barcode_url("ABCD1234", "png")).status_code)
+        self.assertIsNone(barcode_cache.cache.get(key))
+
+        self.client.get(get_barcode_url(self.item.code, "png"))
+        self.assertIsNotNone(barcode_cache.cache.get(BarcodeCache._key(self.item.code, "file.png")))
@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import time
+from unittest import skipUnless
+
+from django.db import connection, transaction
+from django.test import Client
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from kirppu.models import Box, BoxItemCounts, Item, ItemStateLog, Person
+
+from .factories import *
+from .api_access import api, apiOK
+
+__author__ = 'codez'
+
+
+class ItemReserveManyTest(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.vendor = VendorFactory()
+        self.items = ItemFactory.create_batch(3, vendor=self.vendor, state=Item.BROUGHT, price=Decimal("1.50"))
+
+        self.counter = CounterFactory()
+        self.clerk = ClerkFactory()
+        apiOK.clerk_login(self.client, {"code": self.clerk.get_code(), "counter": self.counter.identifier})
+        self.receipt = json.loads(apiOK.receipt_start(self.client).content.decode())
+
+    def _codes(self, items):
+        return " ".join(item.code for item in items)
+
+    def test_reserve(self):
+        ret = apiOK.item_reserve_many(self.client, {"codes": self._codes(self.items)})
+        data = json.loads(ret.content.decode())
+
+        self.assertEqual([item.code for item in self.items], [item["code"] for item in data["items"]])
+        self.assertEqual(450, data["total"])
+        self.assertEqual(Decimal("4.50"), Receipt.objects.get(pk=self.receipt["id"]).total)
+        self.assertEqual(3, Item.objects.filter(state=Item.STAGED).count())
+        self.assertEqual(3, ItemStateLog.objects.filter(new_state=Item.STAGED, clerk=self.clerk).count())
+
+        apiOK.item_reserve(self.client, {"code": ItemFactory(vendor=self.vendor, state=Item.BROUGHT).code})
+        self.assertEqual(Decimal("5.75"), Receipt.objects.get(pk=self.receipt["id"]).calculate_total())
+
+    def test_all_or_nothing(self):
+        sold = ItemFactory(vendor=self.vendor, state=Item.SOLD)
+        ret = api.item_reserve_many(self.client, {"codes": self._codes(self.items + [sold])})
+        self.assertEqual(409, ret.status_code)
+        self.assertIn(sold.code, ret.content.decode())
+        self.assertEqual(0, Item.objects.filter(state=Item.STAGED).count())
+        self.assertEqual(Decimal(0), Receipt.objects.get(pk=self.receipt["id"]).total)
+
+        ret = api.item_reserve_many(self.client, {"codes": self._codes(self.items) + " NOTFOUND"})
+        self.assertEqual(404, ret.status_code)
+        self.assertEqual(0, Item.objects.filter(state=Item.STAGED).count())
+
+    def test_receipt_not_pending(self):
+        Receipt.objects.filter(pk=self.receipt["id"]).update(status=Receipt.FINISHED)
+        ret = api.item_reserve_many(self.client, {"codes": self._codes(self.items)})
+        self.assertEqual(409, ret.status_code)
+        self.assertEqual(0, Item.objects.filter(state=Item.STAGED).count())
+
+    def test_advertised_message(self):
+        item = ItemFactory(vendor=self.vendor)
+        data = json.loads(apiOK.item_reserve_many(self.client, {"codes": item.code}).content.decode())
+        self.assertIn("_message", data["items"][0])
+        self.assertEqual(Item.STAGED, data["items"][0]["state"])
+
+
+class ReceiptTotalTest(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.vendor = VendorFactory()
+        self.items = ItemFactory.create_batch(3, vendor=self.vendor, state=Item.BROUGHT, price=Decimal("2.25"))
+
+        self.counter = CounterFactory()
+        self.clerk = ClerkFactory()
+        apiOK.clerk_login(self.client, {"code": self.clerk.get_code(), "counter": self.counter.identifier})
+        self.receipt_id = json.loads(apiOK.receipt_start(self.client).content.decode())["id"]
+
+    def test_running_total(self):
+        for item in self.items:
+            ret = apiOK.item_reserve(self.client, {"code": item.code})
+        self.assertEqual(675, json.loads(ret.content.decode())["total"])
+
+        ret = apiOK.item_release(self.client, {"code": self.items[0].code})
+        self.assertEqual(450, json.loads(ret.content.decode())["total"])
+
+        receipt = Receipt.objects.get(pk=self.receipt_id)
+        self.assertEqual(Decimal("4.50"), receipt.total)
+        self.assertEqual(0, receipt.total_drift())
+
+    def test_drift(self):
+        apiOK.item_reserve(self.client, {"code": self.items[0].code})
+        Receipt.objects.filter(pk=self.receipt_id).update(total=Decimal("1.00"))
+        self.assertEqual(Decimal("-1.25"), Receipt.objects.get(pk=self.receipt_id).total_drift())
+
+
+class ReceiptEndTest(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.vendor = VendorFactory()
+        self.item_type = ItemTypeFactory()
+        self.counter = CounterFactory()
+        self.clerk = ClerkFactory()
+        apiOK.clerk_login(self.client, {"code": self.clerk.get_code(), "counter": self.counter.identifier})
+
+    def _start(self, count):
+        items = ItemFactory.create_batch(count, vendor=self.vendor, itemtype=self.item_type, state=Item.BROUGHT)
+        receipt_id = json.loads(apiOK.receipt_start(self.client).content.decode())["id"]
+        apiOK.item_reserve_many(self.client, {"codes": " ".join(item.code for item in items)})
+        return receipt_id, items
+
+    def _end(self, function, count):
+        receipt_id, items = self._start(count)
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            function(self.client, {"id": receipt_id})
+            elapsed = time.perf_counter() - start
+        return receipt_id, items, len(queries), elapsed
+
+    def test_finish(self):
+        _, items, small, _ = self._end(apiOK.receipt_finish, 2)
+        receipt_id, items, large, _ = self._end(apiOK.receipt_finish, 10)
+
+        # Queries do not depend on item count. Creating new state buckets may add a few.
+        self.assertLess(large - small, 8)
+        self.assertEqual(10, Item.objects.filter(pk__in=[i.pk for i in items], state=Item.SOLD).count())
+        self.assertEqual(10, ItemStateLog.objects.filter(new_state=Item.SOLD, item__in=items, clerk=self.clerk).count())
+        self.assertEqual(Decimal("12.50"), Receipt.objects.get(pk=receipt_id).total)
+
+    def test_abort(self):
+        _, items, small, _ = self._end(apiOK.receipt_abort, 2)
+        receipt_id, items, large, _ = self._end(apiOK.receipt_abort, 10)
+
+        # Queries do not depend on item count. Creating new state buckets may add a few.
+        self.assertLess(large - small, 8)
+        self.assertEqual(10, Item.objects.filter(pk__in=[i.pk for i in items], state=Item.BROUGHT).count())
+        self.assertEqual(10, ReceiptItem.objects.filter(receipt=receipt_id, action=ReceiptItem.REMOVE).count())
+        self.assertEqual(10, ReceiptItem.objects.filter(receipt=receipt_id, action=ReceiptItem.REMOVED_LATER).count())
+        self.assertEqual(Decimal(0), Receipt.objects.get(pk=receipt_id).total)
+
+    @skipUnless(os.environ.get("KIRPPU_BENCHMARK"), "Set KIRPPU_BENCHMARK=1 to run benchmarks.")
+    def test_benchmark(self):
+        for name, function in (("finish", apiOK.receipt_finish), ("abort", apiOK.receipt_abort)):
+            for count in (5, 50, 500):
+                _, _, queries, elapsed = self._end(function, count)
+                print("{} {} items: {} queries, {:.3f} s".format(name, count, queries, elapsed))
+
+
+class ItemSearchTest(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.vendor = VendorFactory()
+        self.item_type = ItemTypeFactory()
+        self.items = [
+            ItemFactory(vendor=self.vendor, itemtype=self.item_type, name="Comic {}".format(i), price=Decimal(i + 1))
+            for i in range(12)
+        ]
+        ItemFactory(vendor=self.vendor, itemtype=self.item_type, name="Plushie")
+
+        self.counter = CounterFactory()
+        self.clerk = ClerkFactory()
+        self.clerk.user.is_superuser = True
+        self.clerk.user.save()
+        apiOK.clerk_login(self.client, {"code": self.clerk.get_code(), "counter": self.counter.identifier})
+
+    def _search(self, **kwargs):
+        params = dict(query="", code="", vendor="", min_price="", max_price="", item_type="", item_state="")
+        params.update(kwargs)
+        return json.loads(apiOK.item_search(self.client, params).content.decode())
+
+    def test_pages(self):
+        first = self._search(query="comic", limit="5")
+        self.assertEqual(5, len(first["items"]))
+        self.assertTrue(first["more"])
+
+        last = self._search(query="comic", limit="5", offset="10")
+        self.assertEqual(2, len(last["items"]))
+        self.assertFalse(last["more"])
+
+        codes = [item["code"] for item in self._search(query="COMIC")["items"]]
+        self.assertEqual([item.code for item in self.items], codes)
+
+    def test_filters(self):
+        data = self._search(min_price="3", max_price="4.5")
+        self.assertEqual(["Comic 2", "Comic 3"], [item["name"] for item in data["items"]])
+
+        data = self._search(query=self.items[5].code)
+        self.assertEqual([self.items[5].code], [item["code"] for item in data["items"]])
+        self.assertEqual(self.vendor.id, data["items"][0]["vendor"]["id"])
+
+    @override_settings(KIRPPU_CHECKOUT_IDENTITY_CACHE_TIME=0)
+    def test_query_count(self):
+        params = dict(query="", code="", vendor="", min_price="", max_price="", item_type="", item_state="")
+        with CaptureQueriesContext(connection) as small:
+            apiOK.item_search(self.client, dict(params, limit="2"))
+        with CaptureQueriesContext(connection) as large:
+            apiOK.item_search(self.client, dict(params, limit="10"))
+        self.assertEqual(len(small), len(large))
+
+
+class VendorFindTest(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.vendor = VendorFactory(
+            user__username="mikko_m", user__first_name="Mikko", user__last_name="Mallikas",
+            user__email="mikko@example.com")
+        self.other = VendorFactory(user__username="other", user__first_name="Maija", user__last_name="Meikäläinen")
+
+        self.counter = CounterFactory()
+        self.clerk = ClerkFactory()
+        apiOK.clerk_login(self.client, {"code": self.clerk.get_code(), "counter": self.counter.identifier})
+
+    def _find(self, q, **kwargs):
+        return [v["id"] for v in json.loads(apiOK.vendor_find(self.client, dict(kwargs, q=q)).content.decode())]
+
+    def test_prefix(self):
+        self.assertEqual([self.vendor.id], self._find("mik"))
+        self.assertEqual([self.vendor.id], self._find("MALLI mikko@"))
+        self.assertEqual([self.vendor.id, self.other.id], self._find("m"))
+        self.assertEqual([self.other.id], self._find(str(self.other.id)))
+        self.assertEqual([], self._find("allikas"))
+
+    def test_limit(self):
+        self.assertEqual([self.vendor.id], self._find("m", limit="1"))
+
+    def test_terms_follow_saves(self):
+        user = self.vendor.user
+        user.last_name = "Virtanen"
+        user.save()
+        self.assertEqual([self.vendor.id], self._find("virta"))
+        self.assertEqual([], self._find("mallikas"))
+
+        person = Person.objects.create(first_name="Ville", email="ville@example.com")
+        self.other.person = person
+        self.other.save()
+        self.assertEqual([self.other.id], self._find("ville"))
+
+        person.first_name = "Kalle"
+        person.save()
+        self.assertEqual([self.other.id], self._find("kalle"))
+
+    def test_unrelated_save(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.vendor.save(update_fields=("mobile_view_visited",))
+        self.assertFalse([query for query in queries.captured_queries if "vendorsearchterm" in query["sql"]])
+
+    @override_settings(KIRPPU_CHECKOUT_IDENTITY_CACHE_TIME=0)
+    def test_query_count(self):
+        for i in range(10):
+            VendorFactory(user__username="vendor_{}".format(i))
+        with CaptureQueriesContext(connection) as small:
+            self.assertEqual(1, len(self._find("vendor", limit="1")))
+        with CaptureQueriesContext(connection) as large:
+            self.assertEqual(10, len(self._find("vendor")))
+        self.assertEqual(len(small), len(large))
+
+
+class BoxListTest(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.vendor = VendorFactory()
+        self.item_type = ItemTypeFactory()
+
+        self.counter = CounterFactory()
+        self.clerk = ClerkFactory()
+        apiOK.clerk_login(self.client, {"code": self.clerk.get_code(), "counter": self.counter.identifier})
+
+    def _new_box(self, count=4):
+        box = Box.new(
+            vendor=self.vendor,
+            itemtype=self.item_type,
+            name="Box",
+            description="Box of things",
+            price="1.50",
+            count=count,
+            bundle_size=1,
+        )
+        box.get_items().update(state=Item.BROUGHT)
+        return box
+
+    def _list(self):
+        return json.loads(apiOK.box_list(self.client, {"vendor": self.vendor.id}).content.decode())
+
+    def test_counts(self):
+        box = self._new_box()
+        items = list(box.get_items().order_by("pk"))
+        Item.objects.filter(pk=items[1].pk).update(state=Item.SOLD)
+        Item.objects.filter(pk=items[2].pk).update(state=Item.COMPENSATED)
+        hidden = self._new_box()
+        hidden.set_hidden(True)
+
+        data = self._list()
+        self.assertEqual(1, len(data))
+        self.assertEqual(box.id, data[0]["box_id"])
+        self.assertEqual(4, data[0]["item_count"])
+        self.assertEqual(3, data[0]["items_brought_total"])
+        self.assertEqual(1, data[0]["items_sold"])
+        self.assertEqual(1, data[0]["items_compensated"])
+        self.assertEqual(2, data[0]["items_returnable"])
+        self.assertEqual(self.item_type.title, data[0]["item_type"])
+        self.assertEqual(150, data[0]["item_price"])
+
+    def test_returnable_items(self):
+        box = self._new_box(3)
+        Item.objects.filter(pk=box.representative_item_id).update(state=Item.RETURNED)
+
+        data = json.loads(apiOK.vendor_returnable_items(self.client, {"vendor": self.vendor.id}).content.decode())
+        self.assertEqual(1, len(data))
+        self.assertEqual(dict(id=box.id, description="Box of things", box_number=None,
+                              item_count=3, returnable_count=2, returned_count=1), data[0]["box"])
+
+        data = json.loads(apiOK.item_checkout(self.client, {"code": box.representative_item.code}).content.decode())
+        self.assertEqual(2, data["box"]["changed"])
+        self.assertEqual(3, data["box"]["returned_count"])
+
+    @override_settings(KIRPPU_CHECKOUT_IDENTITY_CACHE_TIME=0)
+    def test_query_count(self):
+        self._new_box()
+        with CaptureQueriesContext(connection) as small:
+            self.assertEqual(1, len(self._list()))
+        for _ in range(9):
+            self._new_box()
+        with CaptureQueriesContext(connection) as large:
+            self.assertEqual(10, len(self._list()))
+        self.assertEqual(len(small), len(large))
+
+
+class BoxReserveTest(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.vendor = VendorFactory()
+        self.box = Box.new(
+            vendor=self.vendor,
+            itemtype=ItemTypeFactory(),
+            name="Comic",
+            description="Box of comics",
+            price="1.50",
+            count=5,
+            bundle_size=1,
+        )
+
+        self.counter = CounterFactory()
+        self.clerk = ClerkFactory()
+        apiOK.clerk_login(self.client, {"code": self.clerk.get_code(), "counter": self.counter.identifier})
+
+        code = self.box.representative_item.code
+        self.assertEqual(202, api.item_checkin(self.client, {"code": code}).status_code)
+        self.box.refresh_from_db()
+        apiOK.box_checkin(self.client, {"code": code, "box_info": self.box.box_number})
+        apiOK.receipt_start(self.client)
+
+    def _available(self):
+        data = api.box_find(self.client, {"box_number": self.box.box_number})
+        return json.loads(data.content.decode())["available"]
+
+    def test_counts_maintained(self):
+        self.assertEqual(5, self._available())
+
+        data = json.loads(apiOK.box_item_reserve(
+            self.client, {"box_number": self.box.box_number, "box_item_count": 2}).content.decode())
+        self.assertEqual(2, data["changed"])
+        self.assertEqual(300, data["total"])
+        self.assertEqual(2, Item.objects.filter(code__in=data["item_codes"], state=Item.STAGED).count())
+        self.assertEqual(3, self._available())
+
+        counts = BoxItemCounts.objects.get(box=self.box)
+        self.assertEqual((3, 2), (counts.brought_count, counts.staged_count))
+        self.assertEqual([], BoxItemCounts.objects.verify())
+
+    def test_counts_updated_in_transaction(self):
+        self.assertEqual(5, self._available())
+        with transaction.atomic():
+            apiOK.box_item_reserve(self.client, {"box_number": self.box.box_number, "box_item_count": 2})
+            # Counts include the reservation before it is committed.
+            self.assertEqual(3, self._available())
+
+    def test_not_enough(self):
+        response = api.box_item_reserve(self.client, {"box_number": self.box.box_number, "box_item_count": 6})
+        self.assertEqual(409, response.status_code)
+        self.assertEqual(409, api.box_find(self.client, {"box_number": self.box.box_number,
+                                                         "box_item_count": 6}).status_code)
+        self.assertEqual(5, Item.objects.filter(box=self.box, state=Item.BROUGHT).count())
+
+    def test_find_does_not_count_items(self):
+        self._available()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(5, self._available())
+        self.assertFalse([query for query in queries.captured_queries
+                          if "COUNT(" in query["sql"] and '"state"' in query["sql"]])
+
+    def test_missing_counts(self):
+        BoxItemCounts.objects.filter(box=self.box).delete()
+        Item.objects.filter(pk=self.box.representative_item_id).update(state=Item.SOLD)
+        self.assertEqual(4, self._available())
+
+        Item.objects.filter(pk=self.box.representative_item_id).update(state=Item.BROUGHT)
+        self.assertEqual([(self.box.id, "brought_count", 4, 5), (self.box.id, "sold_count", 1, 0)],
+                         BoxItemCounts.objects.verify(fix=True))
+        self.assertEqual(5, self._available())
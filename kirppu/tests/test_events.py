@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+
+from django.core.cache import caches
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+
+from kirppu.events import EventBus, counter_channel, event_bus, vendor_channel
+from kirppu.models import Item, Receipt, UIText
+from kirppu.text_cache import ui_text_cache
+
+from .factories import *
+from .api_access import api, apiOK
+
+__author__ = 'codez'
+
+
+def _parse(parts):
+    """Parse SSE text parts into (id, event, data) tuples of events that have data."""
+    events = []
+    for block in "".join(parts).split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.split("\n") if line)
+        if "data" in fields:
+            events.append((int(fields["id"]), fields["event"], json.loads(fields["data"])))
+    return events
+
+
+class EventBusTest(TestCase):
+    def setUp(self):
+        caches["default"].clear()
+        self.bus = EventBus()
+        self.channel = vendor_channel(1)
+
+    def test_read(self):
+        self.assertEqual(([], 0), self.bus.read(self.channel, 0))
+        self.assertEqual(1, self.bus.publish(self.channel, "items", {"a": 1}))
+        self.assertEqual(2, self.bus.publish(self.channel, "items", {"a": 2}))
+        self.bus.publish(vendor_channel(2), "items", {"a": 3})
+
+        self.assertEqual(([(1, "items", {"a": 1}), (2, "items", {"a": 2})], 2), self.bus.read(self.channel, 0))
+        self.assertEqual(([(2, "items", {"a": 2})], 2), self.bus.read(self.channel, 1))
+        self.assertEqual(([], 2), self.bus.read(self.channel, 2))
+
+    def test_read_after_restart(self):
+        self.bus.publish(self.channel, "items", {"a": 1})
+        # Reader has seen more events than there are, so the sequence has been restarted.
+        self.assertEqual(([(1, "items", {"a": 1})], 1), self.bus.read(self.channel, 5))
+
+    def test_read_limit(self):
+        for i in range(EventBus.MAX_READ + 5):
+            self.bus.publish(self.channel, "items", i)
+        events, last = self.bus.read(self.channel, 0)
+        self.assertEqual(EventBus.MAX_READ + 5, last)
+        self.assertEqual(list(range(5, EventBus.MAX_READ + 5)), [data for _, _, data in events])
+
+    def test_stream(self):
+        self.bus.publish(self.channel, "items", {"a": 1})
+        sleeps = []
+
+        def sleep(interval):
+            sleeps.append(interval)
+            self.bus.publish(self.channel, "items", {"a": 2})
+
+        parts = list(self.bus.stream(self.channel, after=None, duration=0, interval=0.5, sleep=sleep))
+        self.assertEqual("retry: 1500\n\n", parts[0])
+        # Only events published after the stream started, and the stream ends after one read.
+        self.assertEqual([], _parse(parts))
+        self.assertEqual(["id: 1\n\n"], parts[1:])
+        self.assertEqual([], sleeps)
+
+        parts = list(self.bus.stream(self.channel, after=0, duration=0, interval=0.5, sleep=sleep))
+        self.assertEqual([(1, "items", {"a": 1})], _parse(parts))
+
+    def test_stream_duration(self):
+        def sleep(interval):
+            self.bus.publish(self.channel, "items", {"a": 1})
+            time.sleep(interval)
+
+        # Events published while the stream lasts are sent in the same response.
+        parts = list(self.bus.stream(self.channel, after=None, duration=0.05, interval=0.01, sleep=sleep))
+        events = _parse(parts)
+        self.assertGreater(len(events), 1)
+        self.assertEqual(list(range(1, len(events) + 1)), [number for number, _, _ in events])
+
+
+@override_settings(KIRPPU_EVENT_STREAM_TIME=0)
+class VendorEventsTest(TestCase):
+    def setUp(self):
+        caches["default"].clear()
+        UIText.objects.create(identifier="mobile_login", text="--enable--")
+        self.vendor = VendorFactory()
+        self.client = Client()
+        self.url = reverse("kirppu:mobile_events")
+
+    def tearDown(self):
+        ui_text_cache.invalidate()
+
+    def test_forbidden(self):
+        self.assertEqual(403, self.client.get(self.url).status_code)
+        self.client.force_login(UserFactory())
+        self.assertEqual(403, self.client.get(self.url).status_code)
+
+    def test_events(self):
+        self.client.force_login(self.vendor.user)
+        event_bus.publish(vendor_channel(self.vendor.id), "items", [{"code": "A1", "state": "SO"}])
+        event_bus.publish(vendor_channel(VendorFactory().id), "items", [{"code": "B1", "state": "SO"}])
+
+        response = self.client.get(self.url, HTTP_LAST_EVENT_ID="0")
+        self.assertEqual(200, response.status_code)
+        self.assertEqual("text/event-stream", response["Content-Type"])
+        self.assertEqual("no-cache", response["Cache-Control"])
+        events = _parse(part.decode("utf-8") for part in response.streaming_content)
+        self.assertEqual([(1, "items", [{"code": "A1", "state": "SO"}])], events)
+
+
+@override_settings(KIRPPU_EVENT_STREAM_TIME=0)
+class CounterEventsTest(TestCase):
+    def setUp(self):
+        caches["default"].clear()
+        self.client = Client()
+        self.counter = CounterFactory()
+        self.clerk = ClerkFactory()
+        self.clerk.user.is_superuser = True
+        self.clerk.user.save()
+        apiOK.clerk_login(self.client, {"code": self.clerk.get_code(), "counter": self.counter.identifier})
+
+    def test_receipt_events(self):
+        receipt = json.loads(apiOK.receipt_start(self.client).content.decode())
+        # Events are published on commit, which test transactions do not do.
+        event_bus.publish(counter_channel(self.counter.id), "receipt", {"id": receipt["id"]})
+
+        response = apiOK.events_counter(self.client, HTTP_LAST_EVENT_ID="0")
+        self.assertEqual("text/event-stream", response["Content-Type"])
+        events = _parse(part.decode("utf-8") for part in response.streaming_content)
+        self.assertEqual([(1, "receipt", {"id": receipt["id"]})], events)
+
+    def test_other_counter(self):
+        other = CounterFactory()
+        event_bus.publish(counter_channel(other.id), "receipt", {"id": 1})
+        response = apiOK.events_counter(self.client, {"counter": other.identifier}, HTTP_LAST_EVENT_ID="0")
+        events = _parse(part.decode("utf-8") for part in response.streaming_content)
+        self.assertEqual([(1, "receipt", {"id": 1})], events)
+
+        self.assertEqual(404, api.events_counter(self.client, {"counter": "nonexistent"}).status_code)
+
+
+@override_settings(KIRPPU_EVENT_STREAM_TIME=0)
+class ReceiptStatusEventsTest(TransactionTestCase):
+    def setUp(self):
+        caches["default"].clear()
+        self.client = Client()
+        self.counter = CounterFactory()
+        self.items = ItemFactory.create_batch(3, state=Item.BROUGHT)
+        apiOK.clerk_login(self.client, {"code": ClerkFactory().get_code(), "counter": self.counter.identifier})
+
+    def test_status_changes(self):
+        receipt = apiOK.receipt_start(self.client).json()
+        for item in self.items:
+            apiOK.item_reserve(self.client, {"code": item.code})
+        apiOK.item_release(self.client, {"code": self.items[0].code})
+        apiOK.receipt_finish(self.client, {"id": receipt["id"]})
+
+        events, _ = event_bus.read(counter_channel(self.counter.id), 0)
+        # Changes of the total while items are added and removed are not published.
+        self.assertEqual(
+            [(receipt["id"], Receipt.PENDING, 0),
+             (receipt["id"], Receipt.FINISHED, sum(item.price_cents for item in self.items[1:]))],
+            [(data["id"], data["status"], data["total"]) for _, _, data in events])
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import csv
+import gzip
+import io
+import json
+import os
+import shutil
+import tempfile
+
+from django.core.management import call_command
+from django.test import Client, TestCase
+from django.urls import reverse
+
+from kirppu import exports
+from kirppu.models import ItemStateLog
+
+from .factories import *
+
+__author__ = 'codez'
+
+
+class ExportTest(TestCase):
+    def setUp(self):
+        self.vendor = VendorFactory()
+        self.other = VendorFactory()
+        self.items = ItemFactory.create_batch(5, vendor=self.vendor)
+        ItemFactory.create_batch(2, vendor=self.other)
+        ItemStateLog.objects.bulk_create(
+            ItemStateLog(item=item, old_state=Item.ADVERTISED, new_state=Item.BROUGHT) for item in self.items)
+
+    def test_chunks(self):
+        ids = [row[0] for row in exports.export_rows("items", chunk_size=2)]
+        self.assertEqual(sorted(Item.objects.values_list("id", flat=True)), ids)
+        # Seven items: three full chunks and the last partial one.
+        self.assertNumQueries(4, lambda: list(exports.export_rows("items", chunk_size=2)))
+
+    def test_filters(self):
+        self.assertEqual(5, len(list(exports.export_rows("items", vendor=self.vendor.id))))
+        self.assertEqual(5, len(list(exports.export_rows("logs", vendor=self.vendor.id))))
+        self.assertEqual(0, len(list(exports.export_rows("logs", vendor=self.other.id))))
+        self.assertEqual(0, len(list(exports.export_rows("logs", start=exports.parse_time("2999-01-01")))))
+        self.assertEqual(5, len(list(exports.export_rows("logs", end=exports.parse_time("2999-01-01T12:00")))))
+        self.assertRaises(ValueError, exports.export_rows, "items", start=exports.parse_time("2000-01-01"))
+        self.assertRaises(ValueError, exports.parse_time, "yesterday")
+
+    def test_formats(self):
+        rows = list(exports.export_rows("logs"))
+        lines = list(csv.reader("".join(exports.csv_lines(exports.EXPORTS["logs"].columns, rows)).splitlines()))
+        self.assertEqual(list(exports.EXPORTS["logs"].columns), lines[0])
+        self.assertEqual(self.items[0].code, lines[1][2])
+
+        ndjson = "".join(exports.ndjson_lines(exports.EXPORTS["logs"].columns, rows))
+        objects = [json.loads(line) for line in ndjson.splitlines()]
+        self.assertEqual(5, len(objects))
+        self.assertEqual(Item.BROUGHT, objects[0]["new_state"])
+
+    def test_view(self):
+        client = Client()
+        url = reverse("kirppu:export", kwargs={"name": "items", "ext": "ndjson", "gz": ".gz"})
+        self.assertEqual(302, client.get(url).status_code)
+
+        user = UserFactory(is_staff=True)
+        user.set_password("pw")
+        user.save()
+        client.login(username=user.username, password="pw")
+
+        response = client.get(url, {"vendor": self.other.id})
+        self.assertEqual("application/gzip", response["Content-Type"])
+        content = gzip.GzipFile(fileobj=io.BytesIO(b"".join(response.streaming_content))).read()
+        self.assertEqual(2, len(content.decode("utf-8").splitlines()))
+
+        self.assertEqual(400, client.get(url, {"start": "2000-01-01"}).status_code)
+
+    def test_command(self):
+        out = io.StringIO()
+        call_command("export_data", "receipts", stdout=out)
+        self.assertEqual(list(exports.EXPORTS["receipts"].columns), out.getvalue().strip().split(","))
+
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "logs.ndjson.gz")
+            call_command("export_data", "logs", format="ndjson", output=path, gzip=True, chunk_size=2)
+            with gzip.open(path, "rb") as f:
+                self.assertEqual(5, len(f.read().splitlines()))
+        finally:
+            shutil.rmtree(directory)
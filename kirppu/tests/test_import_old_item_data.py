@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+from decimal import Decimal
+import io
+import os
+import shutil
+import tempfile
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+
+from kirppu.management.commands.import_old_item_data import PostgreDumpParser, typed_rows
+from kirppu.models import ItemStateBucket, ItemStateLog, VendorLedger
+from kirppuauth.models import User
+
+from .factories import *
+
+__author__ = 'codez'
+
+DUMP = """--
+-- PostgreSQL database dump
+--
+
+COPY kirppu_item (id, code, name, price, type, itemtype, adult, hidden, printed, abandoned, lost_property, \
+box_id, vendor_id) FROM stdin;
+10\tA1\tFirst\t1.50\tshort\tother\tno\tf\tt\tf\tf\t\\N\t3
+11\tA2\tSecond\t2.00\tlong\tother\tyes\tf\tf\tf\tf\t\\N\t3
+12\tA3\tThird\t0.50\tshort\tother\tno\tt\tf\tf\tf\t\\N\t4
+\\.
+
+COPY kirppu_vendor (id, user_id, terms_accepted) FROM stdin;
+3\t7\t2016-01-01 10:00:00+02
+4\t8\t\\N
+\\.
+
+COPY kirppuauth_user (id, password, last_login, is_superuser, username, first_name, last_name, email, \
+is_staff, is_active, date_joined, phone, last_checked) FROM stdin;
+7\tx\t\\N\tf\told_one\tOld\tOne\tone@example.com\tf\tt\t2016-01-01 10:00:00+02\t123\t2016-01-01 10:00:00+02
+8\tx\t\\N\tf\told_two\tOld\tTwo\ttwo@example.com\tf\tt\t2016-01-01 10:00:00+02\t456\t2016-01-01 10:00:00+02
+\\.
+"""
+
+
+class ImportOldItemDataTest(TestCase):
+    def setUp(self):
+        ItemTypeFactory(key="other")
+        # Existing user gets the items of the old vendor with same username.
+        self.existing = VendorFactory(user__username="old_two")
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "dump.sql")
+        with io.open(self.path, "w") as f:
+            f.write(DUMP)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_parser(self):
+        blocks = []
+        for table, rows in PostgreDumpParser(io.StringIO(DUMP)).blocks():
+            if table == "kirppu_vendor":
+                blocks.append((table, list(typed_rows(table, rows))))
+            else:
+                blocks.append((table, None))
+        self.assertEqual(["kirppu_item", "kirppu_vendor", "kirppuauth_user"], [table for table, _ in blocks])
+        self.assertEqual([3, 4], [row["id"] for row in blocks[1][1]])
+        self.assertIsNone(blocks[1][1][1]["terms_accepted"])
+
+    def test_import(self):
+        out = io.StringIO()
+        call_command("import_old_item_data", self.path, batch_size=2, stdout=out)
+        self.assertIn("Imported kirppu_item: 3", out.getvalue())
+
+        one = Vendor.objects.get(user__username="old_one")
+        self.assertEqual(["A1", "A2"], sorted(one.item_set.values_list("code", flat=True)))
+        self.assertEqual(["A3"], list(self.existing.item_set.values_list("code", flat=True)))
+        self.assertTrue(Item.objects.get(code="A3").hidden)
+        self.assertEqual({"other"}, set(Item.objects.values_list("itemtype__key", flat=True)))
+
+    def test_import_records_items(self):
+        call_command("import_old_item_data", self.path, batch_size=2, stdout=io.StringIO())
+
+        self.assertEqual(3, ItemStateLog.objects.filter(old_state="", new_state=Item.ADVERTISED).count())
+        bucket = ItemStateBucket.objects.get(old_state="", new_state=Item.ADVERTISED)
+        self.assertEqual((3, Decimal("4.00")), (bucket.count, bucket.price))
+        # Advertised items have no ledger values, but the ledgers must agree with the items.
+        self.assertEqual([], VendorLedger.objects.verify())
+
+    def test_unknown_item_type(self):
+        with io.open(self.path, "w") as f:
+            f.write(DUMP.replace("\tlong\tother\t", "\tlong\tmissing\t"))
+        with self.assertRaisesMessage(CommandError, "Item 11 has unknown item type missing."):
+            call_command("import_old_item_data", self.path, stdout=io.StringIO())
+        self.assertEqual(0, Item.objects.count())
+
+    def test_dry_run(self):
+        out = io.StringIO()
+        call_command("import_old_item_data", self.path, dry_run=True, stdout=out)
+        self.assertIn("Would import kirppu_item: 3", out.getvalue())
+        self.assertFalse(User.objects.filter(username="old_one").exists())
+        self.assertEqual(0, Item.objects.count())
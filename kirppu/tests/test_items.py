@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+import random
+import threading
+import time
+
+from django.db import OperationalError, connection, connections, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from kirppu.item_codes import ItemCodeAllocator, item_codes
+from kirppu.models import Box, ItemStateLog, Sequence
+from kirppu.util import b32_decode, unpack
+
+from .factories import *
+
+__author__ = 'codez'
+
+
+class BulkItemCreationTest(TestCase):
+    def setUp(self):
+        self.vendor = VendorFactory()
+        self.item_type = ItemTypeFactory()
+
+    def _new_box(self, count):
+        return Box.new(
+            vendor=self.vendor,
+            itemtype=self.item_type,
+            name="Box",
+            description="Box of things",
+            price="1.50",
+            count=count,
+            bundle_size=1,
+        )
+
+    def test_new_many(self):
+        items = Item.new_many([
+            dict(name="Item {}".format(i), price="2.00", vendor=self.vendor, itemtype=self.item_type)
+            for i in range(5)
+        ])
+
+        self.assertEqual(["Item {}".format(i) for i in range(5)], [item.name for item in items])
+        self.assertEqual(5, len({item.code for item in items}))
+        stored = Item.objects.in_bulk([item.pk for item in items])
+        for item in items:
+            self.assertEqual(item.code, stored[item.pk].code)
+            self.assertTrue(Item.is_item_barcode(item.code))
+        self.assertEqual(5, ItemStateLog.objects.filter(item__in=items, new_state=Item.ADVERTISED).count())
+
+    def test_box_queries(self):
+        with CaptureQueriesContext(connection) as small:
+            self._new_box(2)
+        with CaptureQueriesContext(connection) as large:
+            box = self._new_box(200)
+
+        # Queries do not depend on item count. Creating new state buckets may add a few.
+        self.assertLess(len(large) - len(small), 5)
+        self.assertEqual(200, box.get_items().count())
+        self.assertEqual(200, Item.objects.filter(box=box).values("code").distinct().count())
+        self.assertEqual(200, ItemStateLog.objects.filter(item__box=box).count())
+
+
+class BoxNumberTest(TestCase):
+    def setUp(self):
+        self.vendor = VendorFactory()
+        self.item_type = ItemTypeFactory()
+
+    def _new_box(self):
+        return Box.new(
+            vendor=self.vendor,
+            itemtype=self.item_type,
+            name="Box",
+            description="Box of things",
+            price="1.50",
+            count=1,
+            bundle_size=1,
+        )
+
+    def test_assign(self):
+        boxes = [self._new_box() for _ in range(3)]
+        for box in boxes:
+            box.assign_box_number()
+        boxes[0].assign_box_number()
+        self.assertEqual([1, 2, 3], [box.box_number for box in boxes])
+        self.assertEqual([1, 2, 3], sorted(Box.objects.values_list("box_number", flat=True)))
+
+    def test_stale_instance(self):
+        box = self._new_box()
+        stale = Box.objects.get(pk=box.pk)
+        box.assign_box_number()
+        stale.assign_box_number()
+        self.assertEqual(box.box_number, stale.box_number)
+        self.assertEqual(2, Sequence.objects.allocate(Box.BOX_NUMBER_SEQUENCE))
+
+    def test_missing_sequence(self):
+        box = self._new_box()
+        Box.objects.filter(pk=box.pk).update(box_number=41)
+        Sequence.objects.filter(name=Box.BOX_NUMBER_SEQUENCE).delete()
+
+        box = self._new_box()
+        box.assign_box_number()
+        self.assertEqual(42, box.box_number)
+        self.assertEqual(43, Sequence.objects.allocate(Box.BOX_NUMBER_SEQUENCE, count=5))
+        self.assertEqual(48, Sequence.objects.allocate(Box.BOX_NUMBER_SEQUENCE))
+
+    def test_no_scan(self):
+        box = self._new_box()
+        with CaptureQueriesContext(connection) as queries:
+            box.assign_box_number()
+        self.assertFalse([query for query in queries.captured_queries if "MAX(" in query["sql"]])
+
+
+class BoxNumberConcurrencyTest(TransactionTestCase):
+    BOXES = 1000
+    THREADS = 4
+    ATTEMPTS = 1000
+
+    def _new_boxes(self):
+        vendor = VendorFactory()
+        items = Item.new_many([
+            dict(name="Box", price="1.50", vendor=vendor, itemtype=ItemTypeFactory())
+            for _ in range(self.BOXES)
+        ])
+        Box.objects.bulk_create([Box(description="Box", representative_item=item) for item in items])
+        return list(Box.objects.values_list("pk", flat=True))
+
+    def _assign(self, pk):
+        for _ in range(self.ATTEMPTS):
+            try:
+                return Box.objects.get(pk=pk).assign_box_number()
+            except OperationalError:
+                # SQLite has one writer at a time, and fails instead of waiting a writer that has read
+                # in its transaction. Numbers of the failed transaction are released, so try again.
+                time.sleep(random.random() * 0.01)
+        raise AssertionError("Box {} was not assigned a number.".format(pk))
+
+    def _check_in(self, ids, errors):
+        try:
+            for pk in ids:
+                self._assign(pk)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            connections.close_all()
+
+    def test_parallel_check_in(self):
+        box_ids = self._new_boxes()
+        errors = []
+        threads = [
+            threading.Thread(target=self._check_in, args=(box_ids[i::self.THREADS], errors))
+            for i in range(self.THREADS)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([], errors)
+        self.assertEqual(list(range(1, self.BOXES + 1)),
+                         sorted(Box.objects.values_list("box_number", flat=True)))
+
+
+class ItemCodeTest(TestCase):
+    def _check(self, allocator, numbers, data_bits=36):
+        codes = [allocator.code(number) for number in numbers]
+        self.assertEqual(len(numbers), len(set(codes)))
+        for code in codes:
+            self.assertTrue(Item.is_item_barcode(code), code)
+            # Raises InvalidChecksum if the checksum is wrong.
+            value, = unpack(b32_decode(code), [data_bits], checksum_bits=4)
+            self.assertNotEqual(0, value)
+        return codes
+
+    def test_whole_space(self):
+        # All numbers of a narrow code map to different non-zero values.
+        allocator = ItemCodeAllocator(code_bits=14)
+        codes = self._check(allocator, range(1, 2 ** 10), data_bits=10)
+        self.assertNotEqual(sorted(codes), codes)
+        with self.assertRaises(OverflowError):
+            allocator.code(2 ** 10)
+
+    def test_random_numbers(self):
+        rng = random.Random(25)
+        allocator = ItemCodeAllocator()
+        self._check(allocator, range(1, 2001))
+        self._check(allocator, rng.sample(range(1, 2 ** 36), 5000))
+        self.assertEqual(allocator.code(123), ItemCodeAllocator().code(123))
+
+    def test_key(self):
+        code = ItemCodeAllocator().code(123)
+        with override_settings(SECRET_KEY="changed"):
+            self.assertEqual(code, ItemCodeAllocator().code(123))
+        with override_settings(KIRPPU_ITEM_CODE_KEY="changed"):
+            self.assertNotEqual(code, ItemCodeAllocator().code(123))
+
+    def test_existence_check(self):
+        with CaptureQueriesContext(connection) as queries:
+            codes = Item.gen_barcodes(Item.BULK_BATCH_SIZE + 1)
+        self.assertEqual(Item.BULK_BATCH_SIZE + 1, len(set(codes)))
+        self.assertEqual(2, len([query for query in queries.captured_queries if "kirppu_item" in query["sql"]]))
+
+    def test_used_code_skipped(self):
+        item = ItemFactory()
+        number = Sequence.objects.get(name=ItemCodeAllocator.SEQUENCE).value + 1
+        # Item of an older code scheme has the code of the next number.
+        Item.objects.filter(pk=item.pk).update(code=item_codes.code(number))
+        self.assertEqual([item_codes.code(n) for n in range(number + 1, number + 4)], Item.gen_barcodes(3))
+
+
+@override_settings(KIRPPU_ITEM_CODE_BLOCK=10)
+class ItemCodeBlockTest(TransactionTestCase):
+    def _sequence(self):
+        return Sequence.objects.filter(name=ItemCodeAllocator.SEQUENCE).values_list("value", flat=True).first()
+
+    def test_blocks(self):
+        allocator = ItemCodeAllocator()
+        first = allocator.allocate(3)
+        self.assertEqual(10, self._sequence())
+        with CaptureQueriesContext(connection) as queries:
+            allocator.allocate(7)
+        self.assertFalse([query for query in queries.captured_queries if "kirppu_sequence" in query["sql"]])
+
+        codes = first + allocator.allocate(12)
+        self.assertEqual(22, self._sequence())
+        self.assertEqual(15, len(set(codes)))
+        self.assertEqual([allocator.code(n) for n in range(1, 4)] + [allocator.code(n) for n in range(11, 23)], codes)
+
+    def test_rollback(self):
+        allocator = ItemCodeAllocator()
+        allocator.allocate(8)
+        with transaction.atomic():
+            # Without row locks, remaining numbers of the block are used, the rest are allocated in the transaction.
+            codes = allocator.allocate(5)
+            self.assertEqual(13, self._sequence())
+            transaction.set_rollback(True)
+        self.assertEqual(10, self._sequence())
+        self.assertEqual([allocator.code(n) for n in (9, 10, 11, 12, 13)], codes)
+        self.assertEqual([allocator.code(n) for n in range(11, 14)], allocator.allocate(3))
+
+    def test_rollback_separate_connection(self):
+        allocator = ItemCodeAllocator()
+        allocator.allocate(8)
+        # The block is reserved with another connection on databases with row locks.
+        connection.features.has_select_for_update = True
+        try:
+            with transaction.atomic():
+                codes = allocator.allocate(5)
+                transaction.set_rollback(True)
+        finally:
+            del connection.features.has_select_for_update
+        self.assertEqual(20, self._sequence())
+        self.assertEqual([allocator.code(n) for n in (9, 10, 11, 12, 13)], codes)
+        self.assertEqual([allocator.code(n) for n in range(14, 17)], allocator.allocate(3))
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+import random
+
+from django.test import TestCase
+
+from kirppu.loadtest import LoadTest, seed
+from kirppu.models import Item, Receipt
+
+__author__ = 'codez'
+
+
+class LoadTestTest(TestCase):
+    def test_event_day(self):
+        rng = random.Random(1)
+        dataset = seed("load", vendors=2, items=5, boxes=1, box_size=3, stations=1, rng=rng)
+        result = LoadTest(dataset, host="testserver", sell_ratio=0.6, receipt_size=2, rng=rng).run()
+
+        summary = {row[0]: row for row in result.summary()}
+        for name in ("clerk_login", "item_checkin", "box_checkin", "receipt_start", "item_reserve",
+                     "receipt_finish", "item_checkout", "item_compensate"):
+            self.assertIn(name, summary)
+        for row in summary.values():
+            self.assertEqual(0, row[4], row)
+
+        self.assertEqual(6, summary["item_reserve"][1])
+        self.assertEqual(6, Item.objects.filter(state=Item.COMPENSATED).count())
+        self.assertEqual(0, Item.objects.filter(state__in=(Item.ADVERTISED, Item.BROUGHT)).exclude(
+            box__isnull=False).count())
+        self.assertEqual(0, Receipt.objects.filter(status=Receipt.PENDING).count())
+        self.assertIn("p95 ms", result.report())
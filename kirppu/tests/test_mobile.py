@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+from django.db import connection
+from django.test import Client, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from kirppu.models import UIText
+from kirppu.text_cache import ui_text_cache
+
+from .factories import *
+
+__author__ = 'codez'
+
+
+class VendorStatusTest(TestCase):
+    def setUp(self):
+        UIText.objects.create(identifier="mobile_login", text="--enable--")
+        self.vendor = VendorFactory()
+        self.items = ItemFactory.create_batch(3, vendor=self.vendor, state=Item.BROUGHT)
+        self.client = Client()
+        self.client.force_login(self.vendor.user)
+        self.url = reverse("kirppu:mobile")
+
+    def tearDown(self):
+        ui_text_cache.invalidate()
+
+    def test_not_modified(self):
+        response = self.client.get(self.url)
+        self.assertEqual(200, response.status_code)
+        etag = response["ETag"]
+        self.assertIn(self.items[0].code, response.content.decode("utf-8"))
+
+        with CaptureQueriesContext(connection) as cached:
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+        self.assertFalse([query for query in cached.captured_queries if "kirppu_item" in query["sql"]])
+
+        text = self.client.get(self.url, {"type": "txt"})
+        self.assertNotEqual(etag, text["ETag"])
+        self.assertEqual(304, self.client.get(self.url, {"type": "txt"}, HTTP_IF_NONE_MATCH=text["ETag"]).status_code)
+
+    def test_invalidated(self):
+        etag = self.client.get(self.url)["ETag"]
+        item = self.items[0]
+        item.state = Item.SOLD
+        item.save()
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(etag, response["ETag"])
+        self.assertEqual(["compensable", "returnable"], sorted(
+            key for key, table in response.context["tables"].items() if table.items))
+
+    def test_other_vendor(self):
+        etag = self.client.get(self.url)["ETag"]
+        ItemFactory(vendor=VendorFactory())
+        self.assertEqual(304, self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code)
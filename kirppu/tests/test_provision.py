@@ -1,11 +1,18 @@
 # -*- coding: utf-8 -*-
+import contextlib
 import decimal
+from unittest import skipUnless
 
+from django.db import connection
 from django.test import Client
 from django.test import TestCase
 from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 
-from kirppu.provision import Provision
+from kirppu.models import VendorLedger
+from kirppu.provision import Provision, batch_provisions, prices_provision
+from kirppu import provision_arrays
+from kirppu.provision_arrays import PercentageProvision, price_arrays
 
 from .factories import *
 from .api_access import apiOK
@@ -13,6 +20,15 @@ from .api_access import apiOK
 __author__ = 'codez'
 
 
+@contextlib.contextmanager
+def _numpy(module):
+    original, provision_arrays.numpy = provision_arrays.numpy, module
+    try:
+        yield
+    finally:
+        provision_arrays.numpy = original
+
+
 class SoldItemFactory(ItemFactory):
     state = Item.SOLD
 
@@ -333,3 +349,158 @@ class ApiProvisionTest(TestCase):
         self.assertEqual(receipt_2["total"], 400)
 # [<-needed for ide-region]
     # endregion
+
+
+class VendorLedgerTest(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.vendor = VendorFactory()
+        self.items = ItemFactory.create_batch(4, vendor=self.vendor, state=Item.BROUGHT)
+
+        self.counter = CounterFactory()
+        self.clerk = ClerkFactory()
+        apiOK.clerk_login(self.client, {"code": self.clerk.get_code(), "counter": self.counter.identifier})
+
+    def _ledger(self):
+        return VendorLedger.objects.get(vendor=self.vendor)
+
+    def _sell(self, items):
+        receipt = apiOK.receipt_start(self.client).json()
+        for item in items:
+            apiOK.item_reserve(self.client, {"code": item.code})
+        apiOK.receipt_finish(self.client, {"id": receipt["id"]})
+
+    @override_settings(KIRPPU_POST_PROVISION=lambda query: Decimal("0.10") * len(query))
+    def test_maintained(self):
+        self._sell(self.items[:3])
+        ledger = self._ledger()
+        self.assertEqual((3, Decimal("3.75")), (ledger.sold_count, ledger.sold_sum))
+
+        apiOK.item_compensate_start(self.client, {"vendor": self.vendor.id})
+        for item in self.items[:2]:
+            apiOK.item_compensate(self.client, {"code": item.code})
+        apiOK.item_compensate_end(self.client)
+
+        ledger = self._ledger()
+        self.assertEqual((1, Decimal("1.25")), (ledger.sold_count, ledger.sold_sum))
+        self.assertEqual((2, Decimal("2.50")), (ledger.compensated_count, ledger.compensated_sum))
+        self.assertEqual(Decimal("-0.20"), ledger.provisions)
+        self.assertEqual([], VendorLedger.objects.verify())
+
+    def test_verify(self):
+        self._sell(self.items[:1])
+        Item.objects.filter(pk=self.items[1].pk).update(state=Item.SOLD)
+
+        self.assertEqual([
+            (self.vendor.id, "sold_count", 1, 2),
+            (self.vendor.id, "sold_sum", Decimal("1.25"), Decimal("2.50")),
+        ], VendorLedger.objects.verify(fix=True))
+        self.assertEqual([], VendorLedger.objects.verify())
+        self.assertEqual(2, self._ledger().sold_count)
+
+    def test_missing_ledger_created_items(self):
+        VendorLedger.objects.filter(vendor=self.vendor).delete()
+        Item.new_many([
+            dict(name="Sold", price="2.00", vendor=self.vendor, itemtype=self.items[0].itemtype, state=Item.SOLD)
+            for _ in range(2)
+        ])
+        self.assertEqual((2, Decimal("4.00")), (self._ledger().sold_count, self._ledger().sold_sum))
+
+        VendorLedger.objects.filter(vendor=self.vendor).delete()
+        ItemFactory(vendor=self.vendor, state=Item.SOLD, price=Decimal("1.00"))
+        self.assertEqual((3, Decimal("5.00")), (self._ledger().sold_count, self._ledger().sold_sum))
+        self.assertEqual([], VendorLedger.objects.verify())
+
+
+class PriceArrayProvisionTest(TestCase):
+    def setUp(self):
+        self.vendors = VendorFactory.create_batch(3)
+        self.item_type = ItemTypeFactory()
+        for count, vendor in enumerate(self.vendors):
+            SoldItemFactory.create_batch(count + 3, vendor=vendor, itemtype=self.item_type, price=Decimal("2.00"))
+            ItemFactory.create_batch(2, vendor=vendor, itemtype=self.item_type, state=Item.COMPENSATED)
+            ItemFactory(vendor=vendor, itemtype=self.item_type, state=Item.BROUGHT)
+
+    def test_same_as_query_function(self):
+        by_query = {
+            vendor.id: Provision(vendor.id, provision_function=lambda q: Decimal("0.10") * len(q)).provision
+            for vendor in self.vendors
+        }
+        by_prices = {
+            vendor.id: Provision(vendor.id, provision_function=prices_provision(
+                lambda prices, item_types: Decimal("0.10") * len(prices))).provision
+            for vendor in self.vendors
+        }
+        self.assertEqual(by_query, by_prices)
+
+    def test_batch(self):
+        function = PercentageProvision(10, step="0.50")
+        with self.assertNumQueries(1):
+            provisions = batch_provisions(function)
+
+        self.assertEqual({vendor.id for vendor in self.vendors}, set(provisions))
+        for vendor in self.vendors:
+            self.assertEqual(
+                Provision(vendor.id, provision_function=prices_provision(function))._provision,
+                provisions[vendor.id])
+        # 3 * 2.00 + 2 * 1.25 = 8.50, 10% rounded up to 0.50.
+        self.assertEqual(Decimal("1.00"), provisions[self.vendors[0].id])
+
+        self.assertEqual([self.vendors[1].id], list(batch_provisions(function, vendor_ids=[self.vendors[1].id])))
+
+    def _by_ledger_and_query(self, function):
+        def query_function(items):
+            return function(*price_arrays(items.values_list("price", "itemtype_id")))
+
+        with CaptureQueriesContext(connection) as queries:
+            provisions = [Provision(vendor.id, provision_function=prices_provision(function))
+                          for vendor in self.vendors]
+            by_ledger = [(p.provision, p.provision_fix) for p in provisions]
+        provisions = [Provision(vendor.id, provision_function=query_function) for vendor in self.vendors]
+        by_query = [(p.provision, p.provision_fix) for p in provisions]
+        self.assertEqual(by_query, by_ledger)
+        return [query for query in queries.captured_queries if '"kirppu_item"' in query["sql"]]
+
+    def test_from_ledger(self):
+        self.assertEqual([], self._by_ledger_and_query(PercentageProvision(10, step="0.50")))
+
+    def test_item_types_from_items(self):
+        self.assertNotEqual([], self._by_ledger_and_query(PercentageProvision(10, item_types=[self.item_type.id])))
+
+    @override_settings(KIRPPU_POST_PROVISION_PRICES=PercentageProvision(10))
+    def test_setting(self):
+        vendor = self.vendors[0]
+        client = Client()
+        clerk = ClerkFactory()
+        apiOK.clerk_login(client, {"code": clerk.get_code(), "counter": CounterFactory().identifier})
+
+        guess = apiOK.compensable_items(client, {"vendor": vendor.id}).json()["extras"]
+        # 10% of 8.50, minus 10% of already compensated 2.50.
+        self.assertEqual([-60], [extra["value"] for extra in guess if extra["type"] == "PRO"])
+
+
+class PriceArrayImplementationTest(TestCase):
+    ROWS = [(2, Decimal("1.50"), 1), (1, Decimal("2.00"), 2), (2, Decimal("0.50"), 2), (1, Decimal("10.00"), 1)]
+
+    def _results(self):
+        groups = provision_arrays.group_by_vendor(self.ROWS)
+        everything = provision_arrays.PercentageProvision(10, step="0.50")
+        type_2 = provision_arrays.PercentageProvision(50, item_types=[2])
+        return (
+            sorted((vendor, list(prices), list(types)) for vendor, (prices, types) in groups.items()),
+            {vendor: (everything(*arrays), type_2(*arrays)) for vendor, arrays in groups.items()},
+            everything(*provision_arrays.price_arrays([])),
+        )
+
+    def test_pure_python(self):
+        with _numpy(None):
+            groups, provisions, empty = self._results()
+        self.assertEqual([(1, [200, 1000], [2, 1]), (2, [150, 50], [1, 2])], groups)
+        self.assertEqual({1: (Decimal("1.50"), Decimal("1.00")), 2: (Decimal("0.50"), Decimal("0.25"))}, provisions)
+        self.assertEqual(Decimal("0.00"), empty)
+
+    @skipUnless(provision_arrays.numpy is not None, "NumPy is not installed")
+    def test_numpy_same_as_pure_python(self):
+        with _numpy(None):
+            expected = self._results()
+        self.assertEqual(expected, self._results())
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import csv
+import json
+
+from django.test import Client, TestCase, override_settings
+from django.urls import reverse
+
+from kirppu.provision import Provision
+from kirppu.provision_arrays import PercentageProvision
+from kirppu.settlement import COLUMNS, settlement_rows, stream_csv
+
+from .factories import *
+from .api_access import apiOK
+
+__author__ = 'codez'
+
+
+@override_settings(KIRPPU_POST_PROVISION_PRICES=PercentageProvision(10, step="0.50"))
+class SettlementTest(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.item_type = ItemTypeFactory()
+        self.vendor = VendorFactory(user__first_name="Matti", user__last_name="Myyjä")
+        self.idle = VendorFactory()
+        self.items = ItemFactory.create_batch(6, vendor=self.vendor, itemtype=self.item_type, state=Item.SOLD)
+        ItemFactory(vendor=self.vendor, itemtype=self.item_type, state=Item.BROUGHT, abandoned=True)
+
+        counter = CounterFactory()
+        clerk = ClerkFactory()
+        apiOK.clerk_login(self.client, {"code": clerk.get_code(), "counter": counter.identifier})
+        apiOK.item_compensate_start(self.client, {"vendor": self.vendor.id})
+        for item in self.items[:2]:
+            apiOK.item_compensate(self.client, {"code": item.code})
+        apiOK.item_compensate_end(self.client)
+        apiOK.clerk_logout(self.client)
+
+    def _rows(self):
+        return {row["vendor_id"]: row for row in settlement_rows()}
+
+    def test_totals(self):
+        row = self._rows()[self.vendor.id]
+        self.assertEqual("Matti Myyjä", row["name"])
+        self.assertEqual((6, Decimal("7.50")), (row["sold_count"], row["sold_sum"]))
+        self.assertEqual((2, Decimal("2.50")), (row["compensated_count"], row["compensated_sum"]))
+        self.assertEqual((4, Decimal("5.00")), (row["unpaid_count"], row["unpaid_sum"]))
+        self.assertEqual((1, Decimal("1.25")), (row["abandoned_count"], row["abandoned_sum"]))
+        # 10% of 7.50 rounded up to 0.50, of which 10% of 2.50 was charged in the compensation.
+        self.assertEqual(Decimal("-1.00"), row["provision"])
+        self.assertEqual(Decimal("-0.50"), row["provision_charged"])
+        self.assertEqual(Decimal("4.50"), row["payable"])
+
+        idle = self._rows()[self.idle.id]
+        self.assertEqual((0, Decimal(0), Decimal(0)), (idle["sold_count"], idle["provision"], idle["payable"]))
+
+    def test_matches_compensation(self):
+        # Paying the rest gives the payable amount.
+        row = self._rows()[self.vendor.id]
+        provision = Provision(self.vendor.id)
+        self.assertEqual(row["payable"], provision.provision + provision.provision_fix + row["unpaid_sum"])
+
+    def test_query_count(self):
+        with self.assertNumQueries(4):
+            small = list(settlement_rows())
+        for _ in range(10):
+            ItemFactory(vendor=VendorFactory(), itemtype=self.item_type, state=Item.SOLD)
+        with self.assertNumQueries(4):
+            large = list(settlement_rows())
+        self.assertEqual(len(small) + 10, len(large))
+
+    def test_csv(self):
+        lines = list(csv.reader("".join(stream_csv(settlement_rows())).splitlines()))
+        self.assertEqual(list(COLUMNS), lines[0])
+        self.assertEqual(3, len(lines))
+
+    def test_view(self):
+        url = reverse("kirppu:settlement_report", kwargs={"ext": "json"})
+        self.assertEqual(302, self.client.get(url).status_code)
+
+        user = UserFactory(is_staff=True)
+        user.set_password("pw")
+        user.save()
+        self.client.login(username=user.username, password="pw")
+        response = self.client.get(url)
+        self.assertTrue(response.streaming)
+        data = json.loads(b"".join(response.streaming_content).decode("utf-8"))
+        self.assertEqual([self.vendor.id, self.idle.id], [row["vendor_id"] for row in data])
+        self.assertEqual("4.50", data[0]["payable"])
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import time
+from unittest import skipUnless
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import Client
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from kirppu import stats
+from kirppu.models import ItemStateBucket, ItemStateBucketManager
+
+from .factories import *
+from .api_access import apiOK
+
+__author__ = 'codez'
+
+
+class StateBucketTest(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.vendor = VendorFactory()
+        self.item_type = ItemTypeFactory()
+        self.items = [
+            Item.new(name="Item {}".format(i), price=Decimal("1.25"), vendor=self.vendor, itemtype=self.item_type)
+            for i in range(3)
+        ]
+
+        self.counter = CounterFactory()
+        self.clerk = ClerkFactory()
+        apiOK.clerk_login(self.client, {"code": self.clerk.get_code(), "counter": self.counter.identifier})
+
+    def _buckets(self):
+        return sorted(ItemStateBucket.objects.values_list("itemtype", "old_state", "new_state", "count", "price"))
+
+    def test_buckets_follow_state_changes(self):
+        for item in self.items:
+            apiOK.item_checkin(self.client, {"code": item.code})
+
+        registered = self._buckets()
+        self.assertIn((self.item_type.pk, "", Item.ADVERTISED, 3, Decimal("3.75")), registered)
+        self.assertIn((self.item_type.pk, Item.ADVERTISED, Item.BROUGHT, 3, Decimal("3.75")), registered)
+
+    def test_rebuild_matches_incremental(self):
+        for item in self.items:
+            apiOK.item_checkin(self.client, {"code": item.code})
+        apiOK.item_checkout(self.client, {"code": self.items[0].code})
+
+        incremental = self._buckets()
+        ItemStateBucket.objects.rebuild()
+        self.assertEqual(incremental, self._buckets())
+
+    def test_sales_data(self):
+        # Put all changes in one bucket, even if the test runs across a minute boundary.
+        bucket_time = ItemStateBucketManager.bucket_time
+        start = timezone.now()
+        ItemStateBucketManager.bucket_time = staticmethod(lambda time: bucket_time(start))
+        try:
+            for item in self.items:
+                apiOK.item_checkin(self.client, {"code": item.code})
+        finally:
+            ItemStateBucketManager.bucket_time = staticmethod(bucket_time)
+
+        lines = list(stats.iterate_logs(stats.SalesData()))
+        # Zero line before the first bucket, and single bucket for all changes.
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].endswith(",0,0,0,0\n"))
+        self.assertTrue(lines[1].endswith(",3,3,0,0\n"))
+
+        lines = list(stats.iterate_logs(stats.SalesData(as_prices=True)))
+        self.assertTrue(lines[1].endswith(",3.75,3.75,0,0\n"))
+
+    def _balance(self, using):
+        lines = list(stats.iterate_logs(using))
+        return lines[-1].split(",")[1:] if lines else []
+
+    def test_price_changes_balance(self):
+        self.clerk.user.is_superuser = True
+        self.clerk.user.save()
+        apiOK.item_edit(self.client, {"code": self.items[0].code, "price": "2.50", "state": Item.ADVERTISED})
+        self.assertEqual(["5.00\n"], self._balance(stats.RegistrationData(as_prices=True)))
+
+        for item in self.items:
+            apiOK.item_checkin(self.client, {"code": item.code})
+        apiOK.item_edit(self.client, {"code": self.items[1].code, "price": "1.00", "state": Item.BROUGHT})
+        self.assertEqual(["4.75", "4.75", "0", "0\n"], self._balance(stats.SalesData(as_prices=True)))
+
+        receipt = json.loads(apiOK.receipt_start(self.client).content.decode())
+        apiOK.item_reserve(self.client, {"code": self.items[1].code})
+        apiOK.receipt_finish(self.client, {"id": receipt["id"]})
+        self.assertEqual(["4.75", "3.75", "1.00", "0\n"], self._balance(stats.SalesData(as_prices=True)))
+
+        # Item leaves its state with the price it entered it with.
+        apiOK.item_edit(self.client, {"code": self.items[1].code, "price": "3.00", "state": Item.BROUGHT})
+        self.assertEqual(["6.75", "6.75", "0.00", "0\n"], self._balance(stats.SalesData(as_prices=True)))
+
+
+class ItemStatisticsTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.item_types = [ItemTypeFactory(), ItemTypeFactory()]
+        self.vendors = [VendorFactory(), VendorFactory()]
+        for vendor in self.vendors:
+            for item_type in self.item_types:
+                ItemFactory.create_batch(2, vendor=vendor, itemtype=item_type, state=Item.BROUGHT)
+                ItemFactory(vendor=vendor, itemtype=item_type, state=Item.SOLD, price=Decimal("2.50"))
+                ItemFactory(vendor=vendor, itemtype=item_type, state=Item.RETURNED, abandoned=True)
+
+    def _rows(self, data):
+        rows = []
+        for key in data.keys():
+            row = data.data_set(key, str(key))
+            # The sum row of item types has no abandoned values.
+            rows.append((key, list(row.property_values), list(row.abandoned) if key != "sum" else None))
+        return rows
+
+    def test_matches_separate_queries(self):
+        statistics = stats.ItemStatistics.get()
+        for group_by in stats.ItemStatistics.GROUPS:
+            self.assertEqual(self._rows(stats.ItemCountData(group_by)),
+                             self._rows(statistics.count_data(group_by)))
+            self.assertEqual(self._rows(stats.ItemEurosData(group_by)),
+                             self._rows(statistics.euros_data(group_by)))
+
+    def test_query_count(self):
+        with self.assertNumQueries(1):
+            stats.ItemStatistics.get()
+        with self.assertNumQueries(0):
+            stats.ItemStatistics.get()
+        with self.assertNumQueries(3):
+            general = stats.general_statistics()
+        self.assertEqual(general["registered"], 16)
+        self.assertEqual(general["brought"], 16)
+        self.assertEqual(general["sold"], 4)
+        self.assertEqual(general["vendors"], 2)
+
+
+@skipUnless(os.environ.get("KIRPPU_BENCHMARK"), "Set KIRPPU_BENCHMARK=1 to run benchmarks.")
+class ItemStatisticsBenchmark(TestCase):
+    ITEMS = int(os.environ.get("KIRPPU_BENCHMARK_ITEMS", 100000))
+    VENDORS = 2000
+
+    def test_benchmark(self):
+        item_types = ItemTypeFactory.create_batch(10)
+        vendors = [VendorFactory(user__username="bench_{}".format(i)) for i in range(self.VENDORS)]
+        states = [s for s, _ in Item.STATE]
+        Item.objects.bulk_create(
+            Item(
+                code="B%07d" % i,
+                name="Item %i" % i,
+                price=Decimal(i % 40 + 1),
+                vendor=vendors[i % len(vendors)],
+                itemtype=item_types[i % len(item_types)],
+                state=states[i % len(states)],
+            )
+            for i in range(self.ITEMS)
+        )
+
+        for name, fn in (
+                ("overview", stats.ItemStatistics.collect),
+                ("general", stats._collect_general_statistics),
+        ):
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                fn()
+                elapsed = time.perf_counter() - start
+            print("{}: {} queries, {:.3f} s".format(name, len(queries), elapsed))
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+from django.template import Context, Template
+from django.db import transaction
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+
+from kirppu.models import UIText
+from kirppu.text_cache import ui_text_cache
+
+from .factories import *
+
+__author__ = 'codez'
+
+
+class UITextCacheTest(TestCase):
+    def setUp(self):
+        UIText.objects.create(identifier="intro_1", text="First")
+        UIText.objects.create(identifier="intro_2", text="Second")
+        UIText.objects.create(identifier="other", text="Other")
+        ui_text_cache.reset_stats()
+
+    def tearDown(self):
+        # Test transaction rollback does not send delete signals.
+        ui_text_cache.invalidate()
+
+    def test_get(self):
+        with self.assertNumQueries(1):
+            self.assertEqual("First", ui_text_cache.get("intro_1"))
+            self.assertEqual("Other", UIText.get_text("other"))
+            self.assertEqual("x", UIText.get_text("missing", "x"))
+            self.assertEqual(["First", "Second"], ui_text_cache.starting_with("intro"))
+        self.assertEqual({"hits": 3, "misses": 1}, ui_text_cache.stats())
+
+    @override_settings(KIRPPU_UI_TEXT_CHECK_INTERVAL=0)
+    def test_other_process(self):
+        self.assertEqual("Other", ui_text_cache.get("other"))
+        # Another process changes the text without touching texts of this process.
+        UIText.objects.filter(identifier="other").update(text="Changed")
+        self.assertEqual("Other", ui_text_cache.get("other"))
+        ui_text_cache.cache.set(ui_text_cache.VERSION_KEY, "other")
+        self.assertEqual("Changed", ui_text_cache.get("other"))
+
+    @override_settings(KIRPPU_UI_TEXT_MAX_AGE=0)
+    def test_max_age(self):
+        self.assertEqual("Other", ui_text_cache.get("other"))
+        # Change is not seen through the version if the version cache is local to the other process.
+        UIText.objects.filter(identifier="other").update(text="Changed")
+        self.assertEqual("Changed", ui_text_cache.get("other"))
+
+    def test_tags(self):
+        template = Template('{% load kirppu_tags %}{% load_text "other" %}|{% load_texts "intro_" " " %}')
+        ui_text_cache.get("other")
+        with self.assertNumQueries(0):
+            self.assertEqual("Other|First Second", template.render(Context()))
+
+    def test_vendor_page(self):
+        user = UserFactory()
+        VendorFactory(user=user)
+        client = Client()
+        client.force_login(user)
+        client.get(reverse("kirppu:page"))
+        ui_text_cache.reset_stats()
+        client.get(reverse("kirppu:page"))
+        self.assertEqual(0, ui_text_cache.stats()["misses"])
+        self.assertGreater(ui_text_cache.stats()["hits"], 0)
+
+
+class UITextInvalidateTest(TransactionTestCase):
+    def setUp(self):
+        UIText.objects.create(identifier="intro_1", text="First")
+        ui_text_cache.reset_stats()
+
+    def tearDown(self):
+        ui_text_cache.invalidate()
+
+    def test_invalidate(self):
+        self.assertEqual("First", ui_text_cache.get("intro_1"))
+        text = UIText.objects.get(identifier="intro_1")
+        text.text = "Changed"
+        text.save()
+        self.assertEqual("Changed", ui_text_cache.get("intro_1"))
+        text.delete()
+        self.assertIsNone(ui_text_cache.get("intro_1"))
+        self.assertEqual(3, ui_text_cache.stats()["misses"])
+
+    def test_invalidate_on_commit(self):
+        ui_text_cache.get("intro_1")
+        version = ui_text_cache.cache.get(ui_text_cache.VERSION_KEY)
+        with transaction.atomic():
+            UIText.objects.get(identifier="intro_1").delete()
+            # Other processes would load the texts that are still committed.
+            self.assertEqual(version, ui_text_cache.cache.get(ui_text_cache.VERSION_KEY))
+        self.assertNotEqual(version, ui_text_cache.cache.get(ui_text_cache.VERSION_KEY))
+        self.assertIsNone(ui_text_cache.get("intro_1"))
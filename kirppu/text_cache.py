@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, print_function, absolute_import
+
+import threading
+from timeit import default_timer
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .models import UIText
+
+__author__ = 'codez'
+
+__all__ = [
+    "UITextCache",
+    "ui_text_cache",
+]
+
+
+class UITextCache(object):
+    """
+    Process local cache of all UIText values, loaded with one query.
+
+    Changes are propagated between workers through a version number stored in Django cache
+    `settings.KIRPPU_UI_TEXT_CACHE`: `invalidate` changes the version, and each process compares its
+    loaded version to it at most once in `settings.KIRPPU_UI_TEXT_CHECK_INTERVAL` seconds.
+    The cache is invalidated when a transaction saving or deleting UIText objects is committed.
+    Texts older than `settings.KIRPPU_UI_TEXT_MAX_AGE` seconds are loaded again regardless of the version,
+    which bounds the time old texts are shown if the version cache is not shared by all processes.
+
+    Hits and misses (lookups that loaded the texts) are counted per process, see `stats`.
+    """
+    VERSION_KEY = "kirppu:uitext:version"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._texts = None  # type: dict
+        self._version = None
+        self._loaded = 0.0
+        self._checked = 0.0
+        self._hits = 0
+        self._misses = 0
+
+    @property
+    def cache(self):
+        return caches[settings.KIRPPU_UI_TEXT_CACHE]
+
+    def _shared_version(self):
+        version = self.cache.get(self.VERSION_KEY)
+        if version is None:
+            # Start a new version also if the key was evicted, as other workers may have older texts.
+            self.cache.add(self.VERSION_KEY, uuid.uuid4().hex, timeout=None)
+            version = self.cache.get(self.VERSION_KEY)
+        return version
+
+    def _fresh(self, texts, now):
+        return texts is not None and now - self._loaded < settings.KIRPPU_UI_TEXT_MAX_AGE
+
+    def _current(self):
+        texts = self._texts
+        now = default_timer()
+        if self._fresh(texts, now) and now - self._checked < settings.KIRPPU_UI_TEXT_CHECK_INTERVAL:
+            self._hits += 1
+            return texts
+
+        version = self._shared_version()
+        with self._lock:
+            self._checked = now
+            if self._fresh(self._texts, now) and self._version == version:
+                self._hits += 1
+                return self._texts
+            self._misses += 1
+            self._texts = dict(UIText.objects.values_list("identifier", "text"))
+            self._version = version
+            self._loaded = now
+            return self._texts
+
+    def get(self, identifier, default=None):
+        """
+        :param identifier: Identifier of the text.
+        :param default: Value to return if there is no such text.
+        :return: Text of the identifier.
+        """
+        return self._current().get(identifier, default)
+
+    def starting_with(self, prefix):
+        """
+        :param prefix: Start of identifiers.
+        :return: Texts whose identifier starts with `prefix`, in identifier order.
+        :rtype: list
+        """
+        texts = self._current()
+        return [texts[identifier] for identifier in sorted(texts) if identifier.startswith(prefix)]
+
+    def invalidate(self):
+        """
+        Drop texts of this process and make other processes reload theirs.
+        """
+        self.cache.set(self.VERSION_KEY, uuid.uuid4().hex, timeout=None)
+        with self._lock:
+            self._texts = None
+            self._version = None
+
+    def stats(self):
+        """
+        :return: Numbers of hits and misses of this process.
+        :rtype: dict
+        """
+        return {
+            "hits": self._hits,
+            "misses": self._misses,
+        }
+
+    def reset_stats(self):
+        self._hits = self._misses = 0
+
+    def prometheus(self):
+        """
+        Format the statistics in Prometheus text exposition format.
+
+        :rtype: str
+        """
+        lines = []
+        for key, stat in sorted(self.stats().items()):
+            metric = "kirppu_ui_text_cache_{}_total".format(key)
+            lines.append("# HELP {} UIText cache {} of this process.".format(metric, key))
+            lines.append("# TYPE {} counter".format(metric))
+            lines.append("{} {}".format(metric, stat))
+        return "\n".join(lines) + "\n"
+
+
+ui_text_cache = UITextCache()
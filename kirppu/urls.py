@@ -4,6 +4,7 @@ from django.conf import settings
 from django.utils.six import itervalues
 
 from .views import (
+    barcode_image,
     get_boxes_codes,
     get_clerk_codes,
     get_counter_commands,
@@ -30,9 +31,13 @@ from .views import (
     type_stats_view,
     statistical_stats_view,
     lost_and_found_list,
+    api_metrics_page,
+    settlement_report,
+    export_view,
+    api_metrics_view,
 )
 from .checkout_api import AJAX_FUNCTIONS, checkout_js
-from .mobile import index as mobile_index, logout as mobile_logout
+from .mobile import index as mobile_index, logout as mobile_logout, events as mobile_events
 from .vendors import change_vendor, create_vendor
 
 __author__ = 'jyrkila'
@@ -43,6 +48,7 @@ _urls = [
     url(r'^clerks/$', get_clerk_codes, name='clerks'),
     url(r'^commands/$', get_counter_commands, name='commands'),
     url(r'^boxes/$', get_boxes_codes, name="box_codes"),
+    url(r'^barcode/(?P<code>[A-Za-z0-9]{1,32})\.(?P<ext>\w+)$', barcode_image, name="barcode"),
     url(r'^checkout/$', checkout_view, name='checkout_view'),
     url(r'^overseer/$', overseer_view, name='overseer_view'),
     url(r'^stats/$', stats_view, name='stats_view'),
@@ -61,6 +67,11 @@ _urls = [
     url(r'^vendor/item/(?P<code>\w+?)/hide$', item_hide, name='item_hide'),
     url(r'^remove_item', remove_item_from_receipt, name='remove_item_from_receipt'),
     url(r'^lost_and_found/$', lost_and_found_list, name='lost_and_found'),
+    url(r'^settlement\.(?P<ext>csv|json)$', settlement_report, name='settlement_report'),
+    url(r'^export/(?P<name>items|receipts|logs)\.(?P<ext>csv|ndjson)(?P<gz>\.gz)?$', export_view,
+        name='export'),
+    url(r'^metrics$', api_metrics_view, name='api_metrics_prometheus'),
+    url(r'^metrics/api/$', api_metrics_page, name='api_metrics'),
     url(r'^vendor/boxes/$', get_boxes, name='vendor_boxes'),
     url(r'^vendor/box/$', box_add, name='box_add'),
     url(r'^vendor/box/(?P<box_id>\w+?)/content$', box_content, name='box_content'),
@@ -69,6 +80,7 @@ _urls = [
 
     url(r'^vendor/status/$', mobile_index, name='mobile'),
     url(r'^vendor/status/logout/$', mobile_logout, name='mobile_logout'),
+    url(r'^vendor/status/events$', mobile_events, name='mobile_events'),
 ]
 
 if settings.KIRPPU_CHECKOUT_ACTIVE:  # Only activate API when checkout is active.
@@ -2,6 +2,8 @@
 from __future__ import print_function, absolute_import
 from django.utils.six import moves, indexbytes, int2byte
 import base64
+import hashlib
+import hmac
 import math
 
 """
@@ -257,6 +259,51 @@ def checksum(number, bits=4):
         number >>= bits
     return chk & mask
 
+
+class FeistelPermutation(object):
+    """
+    Keyed permutation of numbers of `bits` bits, made of a balanced Feistel network.
+
+    Every number maps to a different number of the same width, so a counter mapped through the permutation
+    gives unique numbers which cannot be guessed from each other without the key.
+
+    :param bits: Width of the numbers. Must be even.
+    :type bits: int
+    :param key: Secret key.
+    :type key: bytes
+    :param rounds: Number of Feistel rounds.
+    :type rounds: int
+
+    >>> p = FeistelPermutation(8, b"key")
+    >>> sorted(p(i) for i in range(256)) == list(range(256))
+    True
+    >>> [p(i) for i in range(4)] == [FeistelPermutation(8, b"key")(i) for i in range(4)]
+    True
+    >>> [p(i) for i in range(4)] == [FeistelPermutation(8, b"other")(i) for i in range(4)]
+    False
+
+    """
+    def __init__(self, bits, key, rounds=4):
+        if bits % 2 != 0:
+            raise ValueError("Width must be even: {}".format(bits))
+        self._bits = bits
+        self._half = bits // 2
+        self._mask = (1 << self._half) - 1
+        self._rounds = [hmac.new(key, int2byte(i), hashlib.sha256) for i in moves.range(rounds)]
+
+    def _round(self, i, value):
+        digest = self._rounds[i].copy()
+        digest.update(str(value).encode("ascii"))
+        return int(digest.hexdigest(), 16) & self._mask
+
+    def __call__(self, number):
+        if number >> self._bits != 0:
+            raise OverflowError("{0} does not fit into {1} bits".format(number, self._bits))
+        left, right = number >> self._half, number & self._mask
+        for i in moves.range(len(self._rounds)):
+            left, right = right, left ^ self._round(i, right)
+        return (left << self._half) | right
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
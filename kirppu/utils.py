@@ -244,8 +244,8 @@ def barcode_view(fn):
         default_format = 'png'
         bar_type = request.GET.get("format", default_format).lower()
 
-        # Pubcode supports only these formats.
-        if bar_type not in ('png', 'bmp'):
+        # Pubcode supports only png and bmp, svg is rendered by kirppu.barcodes.
+        if bar_type not in ('png', 'bmp', 'svg'):
             return HttpResponseBadRequest(_(u"Image extension not supported"))
 
         kwargs["bar_type"] = bar_type
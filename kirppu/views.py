@@ -2,6 +2,7 @@ from __future__ import unicode_literals, print_function, absolute_import
 from collections import namedtuple
 from functools import wraps
 import json
+import re
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
@@ -14,6 +15,7 @@ import django.urls as url
 from django.db import transaction, models
 from django.http.response import (
     HttpResponse,
+    StreamingHttpResponse,
     HttpResponseBadRequest,
     HttpResponseForbidden,
     HttpResponseRedirect,
@@ -26,11 +28,13 @@ from django.shortcuts import (
 )
 from django.utils import timezone
 from django.utils.formats import localize
+from django.utils.cache import patch_cache_control
+from django.utils.crypto import constant_time_compare
 from django.utils.six import string_types
 from django.utils.translation import ugettext as _
 from django.views.csrf import csrf_failure as django_csrf_failure
 from django.views.decorators.csrf import ensure_csrf_cookie
-from django.views.decorators.http import require_http_methods
+from django.views.decorators.http import etag, require_http_methods
 from django.views.generic import RedirectView
 
 from .checkout_api import clerk_logout_fn
@@ -41,13 +45,17 @@ from .models import (
     Box,
     Clerk,
     Item,
+    ItemStateBucket,
     ItemType,
     Vendor,
     UserAdapter,
     UIText,
     Receipt,
 )
-from .stats import ItemCountData, ItemEurosData
+from . import exports
+from .settlement import settlement_rows, stream_csv, stream_json
+from .stats import ItemCountData, ItemEurosData, ItemStatistics, general_statistics
+from .text_cache import ui_text_cache
 from .util import get_form
 from .utils import (
     barcode_view,
@@ -56,9 +64,14 @@ from .utils import (
     require_test,
     require_vendor_open,
 )
-from .templatetags.kirppu_tags import get_dataurl
+from .api_metrics import api_metrics
+from .barcodes import IMAGE_FORMATS, barcode_cache, expected_width
+from .templatetags.kirppu_tags import get_barcode_url
 from .vendors import get_multi_vendor_values
-import pubcode
+
+
+# One year, the maximum that should be used.
+BARCODE_MAX_AGE = 365 * 24 * 60 * 60
 
 
 def index(request):
@@ -89,20 +102,23 @@ def item_add(request):
     data = form.db_values()
     name = data.pop("name")
 
-    for suffix in form.cleaned_data["suffixes"]:
-        if item_cnt >= max_items:
-            error_msg = _(u"You have %(max_items)s items, which is the maximum. No more items can be registered.")
-            return HttpResponseBadRequest(error_msg % {'max_items': max_items})
-        item_cnt += 1
-
-        suffixed_name = (name + u" " + suffix).strip() if suffix else name
-        item = Item.new(
-            name=suffixed_name,
+    suffixes = form.cleaned_data["suffixes"]
+    allowed_suffixes = suffixes[:max(0, max_items - item_cnt)]
+    items = Item.new_many([
+        dict(
+            name=(name + u" " + suffix).strip() if suffix else name,
             vendor=vendor,
             **data
         )
+        for suffix in allowed_suffixes
+    ])
+    if len(allowed_suffixes) < len(suffixes):
+        error_msg = _(u"You have %(max_items)s items, which is the maximum. No more items can be registered.")
+        return HttpResponseBadRequest(error_msg % {'max_items': max_items})
+
+    for item in items:
         item_dict = item.as_public_dict()
-        item_dict['barcode_dataurl'] = get_dataurl(item.code, 'png')
+        item_dict['barcode_url'] = get_barcode_url(item.code, 'png')
         response.append(item_dict)
 
     return HttpResponse(json.dumps(response), 'application/json')
@@ -151,7 +167,7 @@ def item_to_not_printed(request, code):
     item_dict = {
         'vendor_id': new_item.vendor_id,
         'code': new_item.code,
-        'barcode_dataurl': get_dataurl(item.code, 'png'),
+        'barcode_url': get_barcode_url(new_item.code, 'png'),
         'name': new_item.name,
         'price': str(new_item.price).replace('.', ','),
         'type': new_item.type,
@@ -188,7 +204,9 @@ def item_update_price(request, code):
     if item.is_locked():
         return HttpResponseBadRequest("Item has been brought to event. Price can't be changed.")
 
+    old_price = item.price
     item.price = str(price)
+    ItemStateBucket.objects.record_price_change(item, old_price)
     item.save()
 
     return HttpResponse(str(price).replace(".", ","))
@@ -363,14 +381,25 @@ def _vendor_menu_contents(request):
         fill(_(u"Box list"), "kirppu:vendor_boxes"),
     ]
 
-    try:
-        # FIXME: Implement a better way to enable the link. db-options...
-        login_text = UIText.objects.get(identifier="mobile_login")
-        if "--enable--" in login_text.text:
-            items.append(fill(_("Mobile"), "kirppu:mobile"))
-    except UIText.DoesNotExist:
-        pass
+    # FIXME: Implement a better way to enable the link. db-options...
+    if "--enable--" in UIText.get_text("mobile_login", ""):
+        items.append(fill(_("Mobile"), "kirppu:mobile"))
 
+    manage_sub = _manage_menu_contents(request, fill)
+    if manage_sub:
+        items.append(fill(_(u"Management"), "", manage_sub))
+    return items
+
+
+def _manage_menu_contents(request, fill):
+    """
+    Generate the Management sub menu for Vendor views.
+
+    :param request: Current request being processed.
+    :param fill: Function creating a menu item from name and view name.
+    :return: List of menu items, empty if the user may not manage anything.
+    :rtype: list[MenuItem]
+    """
     manage_sub = []
     if request.user.is_staff or UserAdapter.is_clerk(request.user):
         manage_sub.append(fill(_(u"Checkout commands"), "kirppu:commands"))
@@ -381,6 +410,8 @@ def _vendor_menu_contents(request):
     if request.user.is_staff:
         manage_sub.append(fill(_(u"Clerk codes"), "kirppu:clerks"))
         manage_sub.append(fill(_(u"Lost and Found"), "kirppu:lost_and_found"))
+        if settings.KIRPPU_API_METRICS:
+            manage_sub.append(fill(_(u"API metrics"), "kirppu:api_metrics"))
 
     if request.user.is_staff\
             or UserAdapter.is_clerk(request.user)\
@@ -392,10 +423,7 @@ def _vendor_menu_contents(request):
             manage_sub.append(fill(_(u"Site administration"), "admin:index"))
         except url.NoReverseMatch as e:
             pass
-
-    if manage_sub:
-        items.append(fill(_(u"Management"), "", manage_sub))
-    return items
+    return manage_sub
 
 
 @login_required
@@ -521,7 +549,7 @@ def get_clerk_codes(request, bar_type):
     if items:
         # Generate a code to check it's length.
         name, code = items[0]
-        width = pubcode.Code128(code, charset='B').width(add_quiet_zone=True)
+        width = expected_width(code)
     else:
         width = None  # Doesn't matter.
 
@@ -542,6 +570,49 @@ def get_counter_commands(request, bar_type):
     })
 
 
+def _is_known_code(code):
+    box = re.match(r"^box(\d+)$", code)
+    if box is not None:
+        return Box.objects.filter(box_number=int(box.group(1))).exists()
+    return Item.objects.filter(code=code).exists()
+
+
+@login_required
+@require_http_methods(["GET", "HEAD"])
+def barcode_image(request, code, ext):
+    """
+    Get a barcode image. The image of a code never changes, so it may be cached for ever.
+
+    Clerks and staff may get an image of any code, vendors only those of their own items.
+    Images of codes that are not item or box codes are kept in the barcode cache only
+    `settings.KIRPPU_BARCODE_UNKNOWN_CACHE_TIME` seconds.
+
+    :param code: Code to render.
+    :type code: str
+    :param ext: Image format, one of `kirppu.barcodes.IMAGE_FORMATS`.
+    :type ext: str
+    :return: Image response.
+    :rtype: HttpResponse
+    """
+    if ext not in IMAGE_FORMATS:
+        raise Http404()
+    if request.user.is_staff or UserAdapter.is_clerk(request.user):
+        known = _is_known_code(code)
+    elif Item.objects.filter(code=code, vendor__user=request.user).exists():
+        known = True
+    else:
+        raise PermissionDenied()
+    return _barcode_image_response(request, code, ext, known)
+
+
+@etag(lambda request, code, ext, known: "{}.{}".format(code, ext))
+def _barcode_image_response(request, code, ext, known):
+    timeout = None if known else settings.KIRPPU_BARCODE_UNKNOWN_CACHE_TIME
+    response = HttpResponse(barcode_cache.get_image(code, ext, timeout=timeout), content_type=IMAGE_FORMATS[ext])
+    patch_cache_control(response, private=True, max_age=BARCODE_MAX_AGE, immutable=True)
+    return response
+
+
 @login_required
 @require_test(lambda request: request.user.is_staff or UserAdapter.is_clerk(request.user))
 @barcode_view
@@ -550,13 +621,12 @@ def get_boxes_codes(request, bar_type):
     vm = []
     for box in boxes:
         code = "box%d" % box.box_number
-        img = pubcode.Code128(code, charset='B').data_url(image_format=bar_type, add_quiet_zone=True)
         r = box.get_representative_item()  # type: Item
 
         vm.append({
             "name": box.description,
             "code": code,
-            "data_url": img,
+            "barcode_url": get_barcode_url(code, bar_type, expected_width(code)),
             "adult": r.adult,
             "vendor_id": r.vendor_id,
             "price": r.price_fmt,
@@ -638,8 +708,9 @@ def _statistics_access(fn):
 @_statistics_access
 def stats_view(request):
     """Stats view."""
-    ic = ItemCountData(ItemCountData.GROUP_ITEM_TYPE)
-    ie = ItemEurosData(ItemEurosData.GROUP_ITEM_TYPE)
+    statistics = ItemStatistics.get()
+    ic = statistics.count_data(ItemCountData.GROUP_ITEM_TYPE)
+    ie = statistics.euros_data(ItemEurosData.GROUP_ITEM_TYPE)
     sum_name = _("Sum")
     item_types = ItemType.objects.order_by("order").values_list("id", "title")
 
@@ -657,8 +728,8 @@ def stats_view(request):
 
     vendor_item_data_counts = []
     vendor_item_data_euros = []
-    vic = ItemCountData(ItemCountData.GROUP_VENDOR)
-    vie = ItemEurosData(ItemEurosData.GROUP_VENDOR)
+    vic = statistics.count_data(ItemCountData.GROUP_VENDOR)
+    vie = statistics.euros_data(ItemEurosData.GROUP_VENDOR)
     vie.use_cents = True
     vendor_item_data_row_size = 0
 
@@ -722,45 +793,7 @@ def _float_array(array):
 @ensure_csrf_cookie
 @_statistics_access
 def statistical_stats_view(request):
-    brought_states = (Item.BROUGHT, Item.STAGED, Item.SOLD, Item.COMPENSATED, Item.RETURNED)
-
-    registered = Item.objects.count()
-    deleted = Item.objects.filter(hidden=True).count()
-    brought = Item.objects.filter(state__in=brought_states).count()
-    sold = Item.objects.filter(state__in=(Item.STAGED, Item.SOLD, Item.COMPENSATED)).count()
-    printed_deleted = Item.objects.filter(hidden=True, printed=True).count()
-    deleted_brought = Item.objects.filter(hidden=True, state__in=brought_states).count()
-    printed_not_brought = Item.objects.filter(printed=True, state=Item.ADVERTISED).count()
-
-    items_in_box = Item.objects.filter(box__isnull=False).count()
-    items_not_in_box = Item.objects.filter(box__isnull=True).count()
-    registered_boxes = Box.objects.count()
-    deleted_boxes = Box.objects.filter(representative_item__hidden=True).count()
-    items_in_deleted_boxes = Item.objects.filter(box__representative_item__hidden=True).count()
-
-    general = {
-        "registered": registered,
-        "deleted": deleted,
-        "deletedOfRegistered": (deleted * 100.0 / registered) if registered > 0 else 0,
-        "brought": brought,
-        "broughtOfRegistered": (brought * 100.0 / registered) if registered > 0 else 0,
-        "broughtDeleted": deleted_brought,
-        "printedDeleted": printed_deleted,
-        "printedNotBrought": printed_not_brought,
-        "sold": sold,
-        "soldOfBrought": (sold * 100.0 / brought) if brought > 0 else 0,
-        "vendors": Vendor.objects.filter(item__state__in=brought_states).distinct().count(),
-        "vendorsTotal": Vendor.objects.count(),
-        "vendorsInMobileView": Vendor.objects.filter(mobile_view_visited=True).count(),
-
-        "itemsInBox": items_in_box,
-        "itemsNotInBox": items_not_in_box,
-        "registeredBoxes": registered_boxes,
-        "deletedBoxes": deleted_boxes,
-        "deletedOfRegisteredBoxes": (deleted_boxes * 100.0 / registered_boxes) if registered_boxes > 0 else 0,
-        "itemsInDeletedBoxes": items_in_deleted_boxes,
-        "itemsInDeletedBoxesOfRegistered": (items_in_deleted_boxes * 100.0 / registered) if registered > 0 else 0,
-    }
+    general = dict(general_statistics())
 
     compensations = Vendor.objects.filter(item__state=Item.COMPENSATED) \
         .annotate(v_sum=models.Sum("item__price")).order_by("v_sum").values_list("v_sum", flat=True)
@@ -879,6 +912,82 @@ def lost_and_found_list(request):
     })
 
 
+@login_required
+@require_test(lambda request: request.user.is_staff)
+@require_http_methods(["GET"])
+def settlement_report(request, ext):
+    """Settlement of all vendors as streamed CSV or JSON."""
+    if ext == "csv":
+        response = StreamingHttpResponse(stream_csv(settlement_rows()), content_type="text/csv; charset=utf-8")
+    else:
+        response = StreamingHttpResponse(stream_json(settlement_rows()), content_type="application/json")
+    response["Content-Disposition"] = 'attachment; filename="settlement.{}"'.format(ext)
+    return response
+
+
+@login_required
+@require_test(lambda request: request.user.is_staff)
+@require_http_methods(["GET"])
+def export_view(request, name, ext, gz):
+    """
+    Stream an export as CSV or NDJSON, optionally gzipped.
+    Query parameters `start`, `end` (ISO date or time) and `vendor` filter the rows.
+    """
+    try:
+        start = exports.parse_time(request.GET["start"]) if request.GET.get("start") else None
+        end = exports.parse_time(request.GET["end"]) if request.GET.get("end") else None
+        vendor = int(request.GET["vendor"]) if request.GET.get("vendor") else None
+        rows = exports.export_rows(name, start=start, end=end, vendor=vendor)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    columns = exports.EXPORTS[name].columns
+    if ext == "csv":
+        parts, content_type = exports.csv_lines(columns, rows), "text/csv; charset=utf-8"
+    else:
+        parts, content_type = exports.ndjson_lines(columns, rows), "application/x-ndjson; charset=utf-8"
+    if gz:
+        parts, content_type = exports.gzip_stream(parts), "application/gzip"
+
+    response = StreamingHttpResponse(parts, content_type=content_type)
+    response["Content-Disposition"] = 'attachment; filename="{}.{}{}"'.format(name, ext, gz or "")
+    return response
+
+
+def _metrics_access(request):
+    token = settings.KIRPPU_API_METRICS_TOKEN
+    if token and constant_time_compare(request.META.get("HTTP_AUTHORIZATION", ""), "Bearer " + token):
+        return True
+    return request.user.is_staff
+
+
+@require_http_methods(["GET"])
+@require_test(_metrics_access)
+def api_metrics_view(request):
+    """Checkout API and UIText cache metrics in Prometheus text format."""
+    return HttpResponse(api_metrics.prometheus() + ui_text_cache.prometheus(),
+                        content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@login_required
+@require_test(lambda request: request.user.is_staff)
+def api_metrics_page(request):
+    endpoints = sorted(api_metrics.snapshot().items())
+    for _name, values in endpoints:
+        calls = float(values["calls"])
+        values["avg_queries"] = values["queries"] / calls
+        values["avg_db_ms"] = 1000 * values["db_time"] / calls
+        values["avg_ms"] = 1000 * values["time"] / calls
+        values["max_ms"] = 1000 * values["max_time"]
+        values["avg_bytes"] = values["bytes"] / calls
+
+    return render(request, "kirppu/api_metrics.html", {
+        'menu': _vendor_menu_contents(request),
+        'enabled': api_metrics.enabled,
+        'endpoints': endpoints,
+    })
+
+
 def kirppu_csrf_failure(request, reason=""):
     if request.is_ajax() or request.META.get("HTTP_ACCEPT", "") == "text/json":
         # TODO: Unify the response to match requested content type.
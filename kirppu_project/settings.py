@@ -5,6 +5,7 @@ from __future__ import unicode_literals, print_function, absolute_import
 from decimal import Decimal
 import os.path
 import re
+import tempfile
 from django.utils.translation import ugettext_lazy as _
 
 import environ
@@ -36,6 +37,18 @@ if env.str("DEFAULT_FROM_EMAIL", None) is not None:
 DATABASES = {
     'default': env.db(default='sqlite:///db.sqlite3'),
 }
+if DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+    # Tests of concurrent transactions need a test database file instead of a shared in-memory database,
+    # where concurrent writers fail immediately with "database table is locked".
+    DATABASES['default'].setdefault('TEST', {}).setdefault(
+        'NAME', os.path.join(tempfile.gettempdir(), 'kirppu_test.sqlite3'))
+
+# Rendered barcode images are stored in "barcodes" cache. Use a cache shared by all workers in production,
+# for example BARCODE_CACHE_URL=filecache:///var/tmp/kirppu_barcodes or a memcached url.
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://'),
+    'barcodes': env.cache('BARCODE_CACHE_URL', default='locmemcache://kirppu-barcodes?max_entries=50000'),
+}
 
 # Hosts/domain names that are valid for this site; required if DEBUG is False
 # See https://docs.djangoproject.com/en/1.5/ref/settings/#allowed-hosts
@@ -115,6 +128,10 @@ SECRET_KEY = env.str('SECRET_KEY', default=(
     '' if not DEBUG else '=#j)-ml7x@a2iw9=#l7%i89l%cry6kch6x49=0%vcasq!!@97-'
 ))
 
+# Secret key of the item code permutation, see kirppu.item_codes. When changing SECRET_KEY, set this
+# to the old SECRET_KEY to keep making item codes with the same permutation.
+KIRPPU_ITEM_CODE_KEY = env.str('KIRPPU_ITEM_CODE_KEY', default=SECRET_KEY)
+
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -337,6 +354,68 @@ KIRPPU_EXHAUST_SHORT_CODE_ON_LOGOUT = False
 KIRPPU_SHORT_CODE_LENGTH = 5
 KIRPPU_MOBILE_LOGIN_RATE_LIMIT = "5/m"
 
+# Compare the running receipt totals to totals calculated from receipt rows on every change, and log any drift.
+KIRPPU_VERIFY_RECEIPT_TOTALS = env.bool("KIRPPU_VERIFY_RECEIPT_TOTALS", default=False)
+
+# Name of the cache in CACHES used for rendered barcode images.
+KIRPPU_BARCODE_CACHE = "barcodes"
+
+# Seconds an image of a code that is not an item or box code is kept in the barcode cache.
+KIRPPU_BARCODE_UNKNOWN_CACHE_TIME = 3600
+
+# Name of the cache in CACHES used to tell workers that UIText values have changed,
+# and the maximum seconds a worker uses its loaded texts without checking for changes.
+# The cache must be shared by all workers for changes to reach every worker within the interval.
+# Otherwise, like with the default process local cache, other workers show old texts until
+# their texts are KIRPPU_UI_TEXT_MAX_AGE seconds old.
+KIRPPU_UI_TEXT_CACHE = "default"
+KIRPPU_UI_TEXT_CHECK_INTERVAL = 1.0
+KIRPPU_UI_TEXT_MAX_AGE = 60
+
+# Name of the cache in CACHES, and seconds, to keep the clerk and counter of checkout sessions
+# between requests. Changes to clerk user permissions take effect only after this time. Changes to
+# Clerk and Counter objects take effect when they are committed if the cache is shared by all workers,
+# and otherwise only after this time in the other workers. Time 0 loads them on every request, and is
+# the default unless the default cache is shared, that is, not the process local cache.
+KIRPPU_CHECKOUT_IDENTITY_CACHE = "default"
+KIRPPU_CHECKOUT_IDENTITY_CACHE_TIME = env.int(
+    "KIRPPU_CHECKOUT_IDENTITY_CACHE_TIME",
+    default=0 if CACHES[KIRPPU_CHECKOUT_IDENTITY_CACHE]["BACKEND"].endswith(".LocMemCache") else 30,
+)
+
+# Name of the cache in CACHES, and seconds, to keep vendor item status snapshots of the mobile view.
+# Snapshots are replaced when items of the vendor change.
+KIRPPU_VENDOR_STATUS_CACHE = "default"
+KIRPPU_VENDOR_STATUS_CACHE_TIME = 600
+
+# Live update events of vendor items and counter receipts, see kirppu.events.
+# Name of the cache in CACHES holding the events, seconds an event is kept, seconds one
+# event stream response lasts before the client reconnects, and seconds between event reads.
+# The cache must be shared by all workers for the events to reach every client; with the default
+# process local cache, a client gets only events published in the worker serving its request.
+# Polling is intended by default: a stream holds a sync worker, such as the default gunicorn worker,
+# for all of its time, so with stream time 0 a response returns after one read and clients poll by
+# reconnecting every KIRPPU_EVENT_POLL_INTERVAL seconds. Set a stream time, e.g. 25, only with
+# threaded or asynchronous workers; clients then get events as they are read, without reconnecting.
+KIRPPU_EVENT_CACHE = "default"
+KIRPPU_EVENT_TIME = 300
+KIRPPU_EVENT_STREAM_TIME = env.int("KIRPPU_EVENT_STREAM_TIME", default=0)
+KIRPPU_EVENT_POLL_INTERVAL = 2.0
+
+# Number of item code sequence numbers each process reserves at a time, see kirppu.item_codes.
+# Unused numbers of a block are skipped when the process ends.
+KIRPPU_ITEM_CODE_BLOCK = 100
+
+# Seconds the statistics overview results are cached.
+KIRPPU_STATS_CACHE_TIME = 30
+
+# Record query counts, database time, latency and response sizes of checkout API functions.
+# The metrics are shown to staff, and in Prometheus format in /kirppu/metrics to staff or
+# with `Authorization: Bearer <KIRPPU_API_METRICS_TOKEN>` header if the token is set.
+# Calls exceeding the query budget of their function are logged and counted.
+KIRPPU_API_METRICS = env.bool("KIRPPU_API_METRICS", default=False)
+KIRPPU_API_METRICS_TOKEN = env.str("KIRPPU_API_METRICS_TOKEN", default="")
+
 CSRF_FAILURE_VIEW = "kirppu.views.kirppu_csrf_failure"
 
 
@@ -345,6 +424,13 @@ def KIRPPU_POST_PROVISION(sold_and_compensated):
     return None
 
 
+# Alternative provision function taking arrays of item prices in cents and item type ids, used instead
+# of KIRPPU_POST_PROVISION when set. See kirppu.provision_arrays, e.g.
+#   from kirppu.provision_arrays import PercentageProvision
+#   KIRPPU_POST_PROVISION_PRICES = PercentageProvision(10, step="0.50")
+KIRPPU_POST_PROVISION_PRICES = None
+
+
 # Load local settings that are not stored in repository. This must be last at end of settings.
 try:
     from .local_settings import *